@@ -0,0 +1,61 @@
+"""Пропускная способность недельной рассылки на заглушке Bot с задержкой ответа.
+Часть получателей ни разу не писала боту (CantInitiateConversation): на них тратится одна попытка"""
+import argparse
+import asyncio
+
+from aiogram.utils.exceptions import CantInitiateConversation
+
+from bench_utils import Timer, main, report, seed_users, temp_database
+
+
+class FakeBot:
+    def __init__(self, latency: float, unreachable: float):
+        self.latency = latency
+        self.unreachable = unreachable
+        self.calls = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if chat_id % 100 < self.unreachable * 100:
+            raise CantInitiateConversation("Forbidden: bot can't initiate conversation with a user")
+
+
+async def run(users: int, rate: float, concurrency: int, latency: float, unreachable: float):
+    async with temp_database(queue=False):
+        await seed_users(users)
+        bot = FakeBot(latency, unreachable)
+        sender = main.BroadcastSender(bot, concurrency, rate, main.SEND_PER_CHAT_INTERVAL, main.SEND_RETRIES)
+        digest = main.WeeklyDigest(sender, main.DIGEST_BATCH_SIZE)
+        with Timer() as timer:
+            stats = await digest.run(1)
+    return {
+        'rate_limit': 'none' if rate >= 1e6 else rate,
+        'concurrency': concurrency,
+        'recipients': users,
+        'api_calls': bot.calls,
+        'sent': stats.get('sent', 0),
+        'blocked': stats.get('blocked', 0),
+        'seconds': timer.elapsed,
+        'msgs_per_sec': users / timer.elapsed
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа Bot API, сек')
+    parser.add_argument('--unreachable', type=float, default=0.3, help='доля получателей без диалога с ботом')
+    args = parser.parse_args()
+
+    # Без лимита видна собственная пропускная способность, с боевым лимитом - его соблюдение
+    variants = [(1e6, main.SEND_CONCURRENCY, args.users), (1e6, 100, args.users),
+                (main.SEND_RATE, main.SEND_CONCURRENCY, min(args.users, 250))]
+    rows = [asyncio.run(run(users, rate, concurrency, args.latency, args.unreachable))
+            for rate, concurrency, users in variants]
+    report(f"Weekly digest, Bot API latency {args.latency * 1000:.0f} ms, "
+           f"{args.unreachable:.0%} unreachable recipients", rows)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,81 @@
+"""Конкурентные /stats с отрисовкой диаграммы: в цикле событий (как до выноса в пул) и в пуле процессов,
+с кэшем готовых PNG и без. Задержка цикла событий - насколько опаздывает таймер на 1 мс, пока идут /stats"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+
+from bench_utils import (Timer, dispatch, fake_telegram, main, message_update, percentile, report, seed_users,
+                         temp_database)
+
+
+class InlineExecutor(Executor):
+    """Отрисовка прямо в цикле событий: run_in_executor возвращает уже готовый результат"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+async def loop_lag(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - started - 0.001)
+
+
+async def run(offload: bool, cache: bool, backend: str, users: int, updates: int, concurrency: int) -> dict:
+    # Разные счета - разные ключи кэша; с кэшем счета повторяются, как у реальных пользователей
+    max_score = 50 if cache else 10 ** 6
+    main.chart_cache = main.LRUCache(main.CHART_CACHE_SIZE if cache else 1)
+    main.CHART_BACKEND = backend
+    executor = (ProcessPoolExecutor(main.CHART_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+                if offload else InlineExecutor())
+    main.chart_executor = executor
+    try:
+        # Прогрев: запуск процессов и импорт бэкенда
+        await asyncio.gather(*(asyncio.get_running_loop().run_in_executor(executor, main.render_pie_chart, 1, 2,
+                                                                          backend)
+                               for _ in range(main.CHART_WORKERS)))
+        async with temp_database(), fake_telegram():
+            await seed_users(users, max_score=max_score)
+            await main.rank_index.load()
+            batch = [message_update(user_id, user_id, '/stats') for user_id in range(1, updates + 1)]
+
+            stop, lags = asyncio.Event(), []
+            ticker = asyncio.ensure_future(loop_lag(stop, lags))
+            with Timer() as timer:
+                latencies = await dispatch(batch, concurrency)
+            stop.set()
+            await ticker
+    finally:
+        executor.shutdown()
+
+    return {
+        'rendering': f"process pool ({main.CHART_WORKERS})" if offload else 'event loop',
+        'cache': cache,
+        'cache_hits': main.chart_cache.hits,
+        'stats_per_sec': updates / timer.elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_loop_lag_ms': max(lags) * 1000
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--updates', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--backend', choices=list(main.CHART_BACKENDS), default=main.CHART_BACKEND)
+    args = parser.parse_args()
+
+    rows = [asyncio.run(run(offload, cache, args.backend, args.users, args.updates, args.concurrency))
+            for offload, cache in ((False, False), (True, False), (False, True), (True, True))]
+    report(f"{args.updates} concurrent /stats ({args.concurrency} at a time), backend {args.backend}", rows)
+
+
+if __name__ == '__main__':
+    cli()
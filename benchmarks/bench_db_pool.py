@@ -0,0 +1,97 @@
+"""Задержка и пропускная способность обработчиков при конкурентных обновлениях: общий пул соединений
+(писатель и читатели) против прежней схемы с новым aiosqlite.connect на каждый вызов функции данных.
+Bot API - заглушка без задержки, диаграмма в /stats подменена готовой картинкой (её стоимость - bench_charts.py)"""
+import argparse
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from io import BytesIO
+
+import aiosqlite
+
+from bench_utils import (Timer, dispatch, fake_telegram, main, message_update, percentile, report, seed_users,
+                         temp_database)
+
+COMMANDS = ['/stats', '/leaderboard', '📢 Реферальная система', '⚙️ Настройки']
+
+
+class ConnectPerCall(main.Database):
+    """Прежняя схема: каждое чтение и каждая запись открывают свое соединение (поток aiosqlite и файл)"""
+
+    async def _open(self) -> aiosqlite.Connection:
+        db = main.TracedConnection(await aiosqlite.connect(self.path))
+        for name, path in self.attachments.items():
+            await db.execute(f"ATTACH DATABASE ? AS {name}", (path,))
+        return db
+
+    @asynccontextmanager
+    async def read(self):
+        db = await self._open()
+        try:
+            yield db
+        finally:
+            await db.close()
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            db = await self._open()
+            try:
+                await db.execute('BEGIN IMMEDIATE')
+                try:
+                    yield db
+                    await db.commit()
+                except BaseException:
+                    self._on_commit.clear()
+                    await db.rollback()
+                    raise
+                self._run_on_commit()
+            finally:
+                await db.close()
+
+
+async def stub_pie_chart(user_id, user_score=None):
+    return BytesIO(b'png')
+
+
+async def run(mode: str, users: int, updates: int, concurrency: int) -> dict:
+    rng = random.Random(451)
+    async with temp_database(), fake_telegram():
+        await seed_users(users)
+        await main.rank_index.load()
+        await main.referral_graph.load()
+        batch = [message_update(update_id, user_id, rng.choice(COMMANDS))
+                 for update_id, user_id in enumerate(rng.sample(range(1, users + 1), updates), 1)]
+
+        main.db_pool.__class__ = ConnectPerCall if mode == 'connect per call' else main.Database
+        try:
+            with Timer() as timer:
+                latencies = await dispatch(batch, concurrency)
+        finally:
+            main.db_pool.__class__ = main.Database
+
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'updates': updates,
+        'updates_per_sec': updates / timer.elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+    args = parser.parse_args()
+
+    main.generate_pie_chart = stub_pie_chart
+    rows = [asyncio.run(run(mode, args.users, args.updates, concurrency))
+            for concurrency in args.concurrency for mode in ('connect per call', 'pool')]
+    report(f"Handlers ({', '.join(COMMANDS)}), {args.users} users", rows)
+
+
+if __name__ == '__main__':
+    cli()
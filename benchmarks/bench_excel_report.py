@@ -0,0 +1,91 @@
+"""Выгрузка отчета Excel при 10^5 пользователей: время и пиковая память потоковой write_excel_report
+(один LEFT JOIN/GROUP BY, курсор кусками, write_only) против прежней схемы (fetchall, запрос SUM по заказам
+на каждого пользователя, Workbook целиком в памяти). Каждый вариант - отдельный процесс"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import tempfile
+import time
+
+from bench_utils import main, report, seed_users, temp_database
+
+
+def old_excel_report(path: str):
+    """Прежняя выгрузка: все пользователи в памяти и N+1 запросов"""
+    from openpyxl import Workbook
+
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Рейтинг участников"
+    ws.append(["Место", "ID", "Username", "Имя", "Баллы", "Рефералов", "Подписка", "Куплено книг", "Создано книг"])
+    db = sqlite3.connect(main.DB_PATH)
+    try:
+        users = db.execute('''SELECT user_id, username, full_name, score, referrals, is_subscribed
+                           FROM users ORDER BY score DESC''').fetchall()
+        for idx, user in enumerate(users, 1):
+            purchased, created = db.execute('''SELECT SUM(books_purchased), SUM(books_created)
+                                            FROM orders WHERE user_id = ?''', (user[0],)).fetchone()
+            ws.append([idx, user[0], user[1], user[2], user[3], user[4], "Да" if user[5] else "Нет",
+                       purchased or 0, created or 0])
+    finally:
+        db.close()
+    wb.save(path)
+
+
+def export(variant: str, path: str, results):
+    os.chdir(path)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    started = time.perf_counter()
+    (old_excel_report if variant == 'old' else main.write_excel_report)(os.path.join(path, f"{variant}.xlsx"))
+    elapsed = time.perf_counter() - started
+    results.put({
+        'variant': 'fetchall + N+1 + Workbook' if variant == 'old' else 'write_excel_report (streaming)',
+        'seconds': elapsed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'rss_growth_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - rss_before,
+        'file_mb': os.path.getsize(os.path.join(path, f"{variant}.xlsx")) / 2 ** 20
+    })
+
+
+async def seed(users: int, orders: float):
+    await seed_users(users)
+    rng = random.Random(451)
+    rows = [(user_id, f'user{user_id}', rng.randrange(5), rng.randrange(3), '2024-01-01')
+            for user_id in range(1, users + 1) if rng.random() < orders]
+    async with main.db_pool.write() as db:
+        await db.executemany('''INSERT INTO orders (user_id, username, books_purchased, books_created, timestamp)
+                             VALUES (?, ?, ?, ?, ?)''', rows)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10 ** 5)
+    parser.add_argument('--orders', type=float, default=0.3, help='доля пользователей с заказом')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        async def prepare():
+            async with temp_database(queue=False):
+                await seed(args.users, args.orders)
+                # База копируется из временного каталога temp_database в общий для процессов
+                async with main.db_pool.exclusive() as db:
+                    await db.execute('VACUUM INTO ?', (os.path.join(path, main.DB_PATH),))
+        asyncio.run(prepare())
+
+        for variant in ('old', 'streaming'):
+            results = context.Queue()
+            process = context.Process(target=export, args=(variant, path, results))
+            process.start()
+            rows.append(results.get())
+            process.join()
+    report(f"Excel report, {args.users} users", rows)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,74 @@
+"""Нагрузочный генератор очереди записи: конкурентные отправители ставят add_points и add_order в LedgerQueue.
+Считаются события/сек, ошибки, размер пачек и задержка от submit до commit"""
+import argparse
+import asyncio
+import random
+import time
+
+from bench_utils import Timer, main, percentile, report, seed_users, temp_database
+
+
+async def submitter(queue: 'main.LedgerQueue', events: int, users: int, order_share: float,
+                    rng: random.Random, latencies: list, errors: list):
+    actions = list(main.POINT_SYSTEM)
+    for _ in range(events):
+        user_id = rng.randrange(1, users + 1)
+        if rng.random() < order_share:
+            future = queue.submit(main.add_order, user_id, f'user{user_id}', rng.randrange(2), rng.randrange(2))
+        else:
+            future = queue.submit(main.add_points, user_id, rng.choice(actions))
+        started = time.perf_counter()
+        try:
+            await future
+        except Exception as e:
+            errors.append(e)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run(users: int, submitters: int, events: int, order_share: float, batch_size: int):
+    async with temp_database(queue=False):
+        await seed_users(users)
+        queue = main.LedgerQueue(batch_size, main.LEDGER_FLUSH_INTERVAL)
+        queue.start()
+        rng = random.Random(451)
+        latencies, errors = [], []
+        per_submitter = events // submitters
+        try:
+            with Timer() as timer:
+                await asyncio.gather(*(submitter(queue, per_submitter, users, order_share,
+                                                 random.Random(rng.random()), latencies, errors)
+                                       for _ in range(submitters)))
+        finally:
+            await queue.stop()
+    total = per_submitter * submitters
+    return {
+        'batch_size': batch_size,
+        'submitters': submitters,
+        'events': total,
+        'failed': queue.failed,
+        'lock_errors': sum('locked' in str(e) for e in errors),
+        'batches': queue.batches,
+        'mean_batch': total / max(queue.batches, 1),
+        'events_per_sec': total / timer.elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--submitters', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--order-share', type=float, default=0.2, help='доля add_order среди событий')
+    args = parser.parse_args()
+
+    # batch_size=1 - commit на каждое событие, как до очереди записи
+    variants = [(1, args.submitters[0])] + [(main.LEDGER_BATCH_SIZE, submitters) for submitters in args.submitters]
+    rows = [asyncio.run(run(args.users, submitters, args.events, args.order_share, batch_size))
+            for batch_size, submitters in variants]
+    report(f"Ledger queue, {args.users} users, {args.order_share:.0%} add_order", rows)
+
+
+if __name__ == '__main__':
+    cli()
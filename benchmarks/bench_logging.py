@@ -0,0 +1,86 @@
+"""Накладные расходы логирования на обработку обновления в каждом режиме: формат text/json,
+запись синхронно или через очередь (LOG_QUEUE), доля логируемых обновлений (LOG_UPDATES_SAMPLE).
+Вывод идет в файл: на терминале или в pipe синхронная запись обходится дороже"""
+import argparse
+import asyncio
+import atexit
+import logging
+import os
+import sys
+import tempfile
+
+from aiogram import types
+
+from bench_utils import Timer, main, report
+
+
+def make_message(user_id: int) -> types.Message:
+    return types.Message(**{
+        'message_id': user_id, 'date': 0, 'text': '/stats',
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+    })
+
+
+async def process(middleware, messages, errors: bool):
+    for message in messages:
+        data = {}
+        await middleware.on_pre_process_message(message, data)
+        if errors:
+            # Путь ошибки обработчика: запись с изменяемым словарем в аргументах
+            main.logger.error("Error in handler for %s: %s", message.from_user.id, data)
+        await middleware.on_post_process_message(message, [], data)
+
+
+def run(fmt: str, use_queue: bool, sample: float, updates: int, errors: bool, path: str) -> dict:
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    stderr = sys.stderr
+    with open(os.path.join(path, f"{fmt}-{use_queue}-{sample}.log"), 'w') as stream:
+        sys.stderr = stream
+        try:
+            listener = main.setup_logging('INFO', fmt, use_queue)
+        finally:
+            sys.stderr = stderr
+
+        middleware = main.UpdateLoggingMiddleware(sample)
+        messages = [make_message(user_id) for user_id in range(updates)]
+        with Timer() as timer:
+            asyncio.run(process(middleware, messages, errors))
+        # Сколько потоку записи еще нужно, чтобы дописать очередь
+        with Timer() as drain:
+            if listener is not None:
+                atexit.unregister(listener.stop)
+                listener.stop()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+            handler.flush()
+
+    return {
+        'format': fmt,
+        'queue': use_queue,
+        'sample': sample,
+        'error_logs': errors,
+        'us_per_update': timer.elapsed / updates * 1e6,
+        'drain_ms': drain.elapsed * 1000
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=50000)
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as path:
+        for sample, errors in ((main.LOG_UPDATES_SAMPLE, False), (1.0, False), (1.0, True)):
+            for fmt in ('text', 'json'):
+                for use_queue in (False, True):
+                    rows.append(run(fmt, use_queue, sample, args.updates, errors, path))
+    report("Logging overhead per update (UpdateLoggingMiddleware pre+post, optional error record)", rows)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,103 @@
+"""Рейтинг в памяти при 10^5-10^6 пользователей: блочный SortedKeys против простого отсортированного list
+(прежняя реализация с bisect.insort/del) и SQL-запроса места по индексу (is_subscribed, score)"""
+import argparse
+import asyncio
+import bisect
+import random
+
+from bench_utils import Timer, main, report, seed_users, temp_database
+
+
+class PlainKeys:
+    """Прежний вариант RankIndex: list с bisect.insort и del - O(n) на изменение"""
+
+    def __init__(self, keys):
+        self._keys = list(keys)
+
+    def add(self, key):
+        bisect.insort(self._keys, key)
+
+    def discard(self, key):
+        idx = bisect.bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            del self._keys[idx]
+
+    def bisect_left(self, key):
+        return bisect.bisect_left(self._keys, key)
+
+    def islice(self, start, stop):
+        return self._keys[max(start, 0):stop]
+
+
+def measure(structure, users: int, operations: int, rng: random.Random):
+    scores = {user_id: rng.randrange(users // 10) for user_id in range(users)}
+    keys = sorted((-score, user_id) for user_id, score in scores.items())
+
+    with Timer() as build:
+        index = structure(keys)
+
+    # Изменение счета - как RankIndex.add_points: удаление старого ключа и вставка нового
+    updated = [rng.randrange(users) for _ in range(operations)]
+    with Timer() as update:
+        for user_id in updated:
+            index.discard((-scores[user_id], user_id))
+            scores[user_id] += rng.randrange(1, 8)
+            index.add((-scores[user_id], user_id))
+
+    probes = [(-scores[rng.randrange(users)],) for _ in range(operations)]
+    with Timer() as position:
+        for probe in probes:
+            index.bisect_left(probe)
+
+    with Timer() as around:
+        for probe in probes:
+            idx = index.bisect_left(probe)
+            index.islice(idx - 2, idx + 3)
+
+    return {
+        'structure': structure.__name__,
+        'users': users,
+        'build_s': build.elapsed,
+        'update_us': update.elapsed / operations * 1e6,
+        'position_us': position.elapsed / operations * 1e6,
+        'around_us': around.elapsed / operations * 1e6,
+        'batch_500_ms': update.elapsed / operations * 500 * 1e3
+    }
+
+
+async def measure_sql(users: int, operations: int, rng: random.Random):
+    async with temp_database(queue=False):
+        await seed_users(users, subscribed=0.8, max_score=users // 10)
+        main.rank_index.ready = False
+        probes = [rng.randrange(1, users + 1) for _ in range(operations)]
+        with Timer() as position:
+            for user_id in probes:
+                await main.get_user_position(user_id)
+    return {
+        'structure': 'SQL (is_subscribed, score)',
+        'users': users,
+        'build_s': '-',
+        'update_us': '-',
+        'position_us': position.elapsed / operations * 1e6,
+        'around_us': '-',
+        'batch_500_ms': '-'
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, nargs='+', default=[10 ** 5, 10 ** 6])
+    parser.add_argument('--operations', type=int, default=20000)
+    parser.add_argument('--sql-operations', type=int, default=200)
+    args = parser.parse_args()
+
+    rows = []
+    for users in args.users:
+        for structure in (PlainKeys, main.SortedKeys):
+            rows.append(measure(structure, users, args.operations, random.Random(451)))
+        rows.append(asyncio.run(measure_sql(users, args.sql_operations, random.Random(451))))
+    report("Rank index: per-operation cost (batch_500_ms - event loop stall for one ledger batch of updates)", rows)
+
+
+if __name__ == '__main__':
+    cli()
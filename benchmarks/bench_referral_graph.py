@@ -0,0 +1,94 @@
+"""Граф рефералов в памяти на синтетическом графе из 10^6 связей: загрузка, память и операции
+против SQL-запросов по индексам таблицы referrals. Топ рефереров сравнивается с прежним
+heapq.nlargest по всем реферерам на каждый вызов"""
+import argparse
+import asyncio
+import heapq
+import random
+
+from bench_utils import Timer, main, peak_rss_mb, report, temp_database
+
+
+async def seed_edges(edges: int, subscribed: float, rng: random.Random):
+    """Дерево приглашений: приглашенный i приходит от одного из ранних пользователей (степенное распределение)"""
+    rows = [(min(int(referral_id * rng.random() ** 3) + 1, referral_id - 1), referral_id, rng.random() < subscribed)
+            for referral_id in range(2, edges + 2)]
+    async with main.db_pool.write() as db:
+        await db.executemany('INSERT INTO referrals (referrer_id, referral_id, subscribed) VALUES (?, ?, ?)', rows)
+    return rows
+
+
+def per_call_us(func, args_list) -> float:
+    with Timer() as timer:
+        for args in args_list:
+            func(*args)
+    return timer.elapsed / len(args_list) * 1e6
+
+
+async def sql_per_call_us(sql: str, args_list) -> float:
+    async with main.db_pool.read() as db:
+        with Timer() as timer:
+            for args in args_list:
+                cursor = await db.execute(sql, args)
+                await cursor.fetchall()
+    return timer.elapsed / len(args_list) * 1e6
+
+
+async def run(edges: int, operations: int, subscribed: float):
+    rng = random.Random(451)
+    async with temp_database(queue=False):
+        rows = await seed_edges(edges, subscribed, rng)
+        graph = main.referral_graph
+        rss_before = peak_rss_mb()
+        with Timer() as load:
+            await graph.load()
+        rss_after = peak_rss_mb()
+
+        users = [rng.randrange(1, edges + 2) for _ in range(operations)]
+        pairs = [rows[rng.randrange(len(rows))][:2] for _ in range(operations)]
+        top_referrer = graph.top(1)[0][0]
+
+        def old_top(limit):
+            return heapq.nlargest(limit, graph._referrals.items(), key=lambda item: len(item[1]))
+
+        results = [
+            ('top(5)', per_call_us(graph.top, [(main.TOP_REFERRERS,)] * 100),
+             await sql_per_call_us('''SELECT referrer_id, COUNT(*) FROM referrals WHERE subscribed = 1
+                                   GROUP BY referrer_id ORDER BY COUNT(*) DESC LIMIT 5''', [()] * 3)),
+            ('top(5), heapq.nlargest', per_call_us(old_top, [(main.TOP_REFERRERS,)] * 10), '-'),
+            ('has_edge', per_call_us(graph.has_edge, pairs),
+             await sql_per_call_us('SELECT 1 FROM referrals WHERE referral_id = ? AND referrer_id = ?',
+                                   [(b, a) for a, b in pairs])),
+            ('creates_cycle (new user)', per_call_us(graph.creates_cycle, [(user_id, edges + 10)
+                                                                           for user_id in users]), '-'),
+            ('creates_cycle (existing)', per_call_us(graph.creates_cycle, [(b, a) for a, b in pairs]), '-'),
+            (f'downline_levels({main.REFERRAL_DEPTH})',
+             per_call_us(graph.downline_levels, [(user_id, main.REFERRAL_DEPTH) for user_id in users]), '-'),
+            (f'downline_levels({main.REFERRAL_DEPTH}), top referrer',
+             per_call_us(graph.downline_levels, [(top_referrer, main.REFERRAL_DEPTH)] * 10), '-'),
+            ('subscribed count', per_call_us(lambda user_id: graph._counts.get(user_id, 0), [(u,) for u in users]),
+             await sql_per_call_us('SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND subscribed = 1',
+                                   [(user_id,) for user_id in users])),
+        ]
+        with Timer() as subscribe:
+            for user_id in users:
+                graph.mark_subscribed(user_id)
+        results.append(('mark_subscribed', subscribe.elapsed / operations * 1e6, '-'))
+
+    report(f"Referral graph, {edges} edges: load {load.elapsed:.2f} s, "
+           f"peak RSS +{rss_after - rss_before:.0f} MB", [
+               {'operation': name, 'memory_us': memory, 'sql_us': sql} for name, memory, sql in results
+           ])
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--edges', type=int, default=10 ** 6)
+    parser.add_argument('--operations', type=int, default=10000)
+    parser.add_argument('--subscribed', type=float, default=0.6, help='доля подписавшихся приглашенных')
+    args = parser.parse_args()
+    asyncio.run(run(args.edges, args.operations, args.subscribed))
+
+
+if __name__ == '__main__':
+    cli()
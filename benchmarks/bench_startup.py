@@ -0,0 +1,59 @@
+"""Время запуска и память процесса для бэкендов диаграмм: каждый вариант - новый интерпретатор.
+'eager pyplot' - прежний импорт matplotlib.pyplot в начале main.py; matplotlib и png - импорт main
+и первая круговая диаграмма выбранным бэкендом (matplotlib импортируется только при ней)"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from bench_utils import report
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json, resource, sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+if {eager}:
+    import matplotlib.pyplot
+import main
+imported = time.perf_counter()
+if {backend!r}:
+    main.render_pie_chart(120, 1000, {backend!r})
+rendered = time.perf_counter()
+print(json.dumps({{'import_s': imported - started, 'chart_s': rendered - imported,
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'matplotlib': 'matplotlib' in sys.modules}}))
+'''
+
+
+def measure(eager: bool, backend: str, repeat: int) -> dict:
+    env = dict(os.environ, LOG_LEVEL='WARNING')
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', CHILD.format(root=ROOT, eager=eager, backend=backend)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'variant': ('eager pyplot' if eager else 'lazy') + (f", first chart: {backend}" if backend else ''),
+        'matplotlib_loaded': samples[0]['matplotlib'],
+        'import_s': statistics.median(sample['import_s'] for sample in samples),
+        'first_chart_s': statistics.median(sample['chart_s'] for sample in samples),
+        'peak_rss_mb': statistics.median(sample['rss_mb'] for sample in samples)
+    }
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5, help='запусков на вариант (берется медиана)')
+    args = parser.parse_args()
+
+    variants = [(True, ''), (False, ''), (False, 'png'), (False, 'matplotlib')]
+    rows = [measure(eager, backend, args.repeat) for eager, backend in variants]
+    report("Process startup and memory by chart backend", rows)
+
+
+if __name__ == '__main__':
+    cli()
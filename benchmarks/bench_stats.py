@@ -0,0 +1,93 @@
+"""/stats через диспетчер: сбор статистики из исходных таблиц на каждый запрос (без снимков) против снимков
+user_stats - холодный кэш (снимок собирается и сохраняется), таблица user_stats и LRU в памяти.
+Запросов на /stats - по метрике bot_handler_db_queries; отрисовка диаграммы подменена, запрос общего счета остается"""
+import argparse
+import asyncio
+import random
+
+from bench_utils import (Timer, dispatch, fake_telegram, main, message_update, percentile, report, reset_throttling,
+                         seed_users, temp_database)
+
+
+async def seed_history(users: int, actions: int, rng: random.Random):
+    """actions начислений и заказ у каждого пользователя"""
+    grants = [(rng.randrange(1, users + 1), rng.choice(list(main.POINT_SYSTEM)), 1, None)
+              for _ in range(users * actions)]
+    async with main.db_pool.write() as db:
+        for i in range(0, len(grants), 10000):
+            await main.add_points_many(grants[i:i + 10000], db=db)
+        await db.executemany('''INSERT INTO orders (user_id, username, books_purchased, books_created, timestamp)
+                             VALUES (?, ?, ?, ?, '2024-01-01')''',
+                             [(user_id, f'user{user_id}', rng.randrange(3), rng.randrange(2))
+                              for user_id in range(1, users + 1)])
+        await db.execute('DELETE FROM user_stats')
+
+
+async def build_always(user_id: int):
+    async with main.db_pool.read() as db:
+        return await main.build_stats_snapshot(user_id, db)
+
+
+async def drain(db):
+    pass
+
+
+async def measure(variant: str, user_ids, concurrency: int) -> dict:
+    reset_throttling()
+    main.handler_db_queries._values.clear()
+    before = dict(main.stats_snapshots.counters)
+    with Timer() as timer:
+        latencies = await dispatch([message_update(user_id, user_id, '/stats') for user_id in user_ids], concurrency)
+    # Снимки сохраняются через очередь записи: ее запросы учтены в метрике обработчика после commit.
+    # События применяются по порядку, поэтому после последнего пустого события очередь пуста
+    await main.ledger_queue.submit(drain)
+    _, queries, count = main.handler_db_queries._values[('cmd_stats',)]
+    after = main.stats_snapshots.counters
+    return {
+        'variant': variant,
+        'stats_per_sec': len(user_ids) / timer.elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries_per_stats': queries / count,
+        **{key: after[key] - before[key] for key in ('memory_hits', 'table_hits', 'builds')}
+    }
+
+
+async def run(users: int, actions: int, updates: int, concurrency: int):
+    rng = random.Random(451)
+    main.render_pie_chart = lambda user_score, total_score, backend=None: b'png'
+    main.chart_executor = None
+    main.instrument_handlers(main.dp)
+    rows = []
+    async with temp_database(), fake_telegram():
+        await seed_users(users)
+        await seed_history(users, actions, rng)
+        await main.rank_index.load()
+        user_ids = rng.sample(range(1, users + 1), updates)
+
+        main.stats_snapshots.get = build_always
+        try:
+            rows.append(await measure('build from tables', user_ids, concurrency))
+        finally:
+            del main.stats_snapshots.get
+
+        main.stats_snapshots.memory.clear()
+        rows.append(await measure('snapshot: cold', user_ids, concurrency))
+        main.stats_snapshots.memory.clear()
+        rows.append(await measure('snapshot: user_stats', user_ids, concurrency))
+        rows.append(await measure('snapshot: memory', user_ids, concurrency))
+    report(f"/stats, {users} users with {actions} actions each, {concurrency} concurrent", rows)
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--actions', type=int, default=20)
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.actions, args.updates, args.concurrency))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,151 @@
+"""Общие части бенчмарков: временная база, заполнение пользователями и вывод результатов.
+Бенчмарки запускаются из корня репозитория: python benchmarks/bench_<name>.py [--help]"""
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+from aiogram.bot import api  # noqa: E402
+
+
+@asynccontextmanager
+async def temp_database(queue: bool = True):
+    """Пул соединений к новой базе во временном каталоге; при queue запущена очередь записи.
+    Состояние процесса, относящееся к прежней базе (индексы, кэши, антифлуд), сбрасывается"""
+    main.rank_index.__init__()
+    main.referral_graph.__init__()
+    main.stats_snapshots.memory.clear()
+    main.leaderboard_cache.__init__(main.leaderboard_cache.limit)
+    reset_throttling()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        await main.db_pool.open()
+        try:
+            await main.init_db()
+            await main.action_rollups.load_state()
+            if queue:
+                main.ledger_queue.start()
+            try:
+                yield main.db_pool
+            finally:
+                if queue:
+                    await main.ledger_queue.stop()
+        finally:
+            await main.db_pool.close()
+            os.chdir(cwd)
+
+
+def reset_throttling():
+    """Сброс антифлуда: повторные прогоны одних и тех же пользователей не должны упираться в лимит"""
+    for state in (main.throttling._buckets, main.throttling._warned, main.throttling._in_flight):
+        state.clear()
+
+
+async def seed_users(count: int, subscribed: float = 1.0, max_score: int = 1000, seed: int = 451):
+    """count пользователей со случайными счетами; доля subscribed подписана на канал"""
+    import random
+    rng = random.Random(seed)
+    rows = [(user_id, f'user{user_id}', f'User {user_id}', f'ref_{user_id}', rng.randrange(max_score),
+             rng.random() < subscribed) for user_id in range(1, count + 1)]
+    async with main.db_pool.write() as db:
+        await db.executemany('''INSERT INTO users (user_id, username, full_name, referral_code, score, is_subscribed)
+                             VALUES (?, ?, ?, ?, ?, ?)''', rows)
+
+
+class FakeTelegram:
+    """Заглушка Bot API вместо HTTP: ответ через latency секунд, вызовы считаются по методам"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+
+    async def make_request(self, session, server, token, method, data=None, files=None, **kwargs):
+        self.calls[method] += 1
+        await asyncio.sleep(self.latency)
+        if method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(data['user_id']), 'is_bot': False, 'first_name': 'User'}}
+        if method.startswith(('send', 'edit')):
+            return {'message_id': 1, 'date': 0, 'chat': {'id': int(data['chat_id']), 'type': 'private'}}
+        return True
+
+
+@asynccontextmanager
+async def fake_telegram(latency: float = 0.0):
+    """Запросы main.bot уходят в FakeTelegram; сессия закрывается, чтобы не переживать цикл событий"""
+    fake = FakeTelegram(latency)
+    original, api.make_request = api.make_request, fake.make_request
+    try:
+        yield fake
+    finally:
+        api.make_request = original
+        await (await main.bot.get_session()).close()
+
+
+def message_update(update_id: int, user_id: int, text: str) -> types.Update:
+    return types.Update(**{'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text[0] == '/' else []
+    }})
+
+
+async def dispatch(updates: List[types.Update], concurrency: int) -> List[float]:
+    """Обработка обновлений через main.dp не более чем concurrency одновременно; задержка каждого в секундах"""
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def process(update):
+        async with semaphore:
+            started = time.perf_counter()
+            await main.dp.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(process(update) for update in updates))
+    return latencies
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса в МБ (Linux: ru_maxrss в КБ)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)] if values else 0.0
+
+
+def report(title: str, rows: List[Dict]):
+    """Таблица результатов: строки - варианты, столбцы - ключи первой строки"""
+    print(f"\n{title}")
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [[f"{row[column]:.3f}" if isinstance(row[column], float) else str(row[column]) for column in columns]
+             for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print('  '.join(cell.ljust(width) for cell, width in zip(line, widths)))
+
+
+class Timer:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
@@ -0,0 +1,118 @@
+"""Запись в общую базу из нескольких процессов (WEB_WORKERS): каждый процесс ставит add_points/add_order
+в свою очередь записи, процессы конкурируют за BEGIN IMMEDIATE. Считаются события/сек и ошибки блокировки
+в зависимости от числа процессов, а также стоимость досинхронизации рейтинга в памяти (refresh_memory_indexes)"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+
+from bench_ledger import submitter
+from bench_utils import Timer, main, percentile, report, seed_users, temp_database
+
+
+async def worker_load(index: int, submitters: int, events: int, users: int, barrier) -> dict:
+    await main.db_pool.open()
+    queue = main.LedgerQueue(main.LEDGER_BATCH_SIZE, main.LEDGER_FLUSH_INTERVAL)
+    queue.start()
+    latencies, errors = [], []
+    rng = random.Random(index)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+        with Timer() as timer:
+            await asyncio.gather(*(submitter(queue, events // submitters, users, 0.2,
+                                             random.Random(rng.random()), latencies, errors)
+                                   for _ in range(submitters)))
+    finally:
+        await queue.stop()
+        await main.db_pool.close()
+    return {'seconds': timer.elapsed, 'events': len(latencies), 'failed': queue.failed,
+            'lock_errors': sum('locked' in str(e) for e in errors), 'latencies': latencies}
+
+
+def worker(index: int, path: str, submitters: int, events: int, users: int, barrier, results):
+    os.chdir(path)
+    results.put(asyncio.run(worker_load(index, submitters, events, users, barrier)))
+
+
+async def prepare(users: int):
+    await main.init_db()
+    await main.action_rollups.load_state()
+    await seed_users(users)
+
+
+def run(workers: int, submitters: int, events: int, users: int) -> dict:
+    context = multiprocessing.get_context('spawn')
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        try:
+            async def setup():
+                await main.db_pool.open()
+                try:
+                    await prepare(users)
+                finally:
+                    await main.db_pool.close()
+            asyncio.run(setup())
+        finally:
+            os.chdir(cwd)
+
+        # Общий объем событий делится между процессами
+        barrier = context.Barrier(workers)
+        results = context.Queue()
+        processes = [context.Process(target=worker, args=(index, path, submitters, events // workers, users,
+                                                          barrier, results))
+                     for index in range(workers)]
+        for process in processes:
+            process.start()
+        stats = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    latencies = [latency for item in stats for latency in item['latencies']]
+    total = sum(item['events'] for item in stats)
+    return {
+        'workers': workers,
+        'events': total,
+        'failed': sum(item['failed'] for item in stats),
+        'lock_errors': sum(item['lock_errors'] for item in stats),
+        'events_per_sec': total / max(item['seconds'] for item in stats),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000
+    }
+
+
+async def measure_refresh(users: int, changed: int) -> dict:
+    """Сверка рейтинга после того, как другой процесс изменил счет changed пользователей"""
+    async with temp_database(queue=False):
+        await seed_users(users, subscribed=0.8)
+        await main.rank_index.load()
+        await main.referral_graph.load()
+        async with main.db_pool.write() as db:
+            await db.execute('UPDATE users SET score = score + 5 WHERE user_id <= ?', (changed,))
+        main.rank_index.mark_stale()
+        with Timer() as timer:
+            await main.refresh_memory_indexes()
+    return {'users': users, 'changed': changed, 'refresh_ms': timer.elapsed * 1000}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--submitters', type=int, default=100, help='конкурентных отправителей в каждом процессе')
+    parser.add_argument('--events', type=int, default=20000, help='событий на все процессы')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--refresh-users', type=int, nargs='+', default=[10 ** 5, 10 ** 6])
+    args = parser.parse_args()
+
+    rows = [run(workers, args.submitters, args.events, args.users) for workers in args.workers]
+    report(f"Shared database, {args.submitters} submitters per worker, {args.users} users", rows)
+
+    rows = [asyncio.run(measure_refresh(users, 1000)) for users in args.refresh_users]
+    report(f"Rank index refresh after remote writes (every {main.MEMORY_INDEX_REFRESH_INTERVAL} s, "
+           f"holds the write lock)", rows)
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,11 +1,37 @@
 # ====================== ИМПОРТЫ И НАСТРОЙКИ ======================
+import asyncio
+import atexit
+import bisect
+import contextvars
+import cProfile
+import csv
+import functools
+import itertools
+import json
 import logging
-from datetime import datetime
+import math
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from io import BytesIO
-from typing import List, Tuple, Dict, Optional
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, List, Tuple, Dict, Optional, Set
 
 import aiosqlite
-import matplotlib.pyplot as plt
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
 from aiogram.utils import executor
 from aiogram.types import (
@@ -19,15 +45,14 @@ from aiogram.types import (
 )
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.dispatcher.filters import Command, Text
-from aiogram.contrib.middlewares.logging import LoggingMiddleware
-from openpyxl import Workbook
+from aiogram.dispatcher.handler import CancelHandler, SkipHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import ChatNotFound, MessageNotModified, RetryAfter, Unauthorized
+from openpyxl import Workbook, load_workbook
 
 # region ====================== КОНФИГУРАЦИЯ ======================
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = '7072278948:AAHULSz4lWo-FADGtYPvT8zvug3RpySHIFA'
@@ -36,6 +61,78 @@ CHANNEL_ID = -1002396542142  # ID канала для проверки подп
 CHANNEL_USERNAME = "lit451"  # Юзернейм канала без @
 CHANNEL_INVITE_LINK = f"https://t.me/{CHANNEL_USERNAME}"  # Ссылка для приглашения
 
+DB_PATH = 'ratings.db'  # Файл базы данных
+DB_READERS = 4  # Количество соединений на чтение в пуле
+ARCHIVE_DB_PATH = 'ratings_archive.db'  # Файл архива старых строк actions и orders
+ARCHIVE_AFTER_DAYS = 180  # Строки старше стольких дней переносятся в архив
+ARCHIVE_BATCH_SIZE = 5000  # Строк, переносимых за одну транзакцию
+COMPACTION_INTERVAL = 86400  # Период архивации и очистки базы в секундах
+VACUUM_PAGES = 5000  # Страниц, освобождаемых за один инкрементальный VACUUM
+CHART_WORKERS = 2  # Количество процессов для отрисовки диаграмм
+CHART_CACHE_SIZE = 512  # Количество готовых диаграмм в кэше
+CHART_BACKEND = 'matplotlib'  # Отрисовка диаграмм: 'matplotlib' или 'png' (без matplotlib)
+CHART_SIZE = 400  # Размер диаграммы в пикселях для бэкенда 'png'
+EXPORT_CHUNK_SIZE = 1000  # Количество строк, читаемых за раз при выгрузке отчета
+REPORT_CACHE_TTL = 60  # Сколько секунд отчет отдается без пересборки, даже если данные менялись
+REFRESH_CONCURRENCY = 10  # Одновременных запросов get_chat_member при массовой проверке подписок
+REFRESH_RATE = 20  # Запросов в секунду к Bot API при массовой проверке подписок
+REFRESH_BATCH_SIZE = 200  # Пользователей в одной пачке (одна транзакция и один чекпоинт)
+REFRESH_RETRIES = 3  # Попыток запроса при RetryAfter
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member']  # chat_member Telegram по умолчанию не присылает
+STATS_CACHE_SIZE = 10000  # Снимков статистики пользователей в памяти
+STATS_CACHE_TTL = 300  # Время жизни снимка статистики в памяти в секундах
+LEDGER_BATCH_SIZE = 500  # Событий леджера в одной транзакции
+LEDGER_FLUSH_INTERVAL = 0.02  # Сколько секунд добирать пачку событий перед commit
+THROTTLE_RATE = 1  # Запросов в секунду на пользователя и команду по умолчанию
+THROTTLE_BURST = 5  # Запросов подряд без ограничения по умолчанию
+THROTTLE_USERS = 10000  # Счетчиков (пользователь, команда) в памяти
+DIGEST_WEEKDAY = 0  # День недельной рассылки рейтинга (0 - понедельник)
+DIGEST_HOUR = 12  # Час, начиная с которого выполняется недельная рассылка
+DIGEST_CHECK_INTERVAL = 600  # Период проверки, не пора ли выполнить рассылку, в секундах
+DIGEST_BATCH_SIZE = 500  # Получателей в одной пачке (один чекпоинт)
+SEND_CONCURRENCY = 20  # Одновременных отправок при рассылке
+SEND_RATE = 25  # Сообщений в секунду при рассылке (общий лимит Bot API - около 30)
+SEND_PER_CHAT_INTERVAL = 1  # Минимальный интервал между сообщениями в один чат в секундах
+SEND_RETRIES = 3  # Попыток отправки одного сообщения
+ROLLUP_BACKFILL_BATCH = 50000  # Строк actions (по id) в одной транзакции заполнения агрегатов
+RANK_HISTORY_INTERVAL = 3600  # Период проверки ежедневного снимка мест в секундах
+HISTORY_DAYS = 30  # Дней на графиках прогресса и места
+REFERRAL_DEPTH = 3  # Уровней реферальной сети в статистике
+TOP_REFERRERS = 5  # Рефереров в панели администратора
+
+# Логирование: формат 'text' или 'json', запись в отдельном потоке через очередь (LOG_QUEUE=0 - синхронно)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_QUEUE = os.getenv('LOG_QUEUE', '1') == '1'
+LOG_UPDATES_SAMPLE = float(os.getenv('LOG_UPDATES_SAMPLE', '0.01'))  # Доля обновлений, попадающих в лог
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (порт + номер процесса; 0 - выключено)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+SLOW_QUERY_THRESHOLD = float(os.getenv('SLOW_QUERY_THRESHOLD', '0.1'))  # Запросы к базе дольше (сек) пишутся в лог
+PROFILE_SECONDS = 30  # Длительность профилирования по умолчанию в секундах
+PROFILE_MAX_SECONDS = 300  # Максимальная длительность профилирования в секундах
+PROFILE_SAMPLE_INTERVAL = 0.005  # Период выборки стеков в секундах
+
+# Режим запуска: 'polling' или 'webhook' (aiohttp-сервер, можно поставить за балансировщик)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')  # Адрес, на котором слушает сервер
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Публичный адрес для setWebhook (пусто - не регистрировать)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '100'))  # Одновременно обрабатываемых обновлений
+# Процессов webhook-сервера на одном порту (SO_REUSEPORT); в режиме polling всегда один процесс
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '1')) if BOT_MODE == 'webhook' else 1
+# Хранилище FSM: 'memory' или 'sqlite' (общее для всех процессов)
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite' if WEB_WORKERS > 1 else 'memory')
+DATA_VERSION_POLL_INTERVAL = 1  # Период проверки изменений базы другими процессами в секундах
+# Период досинхронизации рейтинга и графа рефералов в памяти с записями других процессов в секундах
+MEMORY_INDEX_REFRESH_INTERVAL = 5
+WORKER_INDEX = 0  # Номер процесса; фоновые задачи и setWebhook выполняет только процесс 0
+
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
+
 POINT_SYSTEM = {
     'subscription': 1,
     'referral': 2,
@@ -44,199 +141,1821 @@ POINT_SYSTEM = {
     'book_creation': 7
 }
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
-dp.middleware.setup(LoggingMiddleware())
+# endregion
 
 
-# endregion
+# ====================== ЛОГИРОВАНИЕ ======================
+LOG_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON; поля из extra попадают в запись как есть"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage()
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Передача записи в очередь: аргументы подставляются сразу, оформление (JSON, время) - в потоке QueueListener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Изменяемые аргументы (например, словарь статистики) к моменту записи в потоке могут измениться.
+        # Очередь внутри процесса: exc_info и поля extra передаются как есть, без сериализации
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level: str, fmt: str, use_queue: bool) -> Optional[QueueListener]:
+    """Настройка корневого логгера; при use_queue запись в stderr идет в отдельном потоке"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(LOG_TEXT_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    if not use_queue:
+        root.addHandler(handler)
+        return None
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener.start()
+    # Остановка дописывает оставшиеся в очереди записи
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_QUEUE)
+
+
+class UpdateLoggingMiddleware(BaseMiddleware):
+    """Выборочное логирование сообщений и callback: в лог попадает доля sample с временем обработки"""
+
+    def __init__(self, sample: float):
+        super().__init__()
+        self.sample = sample
+
+    def _start(self, data: Dict):
+        if random.random() < self.sample:
+            data['log_started'] = time.perf_counter()
+
+    def _finish(self, event_type: str, user: Optional[types.User], data: Dict):
+        started = data.get('log_started')
+        if started is None:
+            return
+        duration = (time.perf_counter() - started) * 1000
+        logger.info("%s from %s processed in %.1f ms", event_type, user.id if user else None, duration,
+                    extra={'event_type': event_type, 'user_id': user.id if user else None,
+                           'duration_ms': round(duration, 1)})
+
+    async def on_pre_process_message(self, message: Message, data: Dict):
+        self._start(data)
+
+    async def on_post_process_message(self, message: Message, results: List, data: Dict):
+        self._finish('message', message.from_user, data)
+
+    async def on_pre_process_callback_query(self, callback_query: CallbackQuery, data: Dict):
+        self._start(data)
+
+    async def on_post_process_callback_query(self, callback_query: CallbackQuery, results: List, data: Dict):
+        self._finish('callback_query', callback_query.from_user, data)
+
+
+# ====================== МЕТРИКИ ======================
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+INF_LABEL = 'le="+Inf"'
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Счетчик с метками"""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for values, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с метками: количество наблюдений по корзинам, сумма и общее количество"""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._values: Dict[Tuple, list] = {}  # метки -> [наблюдения по корзинам, сумма, количество]
+
+    def observe(self, value: float, *labels: str):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        idx = bisect.bisect_left(self.buckets, value)
+        if idx < len(self.buckets):
+            series[0][idx] += 1
+        series[1] += value
+        series[2] += 1
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, values, INF_LABEL)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик и функций, возвращающих текущие значения счетчиков компонентов"""
+
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Tuple[str, Callable[[], Dict[str, float]]]] = []
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self, prefix: str, collector: Callable[[], Dict[str, float]]):
+        """Регистрация функции со значениями вида {имя: число}; опрашивается при каждом экспорте"""
+        self._collectors.append((prefix, collector))
+
+    def render(self) -> str:
+        """Текстовый формат экспорта Prometheus"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        for prefix, collector in self._collectors:
+            try:
+                values = collector()
+            except Exception as e:
+                logger.error("Error collecting metrics %s: %s", prefix, e)
+                continue
+            for key, value in values.items():
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram('bot_handler_seconds', 'Handler latency', ('handler',))
+handler_errors = metrics.counter('bot_handler_errors_total', 'Handler exceptions', ('handler',))
+handler_db_queries = metrics.histogram('bot_handler_db_queries', 'Database queries per handled update',
+                                       ('handler',), METRICS_COUNT_BUCKETS)
+db_query_seconds = metrics.histogram('bot_db_query_seconds', 'Database query latency by calling helper',
+                                     ('helper', 'operation'))
+api_seconds = metrics.histogram('bot_telegram_api_seconds', 'Telegram Bot API call latency', ('method',))
+api_errors = metrics.counter('bot_telegram_api_errors_total', 'Telegram Bot API errors', ('method',))
+api_retry_after = metrics.counter('bot_telegram_retry_after_total', 'Telegram Bot API RetryAfter responses',
+                                  ('method',))
+
+class QueryCounter:
+    """Запросы к базе в рамках обработки одного обновления, включая события, поставленные в очередь записи"""
+    __slots__ = ('queries', 'pending')
+
+    def __init__(self):
+        self.queries = 0
+        self.pending: List[asyncio.Future] = []  # События очереди записи, еще не зафиксированные
+
+
+# Счетчик запросов к базе в рамках обработки одного обновления
+db_query_counter: contextvars.ContextVar = contextvars.ContextVar('db_query_counter', default=None)
+
+
+def observe_db_queries(counter: QueryCounter, handler_name: str):
+    """Учет числа запросов обработчика; при событиях в очереди записи - после их commit"""
+    if not counter.pending:
+        handler_db_queries.observe(counter.queries, handler_name)
+        return
+    pending = asyncio.gather(*counter.pending, return_exceptions=True)
+    pending.add_done_callback(lambda _: handler_db_queries.observe(counter.queries, handler_name))
+
+
+def instrumented(handler: Callable) -> Callable:
+    """Обертка обработчика: время работы, ошибки и число запросов к базе"""
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        counter = QueryCounter()
+        token = db_query_counter.set(counter)
+        started = time.perf_counter()
+        profiled = profiler.active
+        try:
+            return await handler(*args, **kwargs)
+        except (CancelHandler, SkipHandler):
+            raise
+        except Exception:
+            handler_errors.inc(handler.__name__)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler.__name__)
+            db_query_counter.reset(token)
+            observe_db_queries(counter, handler.__name__)
+            if profiled:
+                profiler.count_update()
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_handlers(dispatcher: Dispatcher):
+    """Обертка всех зарегистрированных обработчиков сообщений и callback (повторный вызов ничего не меняет)"""
+    for handlers in (dispatcher.message_handlers, dispatcher.callback_query_handlers):
+        for handler_obj in handlers.handlers:
+            if not getattr(handler_obj.handler, 'instrumented', False):
+                handler_obj.handler = instrumented(handler_obj.handler)
+
+
+class InstrumentedBot(Bot):
+    """Bot с учетом времени вызовов Bot API, ошибок и RetryAfter"""
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except RetryAfter:
+            api_retry_after.inc(method)
+            raise
+        except Exception:
+            api_errors.inc(method)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, method)
+
+
+class TracedConnection:
+    """Соединение aiosqlite с учетом времени и числа запросов; остальные методы передаются как есть"""
+
+    def __init__(self, connection: aiosqlite.Connection):
+        self._connection = connection
+
+    def __getattr__(self, name: str):
+        return getattr(self._connection, name)
+
+    async def _traced(self, method: Callable, sql: str, parameters):
+        # Функция, вызвавшая execute: кадр стека над execute/executemany, пока корутина выполняется синхронно
+        helper = sys._getframe(2).f_code.co_name
+        started = time.perf_counter()
+        try:
+            return await method(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_query_seconds.observe(elapsed, helper, sql.split(None, 1)[0].upper())
+            if elapsed > SLOW_QUERY_THRESHOLD:
+                logger.warning("Slow query (%.1f ms): %s", elapsed * 1000, ' '.join(sql.split())[:500],
+                               extra={'duration_ms': round(elapsed * 1000, 1)})
+            counter = db_query_counter.get()
+            if counter is not None:
+                counter.queries += 1
+
+    async def execute(self, sql: str, parameters=None) -> aiosqlite.Cursor:
+        return await self._traced(self._connection.execute, sql, parameters)
+
+    async def executemany(self, sql: str, parameters) -> aiosqlite.Cursor:
+        return await self._traced(self._connection.executemany, sql, parameters)
+
+
+metrics_runner: Optional[web.AppRunner] = None
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server(host: str, port: int):
+    """Локальный HTTP-сервер с /metrics (если порт занят, бот работает без метрик)"""
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    try:
+        await web.TCPSite(metrics_runner, host, port).start()
+    except OSError as e:
+        logger.error("Metrics server disabled, cannot bind %s:%s: %s", host, port, e)
+        await stop_metrics_server()
+        return
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+
+# ====================== ПРОФИЛИРОВАНИЕ ======================
+PROFILE_MODES = ('sample', 'cprofile')
+
+
+class Profiler:
+    """Профилирование по запросу на N секунд или N обработанных обновлений:
+    'sample' - выборка стеков потока цикла событий (collapsed stacks для flamegraph.pl/speedscope),
+    'cprofile' - cProfile (файл pstats)"""
+
+    def __init__(self, sample_interval: float):
+        self.sample_interval = sample_interval
+        self.active = False
+        self.mode = 'sample'
+        self._seconds = 0.0
+        self._updates = 0
+        self._updates_limit: Optional[int] = None
+        self._started = 0.0
+        self._done: Optional[asyncio.Event] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._stop_sampler: Optional[threading.Event] = None
+        self._stacks: Dict[str, int] = defaultdict(int)
+
+    def start(self, mode: str, seconds: float, updates: Optional[int] = None):
+        """Начало сбора в потоке цикла событий"""
+        self.active = True
+        self.mode = mode
+        self._seconds = seconds
+        self._updates = 0
+        self._updates_limit = updates
+        self._started = time.monotonic()
+        self._done = asyncio.Event()
+        self._stacks = defaultdict(int)
+        if mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._stop_sampler = threading.Event()
+            self._sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),), daemon=True)
+            self._sampler.start()
+
+    def _sample(self, thread_id: int):
+        """Выборка стека потока цикла событий (выполняется в отдельном потоке)"""
+        while not self._stop_sampler.wait(self.sample_interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self._stacks[';'.join(reversed(stack))] += 1
+
+    def count_update(self):
+        """Учет обработанного обновления; по достижении лимита сбор завершается"""
+        self._updates += 1
+        if self._updates_limit is not None and self._updates >= self._updates_limit:
+            self._done.set()
+
+    async def wait(self) -> Tuple[str, Dict[str, Any]]:
+        """Ожидание окончания сбора; возвращает путь к временному файлу профиля и сводку"""
+        try:
+            await asyncio.wait_for(self._done.wait(), self._seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.active = False
+            if self.mode == 'cprofile':
+                self._profile.disable()
+            else:
+                self._stop_sampler.set()
+                self._sampler.join()
+
+        summary = {
+            'mode': self.mode,
+            'seconds': round(time.monotonic() - self._started, 1),
+            'updates': self._updates
+        }
+        fd, path = tempfile.mkstemp(suffix='.pstats' if self.mode == 'cprofile' else '.collapsed')
+        os.close(fd)
+        if self.mode == 'cprofile':
+            self._profile.dump_stats(path)
+            self._profile = None
+        else:
+            summary['samples'] = sum(self._stacks.values())
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self._stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            self._stacks = defaultdict(int)
+        return path, summary
+
+
+profiler = Profiler(PROFILE_SAMPLE_INTERVAL)
 
 
 # ====================== БАЗА ДАННЫХ ======================
+SQL_VARIABLES_LIMIT = 500  # Параметров в одном запросе вида IN (...)
+
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+    'PRAGMA busy_timeout = 5000'
+)
+
+
+class Database:
+    """Долгоживущие соединения с базой: один писатель и пул читателей"""
+
+    def __init__(self, path: str, readers: int = 4, attachments: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.readers_count = readers
+        self.attachments = attachments or {}  # Имя схемы -> файл; читатели подключают их только на чтение
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._readers: Optional[asyncio.Queue] = None
+        self._connections: List[aiosqlite.Connection] = []
+        self._savepoints = itertools.count(1)
+        self._on_commit: List[Tuple[Callable, tuple]] = []
+        self.version = 0  # Версия данных рейтинга, растет при каждой зафиксированной записи в леджер
+        self._data_version: Optional[int] = None
+        self._remote_listeners: List[Callable] = []
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        """Открытие соединения с настроенными PRAGMA"""
+        db = TracedConnection(await aiosqlite.connect(self.path, uri=True))
+        for pragma in DB_PRAGMAS:
+            await db.execute(pragma)
+        for name, path in self.attachments.items():
+            # Файл создается писателем, который открывается первым
+            await db.execute(f"ATTACH DATABASE ? AS {name}", (f"file:{path}?mode=ro" if read_only else path,))
+        if read_only:
+            await db.execute('PRAGMA query_only = 1')
+        self._connections.append(db)
+        return db
+
+    async def open(self):
+        """Открытие писателя и пула читателей"""
+        self._write_lock = asyncio.Lock()
+        self._writer = await self._connect()
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._connect(read_only=True))
+
+    async def close(self):
+        """Закрытие всех соединений"""
+        for db in self._connections:
+            await db.close()
+        self._connections.clear()
+        self._writer = None
+        self._readers = None
+
+    @asynccontextmanager
+    async def exclusive(self):
+        """Соединение писателя вне транзакции (для VACUUM) под блокировкой записи"""
+        async with self._write_lock:
+            yield self._writer
+
+    @asynccontextmanager
+    async def read(self):
+        """Соединение на чтение из пула"""
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def write(self):
+        """Транзакция на соединении писателя: commit при выходе, rollback при ошибке"""
+        async with self._write_lock:
+            # Явный BEGIN: точки сохранения внутри не должны фиксировать транзакцию сами
+            await self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                self._on_commit.clear()
+                await self._writer.rollback()
+                raise
+            self._run_on_commit()
+
+    @asynccontextmanager
+    async def transaction(self, db: Optional[aiosqlite.Connection] = None):
+        """Единица работы: новая транзакция писателя или точка сохранения в транзакции вызывающего"""
+        if db is None:
+            async with self.write() as db:
+                yield db
+            return
+
+        savepoint = f"sp_{next(self._savepoints)}"
+        mark = len(self._on_commit)
+        await db.execute(f"SAVEPOINT {savepoint}")
+        try:
+            yield db
+        except BaseException:
+            del self._on_commit[mark:]
+            await db.execute(f"ROLLBACK TO {savepoint}")
+            await db.execute(f"RELEASE {savepoint}")
+            raise
+        await db.execute(f"RELEASE {savepoint}")
+
+    def on_commit(self, callback: Callable, *args: Any):
+        """Отложенный вызов после фиксации текущей транзакции писателя (отменяется при откате)"""
+        self._on_commit.append((callback, args))
+
+    def mark_changed(self):
+        """Отметка изменения данных рейтинга: версия увеличится после commit"""
+        self.on_commit(self._bump_version)
+
+    def _bump_version(self):
+        self.version += 1
+
+    def on_remote_change(self, callback: Callable):
+        """Подписка на изменения базы, зафиксированные другими процессами"""
+        self._remote_listeners.append(callback)
+
+    async def poll_remote_changes(self):
+        """Проверка изменений от других процессов: PRAGMA data_version писателя не меняется от его собственных commit"""
+        async with self._write_lock:
+            cursor = await self._writer.execute('PRAGMA data_version')
+            data_version = (await cursor.fetchone())[0]
+
+        changed = self._data_version is not None and data_version != self._data_version
+        self._data_version = data_version
+        if not changed:
+            return
+
+        self._bump_version()
+        for callback in self._remote_listeners:
+            try:
+                callback()
+            except Exception as e:
+                logger.error("Error in remote change callback: %s", e)
+
+    def _run_on_commit(self):
+        """Выполнение отложенных вызовов после commit"""
+        callbacks, self._on_commit = self._on_commit, []
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error("Error in on_commit callback: %s", e)
+
+
+db_pool = Database(DB_PATH, readers=DB_READERS, attachments={'archive': ARCHIVE_DB_PATH})
+
+
+# Миграции схемы: номер миграции - позиция в списке, примененная версия хранится в PRAGMA user_version.
+# Уже выпущенные миграции не меняются, новые добавляются в конец.
+MIGRATIONS: List[Tuple[str, ...]] = [
+    # 1. Базовые таблицы
+    (
+        '''CREATE TABLE IF NOT EXISTS users
+           (user_id INTEGER PRIMARY KEY, 
+            username TEXT, 
+            full_name TEXT, 
+            score INTEGER DEFAULT 0,
+            referral_code TEXT UNIQUE,
+            referrals INTEGER DEFAULT 0,
+            is_subscribed INTEGER DEFAULT 0,
+            subscribed_at DATETIME)''',
+        '''CREATE TABLE IF NOT EXISTS actions
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action_type TEXT,
+            points INTEGER,
+            timestamp DATETIME,
+            details TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS referrals
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referral_id INTEGER,
+            subscribed INTEGER DEFAULT 0,
+            timestamp DATETIME,
+            UNIQUE(referrer_id, referral_id))''',
+        '''CREATE TABLE IF NOT EXISTS orders
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            username TEXT,
+            books_purchased INTEGER DEFAULT 0,
+            books_created INTEGER DEFAULT 0,
+            timestamp DATETIME)''',
+        '''CREATE TABLE IF NOT EXISTS notification_settings
+           (user_id INTEGER PRIMARY KEY,
+            weekly_notifications INTEGER DEFAULT 1)''',
+    ),
+    # 2. Агрегаты, поддерживаемые триггерами при каждом изменении users, и чекпоинты фоновых задач
+    (
+        '''CREATE TABLE IF NOT EXISTS aggregates
+           (name TEXT PRIMARY KEY,
+            value INTEGER DEFAULT 0)''',
+        "INSERT OR IGNORE INTO aggregates (name, value) VALUES ('total_score', 0)",
+        '''CREATE TRIGGER IF NOT EXISTS users_total_score_insert
+           AFTER INSERT ON users WHEN NEW.is_subscribed = 1
+           BEGIN
+               UPDATE aggregates SET value = value + NEW.score WHERE name = 'total_score';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_total_score_update
+           AFTER UPDATE OF score, is_subscribed ON users
+           WHEN OLD.is_subscribed = 1 OR NEW.is_subscribed = 1
+           BEGIN
+               UPDATE aggregates
+               SET value = value - OLD.score * (OLD.is_subscribed = 1)
+                                 + NEW.score * (NEW.is_subscribed = 1)
+               WHERE name = 'total_score';
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_total_score_delete
+           AFTER DELETE ON users WHEN OLD.is_subscribed = 1
+           BEGIN
+               UPDATE aggregates SET value = value - OLD.score WHERE name = 'total_score';
+           END''',
+        '''CREATE TABLE IF NOT EXISTS checkpoints
+           (name TEXT PRIMARY KEY,
+            value INTEGER)''',
+    ),
+    # 3. Индексы для горячих запросов
+    (
+        'CREATE INDEX IF NOT EXISTS idx_users_subscribed_score ON users (is_subscribed, score)',
+        'CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)',
+        'CREATE INDEX IF NOT EXISTS idx_actions_user_type ON actions (user_id, action_type)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referral ON referrals (referral_id, subscribed)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id, subscribed)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id)',
+    ),
+    # 4. Денормализованные снимки статистики пользователей
+    (
+        '''CREATE TABLE IF NOT EXISTS user_stats
+           (user_id INTEGER PRIMARY KEY,
+            data TEXT)''',
+    ),
+    # 5. Состояния FSM, общие для всех процессов бота
+    (
+        '''CREATE TABLE IF NOT EXISTS fsm_storage
+           (chat_id INTEGER,
+            user_id INTEGER,
+            state TEXT,
+            data TEXT,
+            bucket TEXT,
+            PRIMARY KEY (chat_id, user_id))''',
+    ),
+    # 6. Место и счет из последней доставленной недельной рассылки (для изменения места)
+    (
+        '''CREATE TABLE IF NOT EXISTS weekly_digest
+           (user_id INTEGER PRIMARY KEY,
+            position INTEGER,
+            score INTEGER,
+            sent_at DATETIME)''',
+    ),
+    # 7. Агрегаты действий по дням и неделям (неделя начинается с понедельника) и ежедневные снимки мест.
+    # Строки actions, записанные до триггера, учитываются фоновым заполнением до rollup_backfill_until
+    (
+        '''CREATE TABLE IF NOT EXISTS action_rollups
+           (user_id INTEGER,
+            period TEXT,
+            period_start TEXT,
+            action_type TEXT,
+            points INTEGER DEFAULT 0,
+            actions INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, period, period_start, action_type)) WITHOUT ROWID''',
+        '''CREATE TRIGGER IF NOT EXISTS actions_rollup_insert
+           AFTER INSERT ON actions WHEN NEW.timestamp IS NOT NULL
+           BEGIN
+               INSERT INTO action_rollups (user_id, period, period_start, action_type, points, actions)
+               VALUES (NEW.user_id, 'day', date(NEW.timestamp), NEW.action_type, NEW.points, 1),
+                      (NEW.user_id, 'week', date(NEW.timestamp, 'weekday 0', '-6 days'), NEW.action_type,
+                       NEW.points, 1)
+               ON CONFLICT (user_id, period, period_start, action_type)
+               DO UPDATE SET points = points + excluded.points, actions = actions + 1;
+           END''',
+        '''INSERT OR REPLACE INTO checkpoints (name, value)
+           SELECT 'rollup_backfill_until', max_id FROM (SELECT MAX(id) AS max_id FROM actions) WHERE max_id IS NOT NULL''',
+        '''CREATE TABLE IF NOT EXISTS rank_history
+           (user_id INTEGER,
+            day TEXT,
+            position INTEGER,
+            score INTEGER,
+            PRIMARY KEY (user_id, day)) WITHOUT ROWID''',
+    ),
+    # 8. Суммы по строкам actions и orders, перенесенным в архив
+    (
+        '''CREATE TABLE IF NOT EXISTS action_summaries
+           (user_id INTEGER,
+            action_type TEXT,
+            points INTEGER DEFAULT 0,
+            actions INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, action_type)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS order_summaries
+           (user_id INTEGER PRIMARY KEY,
+            books_purchased INTEGER DEFAULT 0,
+            books_created INTEGER DEFAULT 0,
+            orders INTEGER DEFAULT 0)''',
+    ),
+    # 9. Удаление старых снимков мест по дню
+    (
+        'CREATE INDEX IF NOT EXISTS idx_rank_history_day ON rank_history (day)',
+    ),
+    # 10. Журнал изменений счета и подписки: по нему процессы досинхронизируют рейтинг в памяти
+    (
+        '''CREATE TABLE IF NOT EXISTS user_changes
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER)''',
+        '''CREATE TRIGGER IF NOT EXISTS users_insert_log AFTER INSERT ON users
+           BEGIN INSERT INTO user_changes (user_id) VALUES (NEW.user_id); END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_update_log AFTER UPDATE OF score, is_subscribed ON users
+           WHEN OLD.score IS NOT NEW.score OR OLD.is_subscribed IS NOT NEW.is_subscribed
+           BEGIN INSERT INTO user_changes (user_id) VALUES (NEW.user_id); END''',
+    ),
+]
+
+
 async def init_db():
-    """Инициализация базы данных"""
-    async with aiosqlite.connect('ratings.db') as db:
-        # Удаляем старые таблицы, если они есть
-        await db.execute('DROP TABLE IF EXISTS users')
-        await db.execute('DROP TABLE IF EXISTS actions')
-        await db.execute('DROP TABLE IF EXISTS referrals')
-        await db.execute('DROP TABLE IF EXISTS orders')
-        await db.execute('DROP TABLE IF EXISTS subscriptions')
-        await db.execute('DROP TABLE IF EXISTS notification_settings')
-
-        # Создаем новые таблицы с правильной структурой
-        await db.execute('''CREATE TABLE IF NOT EXISTS users
-                         (user_id INTEGER PRIMARY KEY, 
-                          username TEXT, 
-                          full_name TEXT, 
-                          score INTEGER DEFAULT 0,
-                          referral_code TEXT UNIQUE,
-                          referrals INTEGER DEFAULT 0,
-                          is_subscribed INTEGER DEFAULT 0,
-                          subscribed_at DATETIME)''')
-
-        await db.execute('''CREATE TABLE IF NOT EXISTS actions
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          user_id INTEGER,
-                          action_type TEXT,
-                          points INTEGER,
-                          timestamp DATETIME,
-                          details TEXT)''')
-
-        await db.execute('''CREATE TABLE IF NOT EXISTS referrals
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          referrer_id INTEGER,
-                          referral_id INTEGER,
-                          subscribed INTEGER DEFAULT 0,
-                          timestamp DATETIME,
-                          UNIQUE(referrer_id, referral_id))''')
-
-        await db.execute('''CREATE TABLE IF NOT EXISTS orders
-                         (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                          user_id INTEGER,
-                          username TEXT,
-                          books_purchased INTEGER DEFAULT 0,
-                          books_created INTEGER DEFAULT 0,
-                          timestamp DATETIME)''')
-
-        await db.execute('''CREATE TABLE IF NOT EXISTS notification_settings
-                         (user_id INTEGER PRIMARY KEY,
-                          weekly_notifications INTEGER DEFAULT 1)''')
-
-        await db.commit()
+    """Инициализация базы данных: применение недостающих миграций с сохранением данных"""
+    async with db_pool.write() as db:
+        cursor = await db.execute('PRAGMA user_version')
+        version = (await cursor.fetchone())[0]
+
+        for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute(f"PRAGMA user_version = {number}")
+            logger.info("Applied database migration %s", number)
+
+
+async def get_checkpoint(name: str) -> Optional[int]:
+    """Чтение чекпоинта фоновой задачи"""
+    async with db_pool.read() as db:
+        cursor = await db.execute('SELECT value FROM checkpoints WHERE name = ?', (name,))
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+
+async def set_checkpoint(name: str, value: Optional[int], db: aiosqlite.Connection = None):
+    """Запись чекпоинта фоновой задачи (None - удаление)"""
+    async with db_pool.transaction(db) as db:
+        if value is None:
+            await db.execute('DELETE FROM checkpoints WHERE name = ?', (name,))
+        else:
+            await db.execute('INSERT OR REPLACE INTO checkpoints (name, value) VALUES (?, ?)', (name, value))
+
+
+# ====================== ХРАНИЛИЩЕ FSM ======================
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_storage: состояния и данные видны всем процессам бота"""
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    @staticmethod
+    def _address(chat, user) -> Tuple[int, int]:
+        chat, user = BaseStorage.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _load(self, column: str, chat, user, db: aiosqlite.Connection = None) -> Optional[str]:
+        query = f"SELECT {column} FROM fsm_storage WHERE chat_id = ? AND user_id = ?"
+        if db is None:
+            async with db_pool.read() as db:
+                cursor = await db.execute(query, self._address(chat, user))
+                row = await cursor.fetchone()
+        else:
+            cursor = await db.execute(query, self._address(chat, user))
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def _store(self, column: str, value: Optional[str], chat, user, db: aiosqlite.Connection = None):
+        """Запись одного поля; пустая запись удаляется"""
+        address = self._address(chat, user)
+        async with db_pool.transaction(db) as db:
+            await db.execute(f'''INSERT INTO fsm_storage (chat_id, user_id, {column}) VALUES (?, ?, ?)
+                                 ON CONFLICT (chat_id, user_id) DO UPDATE SET {column} = excluded.{column}''',
+                             (*address, value))
+            await db.execute('''DELETE FROM fsm_storage
+                                WHERE chat_id = ? AND user_id = ?
+                                AND state IS NULL AND data IS NULL AND bucket IS NULL''', address)
+
+    async def get_state(self, *, chat=None, user=None, default: Optional[str] = None) -> Optional[str]:
+        state = await self._load('state', chat, user)
+        return state if state is not None else self.resolve_state(default)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self._store('state', self.resolve_state(state), chat, user)
+
+    async def get_data(self, *, chat=None, user=None, default: Optional[Dict] = None) -> Dict:
+        data = await self._load('data', chat, user)
+        return json.loads(data) if data else (default or {})
+
+    async def set_data(self, *, chat=None, user=None, data: Dict = None):
+        await self._store('data', json.dumps(data) if data else None, chat, user)
+
+    async def update_data(self, *, chat=None, user=None, data: Dict = None, **kwargs):
+        # Чтение и запись в одной транзакции писателя: параллельные обновления из других процессов не теряются
+        async with db_pool.write() as db:
+            current = json.loads(await self._load('data', chat, user, db) or '{}')
+            current.update(data or {}, **kwargs)
+            await self._store('data', json.dumps(current) if current else None, chat, user, db)
+
+    async def has_bucket(self) -> bool:
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default: Optional[Dict] = None) -> Dict:
+        bucket = await self._load('bucket', chat, user)
+        return json.loads(bucket) if bucket else (default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket: Dict = None):
+        await self._store('bucket', json.dumps(bucket) if bucket else None, chat, user)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket: Dict = None, **kwargs):
+        async with db_pool.write() as db:
+            current = json.loads(await self._load('bucket', chat, user, db) or '{}')
+            current.update(bucket or {}, **kwargs)
+            await self._store('bucket', json.dumps(current) if current else None, chat, user, db)
+
+
+bot = InstrumentedBot(token=BOT_TOKEN)
+storage = SQLiteStorage() if FSM_STORAGE == 'sqlite' else MemoryStorage()
+dp = Dispatcher(bot, storage=storage)
+dp.middleware.setup(UpdateLoggingMiddleware(LOG_UPDATES_SAMPLE))
+
+
+# ====================== РЕЙТИНГ ======================
+RANK_BUCKET_SIZE = 1000  # Ключей в блоке отсортированного списка рейтинга
+
+
+class SortedKeys:
+    """Отсортированный список блоками по load..2*load ключей: вставка и удаление сдвигают один блок,
+    номер ключа считается деревом Фенвика по длинам блоков - O(load + log n) вместо O(n) у list"""
+
+    def __init__(self, keys: List = (), load: int = RANK_BUCKET_SIZE):
+        self.load = load
+        keys = list(keys)  # Ожидаются уже отсортированные ключи
+        self._buckets = [keys[i:i + load] for i in range(0, len(keys), load)]
+        self._maxes = [bucket[-1] for bucket in self._buckets]
+        self._len = len(keys)
+        self._rebuild_index()
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _rebuild_index(self):
+        """Дерево Фенвика по длинам блоков (после разбиения или удаления блока)"""
+        size = len(self._buckets)
+        tree = [0] * (size + 1)
+        for pos, bucket in enumerate(self._buckets, 1):
+            tree[pos] += len(bucket)
+            parent = pos + (pos & -pos)
+            if parent <= size:
+                tree[parent] += tree[pos]
+        self._tree = tree
+
+    def _update(self, pos: int, delta: int):
+        pos += 1
+        while pos < len(self._tree):
+            self._tree[pos] += delta
+            pos += pos & -pos
+
+    def _offset(self, pos: int) -> int:
+        """Число ключей в блоках до pos"""
+        total = 0
+        while pos > 0:
+            total += self._tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _locate(self, index: int) -> Tuple[int, int]:
+        """(блок, позиция в блоке) для ключа с номером index"""
+        size = len(self._tree) - 1
+        pos = 0
+        step = 1 << size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= size and self._tree[nxt] <= index:
+                pos = nxt
+                index -= self._tree[nxt]
+            step >>= 1
+        return pos, index
+
+    def add(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._len = 1
+            self._rebuild_index()
+            return
+
+        pos = bisect.bisect_left(self._maxes, key)
+        if pos == len(self._buckets):
+            pos -= 1
+            self._buckets[pos].append(key)
+            self._maxes[pos] = key
+        else:
+            bisect.insort(self._buckets[pos], key)
+        self._len += 1
+
+        bucket = self._buckets[pos]
+        if len(bucket) > 2 * self.load:
+            half = len(bucket) // 2
+            self._buckets[pos:pos + 1] = [bucket[:half], bucket[half:]]
+            self._maxes[pos:pos + 1] = [bucket[half - 1], bucket[-1]]
+            self._rebuild_index()
+        else:
+            self._update(pos, 1)
+
+    def discard(self, key):
+        pos = bisect.bisect_left(self._maxes, key)
+        if pos == len(self._buckets):
+            return
+        bucket = self._buckets[pos]
+        idx = bisect.bisect_left(bucket, key)
+        if bucket[idx] != key:
+            return
+        del bucket[idx]
+        self._len -= 1
+
+        if not bucket:
+            del self._buckets[pos]
+            del self._maxes[pos]
+            self._rebuild_index()
+        else:
+            self._maxes[pos] = bucket[-1]
+            self._update(pos, -1)
+
+    def bisect_left(self, key) -> int:
+        pos = bisect.bisect_left(self._maxes, key)
+        if pos == len(self._buckets):
+            return self._len
+        return self._offset(pos) + bisect.bisect_left(self._buckets[pos], key)
+
+    def islice(self, start: int, stop: int) -> List:
+        """Ключи с номерами [start, stop)"""
+        start, stop = max(start, 0), min(stop, self._len)
+        if start >= stop:
+            return []
+        pos, idx = self._locate(start)
+        result = []
+        while len(result) < stop - start:
+            result.extend(self._buckets[pos][idx:idx + stop - start - len(result)])
+            pos, idx = pos + 1, 0
+        return result
+
+
+class RankIndex:
+    """Рейтинг подписанных пользователей в памяти: отсортированные ключи (-score, user_id)"""
+
+    def __init__(self):
+        self._scores: Dict[int, int] = {}
+        self._subscribed: Set[int] = set()
+        self._keys = SortedKeys()
+        self.ready = False
+        self.stale = False  # Другие процессы записали изменения, которых нет в индексе
+        self._last_change = 0  # Последняя учтенная запись журнала user_changes
+
+    async def load(self):
+        """Построение индекса по таблице users"""
+        async with db_pool.read() as db:
+            # Журнал читается первым: изменения между двумя запросами будут применены повторно, а не потеряны
+            cursor = await db.execute('SELECT MAX(id) FROM user_changes')
+            self._last_change = (await cursor.fetchone())[0] or 0
+            cursor = await db.execute('SELECT user_id, score, is_subscribed FROM users')
+            rows = await cursor.fetchall()
+
+        self._scores = {user_id: score for user_id, score, _ in rows}
+        self._subscribed = {user_id for user_id, _, is_subscribed in rows if is_subscribed}
+        self._keys = SortedKeys(sorted((-self._scores[user_id], user_id) for user_id in self._subscribed))
+        self.ready = True
+
+    def mark_stale(self):
+        self.stale = True
+
+    async def refresh(self, db: aiosqlite.Connection):
+        """Применение изменений из журнала user_changes после последнего прочитанного (в том числе своих)"""
+        self.stale = False
+        cursor = await db.execute('SELECT MIN(id) FROM user_changes')
+        first = (await cursor.fetchone())[0]
+        if first is not None and first > self._last_change + 1:
+            # Журнал очищен дальше прочитанного места: изменения восстановить нельзя
+            await self.load()
+            return
+
+        cursor = await db.execute('''SELECT c.id, u.user_id, u.score, u.is_subscribed FROM user_changes c
+                                  JOIN users u ON u.user_id = c.user_id WHERE c.id > ? ORDER BY c.id''',
+                                  (self._last_change,))
+        for change_id, user_id, score, is_subscribed in await cursor.fetchall():
+            self._last_change = change_id
+            if user_id not in self._scores:
+                self.add_user(user_id, score, bool(is_subscribed))
+                continue
+            if self._scores[user_id] != score:
+                self.add_points(user_id, score - self._scores[user_id])
+            self.set_subscribed(user_id, bool(is_subscribed))
+
+    def _insert(self, user_id: int):
+        self._keys.add((-self._scores[user_id], user_id))
+
+    def _remove(self, user_id: int):
+        self._keys.discard((-self._scores[user_id], user_id))
+
+    def add_user(self, user_id: int, score: int = 0, subscribed: bool = False):
+        """Добавление пользователя (повторная регистрация игнорируется)"""
+        if not self.ready or user_id in self._scores:
+            return
+        self._scores[user_id] = score
+        if subscribed:
+            self._subscribed.add(user_id)
+            self._insert(user_id)
+
+    def add_points(self, user_id: int, points: int):
+        """Изменение счета пользователя"""
+        if user_id not in self._scores:
+            return
+        subscribed = user_id in self._subscribed
+        if subscribed:
+            self._remove(user_id)
+        self._scores[user_id] += points
+        if subscribed:
+            self._insert(user_id)
+
+    def set_subscribed(self, user_id: int, subscribed: bool):
+        """Изменение статуса подписки"""
+        if user_id not in self._scores or (user_id in self._subscribed) == subscribed:
+            return
+        if subscribed:
+            self._subscribed.add(user_id)
+            self._insert(user_id)
+        else:
+            self._subscribed.discard(user_id)
+            self._remove(user_id)
+
+    def score(self, user_id: int) -> int:
+        return self._scores.get(user_id, 0)
+
+    def is_subscribed(self, user_id: int) -> bool:
+        return user_id in self._subscribed
+
+    def position_for_score(self, score: int) -> int:
+        """Место для счета: число подписанных с большим счетом + 1"""
+        return self._keys.bisect_left((-score,)) + 1
+
+    def position(self, user_id: int) -> int:
+        """Место пользователя (как в SQL-версии: для неизвестного пользователя - 1)"""
+        if user_id not in self._scores:
+            return 1
+        return self.position_for_score(self._scores[user_id])
+
+    def top(self, limit: int) -> List[int]:
+        """ID первых limit подписанных пользователей"""
+        return [user_id for _, user_id in self._keys.islice(0, limit)]
+
+    def around(self, user_id: int, radius: int) -> List[Tuple[int, int, int]]:
+        """Соседи подписанного пользователя: (место, user_id, score)"""
+        if user_id not in self._subscribed:
+            return []
+        idx = self._keys.bisect_left((-self._scores[user_id], user_id))
+        return [(self.position_for_score(-neg_score), neighbour_id, -neg_score)
+                for neg_score, neighbour_id in self._keys.islice(idx - radius, idx + radius + 1)]
+
+
+rank_index = RankIndex()
+
+
+class ReferralGraph:
+    """Граф рефералов в памяти: списки смежности в обе стороны по таблице referrals
+    и число подписавшихся приглашенных у каждого реферера (как "Приглашено" в статистике)"""
+
+    def __init__(self):
+        self._referrals: Dict[int, Set[int]] = defaultdict(set)  # Реферер -> приглашенные
+        self._referrers: Dict[int, Set[int]] = defaultdict(set)  # Приглашенный -> рефереры
+        self._pending: Dict[int, List[int]] = defaultdict(list)  # Приглашенный -> рефереры связей с subscribed = 0
+        self._counts: Dict[int, int] = {}  # Реферер -> связей с subscribed = 1
+        self._top = SortedKeys()  # Ключи (-число, реферер) для топа
+        self._last_id = 0  # Наибольший id прочитанной связи: связи только добавляются
+        self._last_change = 0  # Последняя учтенная запись журнала user_changes
+        self.ready = False
+        self.stale = False
+
+    async def load(self):
+        """Построение графа по таблице referrals"""
+        self.ready = False
+        referrals, referrers, pending, counts = defaultdict(set), defaultdict(set), defaultdict(list), defaultdict(int)
+        last_id = 0
+        async with db_pool.read() as db:
+            cursor = await db.execute('SELECT MAX(id) FROM user_changes')
+            self._last_change = (await cursor.fetchone())[0] or 0
+            # Связи уникальны, поэтому при загрузке проверки _set_edge не нужны
+            cursor = await db.execute('SELECT id, referrer_id, referral_id, subscribed FROM referrals')
+            async for edge_id, referrer_id, referral_id, subscribed in cursor:
+                referrals[referrer_id].add(referral_id)
+                referrers[referral_id].add(referrer_id)
+                if subscribed:
+                    counts[referrer_id] += 1
+                else:
+                    pending[referral_id].append(referrer_id)
+                last_id = max(last_id, edge_id)
+
+        self._referrals, self._referrers, self._pending, self._counts = referrals, referrers, pending, dict(counts)
+        self._last_id = last_id
+        self._top = SortedKeys(sorted((-count, referrer_id) for referrer_id, count in self._counts.items()))
+        self.ready = True
+
+    async def _read_edges(self, db: aiosqlite.Connection):
+        cursor = await db.execute('''SELECT id, referrer_id, referral_id, subscribed FROM referrals
+                                  WHERE id > ? ORDER BY id''', (self._last_id,))
+        async for edge_id, referrer_id, referral_id, subscribed in cursor:
+            self._set_edge(referrer_id, referral_id, bool(subscribed))
+            self._last_id = edge_id
+
+    def _set_edge(self, referrer_id: int, referral_id: int, subscribed: bool):
+        """Учет связи и ее статуса; повторный вызов с тем же статусом ничего не меняет"""
+        if referral_id not in self._referrals.get(referrer_id, ()):
+            self._referrals[referrer_id].add(referral_id)
+            self._referrers[referral_id].add(referrer_id)
+            if not subscribed:
+                self._pending[referral_id].append(referrer_id)
+                return
+        elif not subscribed or referrer_id not in self._pending.get(referral_id, ()):
+            return
+        else:
+            pending = self._pending[referral_id]
+            pending.remove(referrer_id)
+            if not pending:
+                del self._pending[referral_id]
+        self._add_count(referrer_id)
+
+    def _add_count(self, referrer_id: int):
+        count = self._counts.get(referrer_id, 0)
+        self._top.discard((-count, referrer_id))
+        self._top.add((-count - 1, referrer_id))
+        self._counts[referrer_id] = count + 1
+
+    def mark_stale(self):
+        self.stale = True
+
+    async def refresh(self, db: aiosqlite.Connection):
+        """Учет связей, добавленных другими процессами, и подписок их приглашенных (по журналу user_changes)"""
+        self.stale = False
+        cursor = await db.execute('SELECT MIN(id) FROM user_changes')
+        first = (await cursor.fetchone())[0]
+        if first is not None and first > self._last_change + 1:
+            # Журнал очищен дальше прочитанного места
+            await self.load()
+            return
+
+        await self._read_edges(db)
+        cursor = await db.execute('SELECT id, user_id FROM user_changes WHERE id > ? ORDER BY id',
+                                  (self._last_change,))
+        subscribed = set()
+        for change_id, user_id in await cursor.fetchall():
+            self._last_change = change_id
+            if user_id in self._pending:
+                subscribed.add(user_id)
+
+        subscribed = list(subscribed)
+        for i in range(0, len(subscribed), SQL_VARIABLES_LIMIT):
+            chunk = subscribed[i:i + SQL_VARIABLES_LIMIT]
+            cursor = await db.execute(f'''SELECT referrer_id, referral_id FROM referrals
+                                      WHERE referral_id IN ({', '.join('?' * len(chunk))}) AND subscribed = 1''',
+                                      chunk)
+            for referrer_id, referral_id in await cursor.fetchall():
+                self._set_edge(referrer_id, referral_id, True)
+
+    def add_edge(self, referrer_id: int, referral_id: int):
+        """Добавление связи после фиксации транзакции"""
+        if not self.ready:
+            return
+        self._set_edge(referrer_id, referral_id, False)
+
+    def mark_subscribed(self, referral_id: int):
+        """Приглашенный подписался: его связи с subscribed = 0 засчитываются реферерам"""
+        if not self.ready:
+            return
+        for referrer_id in self._pending.pop(referral_id, ()):
+            self._add_count(referrer_id)
+
+    def has_edge(self, referrer_id: int, referral_id: int) -> bool:
+        referrals = self._referrals.get(referrer_id)
+        return referrals is not None and referral_id in referrals
+
+    def creates_cycle(self, referrer_id: int, referral_id: int) -> bool:
+        """Замкнет ли связь цикл: реферер уже находится в сети приглашенного (или это он сам)"""
+        if referrer_id == referral_id:
+            return True
+        if not self.ready:
+            return False
+        # Обход сети приглашенного: у нового пользователя она пуста, поэтому проверка обычно O(1)
+        seen = {referral_id}
+        frontier = [referral_id]
+        while frontier:
+            next_frontier = []
+            for user_id in frontier:
+                for child_id in self._referrals.get(user_id, ()):
+                    if child_id == referrer_id:
+                        return True
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        next_frontier.append(child_id)
+            frontier = next_frontier
+        return False
+
+    def downline_levels(self, user_id: int, depth: int) -> List[int]:
+        """Число приглашенных на каждом из depth уровней (каждый пользователь учитывается один раз)"""
+        seen = {user_id}
+        frontier = [user_id]
+        levels = []
+        for _ in range(depth):
+            next_frontier = []
+            for parent_id in frontier:
+                for child_id in self._referrals.get(parent_id, ()):
+                    if child_id not in seen:
+                        seen.add(child_id)
+                        next_frontier.append(child_id)
+            if not next_frontier:
+                break
+            levels.append(len(next_frontier))
+            frontier = next_frontier
+        return levels
+
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """Рефереры с наибольшим числом подписавшихся приглашенных: (user_id, count)"""
+        return [(user_id, -neg_count) for neg_count, user_id in self._top.islice(0, limit)]
+
+
+referral_graph = ReferralGraph()
+
+
+async def refresh_memory_indexes():
+    """Учет в рейтинге и графе рефералов записей других процессов (при WEB_WORKERS > 1).
+    Чтение идет на соединении писателя под блокировкой записи: локальный commit не попадет между чтением и сверкой"""
+    if not (rank_index.stale or referral_graph.stale):
+        return
+    async with db_pool.exclusive() as db:
+        if rank_index.stale:
+            await rank_index.refresh(db)
+        if referral_graph.stale:
+            await referral_graph.refresh(db)
+
+
+db_pool.on_remote_change(rank_index.mark_stale)
+db_pool.on_remote_change(referral_graph.mark_stale)
+
+
+# ====================== КЭШИРОВАНИЕ ======================
+class LRUCache:
+    """LRU-кэш с ограничением размера и необязательным временем жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or (self.ttl is not None and item[1] < time.monotonic()):
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# ====================== ЛИМИТЫ ЗАПРОСОВ ======================
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """Взять токены без ожидания"""
+        if time.monotonic() < self._paused_until:
+            return False
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1):
+        """Дождаться и взять токены"""
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.try_acquire(tokens):
+                return
+            await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Приостановка выдачи токенов (например, по RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# ====================== ЗАЩИТА ОТ ФЛУДА ======================
+def rate_limit(rate: Optional[float], burst: Optional[int] = None, key: Optional[str] = None,
+               coalesce: bool = False):
+    """Декоратор обработчика: свой лимит (None - без лимита), общий ключ для нескольких обработчиков
+    и объединение повторного запроса с уже выполняющимся (только для обработчиков без побочных эффектов)"""
+    def decorator(func: Callable) -> Callable:
+        func.throttle_rate = rate
+        func.throttle_burst = burst
+        func.throttle_key = key
+        func.throttle_coalesce = coalesce
+        return func
+    return decorator
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничение частоты запросов: ведро токенов на пару (пользователь, команда).
+    Счетчики локальны для процесса: при нескольких процессах лимит действует в каждом отдельно"""
+
+    def __init__(self, rate: float, burst: int, maxsize: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(maxsize)
+        self._warned = LRUCache(maxsize)
+        self._in_flight: Set[Tuple[int, str]] = set()
+        self.passed = 0
+        self.throttled = 0
+        self.coalesced = 0
+
+    def _check(self, user_id: int, data: Dict) -> Optional[str]:
+        """Проверка запроса; возвращает причину отказа или None"""
+        handler = current_handler.get()
+        if handler is None:
+            return None
+        rate = getattr(handler, 'throttle_rate', self.rate)
+        if rate is None:
+            return None
+        key = (user_id, getattr(handler, 'throttle_key', None) or handler.__name__)
+
+        if getattr(handler, 'throttle_coalesce', False):
+            if key in self._in_flight:
+                self.coalesced += 1
+                return 'coalesced'
+            self._in_flight.add(key)
+            data['throttle_key'] = key
+
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, getattr(handler, 'throttle_burst', None) or self.burst)
+            self._buckets.set(key, bucket)
+        if not bucket.try_acquire():
+            self._release(data)
+            self.throttled += 1
+            # Предупреждаем один раз до следующего пропущенного запроса, чтобы не отвечать на каждый
+            if self._warned.get(key):
+                return 'silent'
+            self._warned.set(key, True)
+            return 'throttled'
+
+        self._warned.pop(key)
+        self.passed += 1
+        return None
+
+    def _release(self, data: Dict):
+        key = data.pop('throttle_key', None)
+        if key is not None:
+            self._in_flight.discard(key)
+
+    async def on_process_message(self, message: Message, data: Dict):
+        reason = self._check(message.from_user.id, data)
+        if reason == 'throttled':
+            await message.answer("⏳ Слишком много запросов, попробуйте чуть позже")
+        if reason is not None:
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, callback_query: CallbackQuery, data: Dict):
+        reason = self._check(callback_query.from_user.id, data)
+        if reason == 'coalesced':
+            await callback_query.answer("⏳ Запрос уже выполняется")
+        elif reason is not None:
+            await callback_query.answer("⏳ Слишком много запросов, попробуйте чуть позже")
+        if reason is not None:
+            raise CancelHandler()
+
+    async def on_post_process_message(self, message: Message, results: List, data: Dict):
+        self._release(data)
+
+    async def on_post_process_callback_query(self, callback_query: CallbackQuery, results: List, data: Dict):
+        self._release(data)
+
+    @property
+    def counters(self) -> Dict[str, int]:
+        return {
+            'passed': self.passed,
+            'throttled': self.throttled,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._in_flight)
+        }
+
+
+throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST, THROTTLE_USERS)
+dp.middleware.setup(throttling)
+metrics.collect('bot_throttling', lambda: throttling.counters)
+
+
+# ====================== ДИАГРАММЫ ======================
+PIE_COLORS = ['#ff9999', '#66b3ff']
+
+
+def _pie_sizes(user_score: int, total_score: int) -> Tuple[int, int, int]:
+    """Доли диаграммы: (баллы пользователя, баллы остальных, всего)"""
+    other_score = total_score - user_score if total_score > user_score else 0
+
+    # Если нет данных
+    if total_score == 0:
+        return 1, 1, 2
+    return user_score, other_score, total_score
+
+
+def render_pie_chart_matplotlib(user_score: int, total_score: int) -> bytes:
+    """Отрисовка круговой диаграммы через matplotlib"""
+    # matplotlib импортируется только при первой отрисовке
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    user_score, other_score, total_score = _pie_sizes(user_score, total_score)
+    labels = ['Ваши баллы', 'Другие участники']
+    sizes = [user_score, other_score]
+
+    # Объектный API без pyplot: у каждой фигуры свое состояние
+    fig = Figure()
+    ax = fig.subplots()
+    ax.pie(sizes, labels=labels, colors=PIE_COLORS, autopct='%1.1f%%', startangle=90)
+    ax.axis('equal')  # Круговая диаграмма
+    ax.set_title(f"Ваши баллы: {user_score} из {total_score} ({user_score / total_score * 100:.1f}%)")
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
+
+
+def encode_png(width: int, height: int, palette: List[str], pixels: bytes) -> bytes:
+    """Кодирование палитрового PNG: pixels - индексы цветов построчно"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    raw = bytearray()
+    for y in range(height):
+        raw.append(0)  # Фильтр строки: None
+        raw += pixels[y * width:(y + 1) * width]
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+            + chunk(b'PLTE', b''.join(bytes.fromhex(color.lstrip('#')) for color in palette))
+            + chunk(b'IDAT', zlib.compress(bytes(raw), 6))
+            + chunk(b'IEND', b''))
+
+
+def render_pie_chart_png(user_score: int, total_score: int) -> bytes:
+    """Компактная отрисовка двух секторов в PNG на чистом Python (без подписей)"""
+    user_score, _, total_score = _pie_sizes(user_score, total_score)
+    size = CHART_SIZE
+    radius = size / 2 - 2
+    center = size / 2
+    # Сектор пользователя начинается сверху и идет против часовой стрелки, как в matplotlib
+    user_angle = 2 * math.pi * user_score / total_score
+
+    pixels = bytearray(size * size)  # 0 - фон
+    for y in range(size):
+        dy = center - y - 0.5
+        if abs(dy) > radius:
+            continue
+        half = math.sqrt(radius * radius - dy * dy)
+        row = y * size
+        for x in range(max(int(center - half), 0), min(int(center + half) + 1, size)):
+            dx = x + 0.5 - center
+            if dx * dx + dy * dy > radius * radius:
+                continue
+            angle = (math.atan2(dy, dx) - math.pi / 2) % (2 * math.pi)
+            pixels[row + x] = 1 if angle < user_angle else 2
+
+    return encode_png(size, size, ['#ffffff'] + PIE_COLORS, bytes(pixels))
+
+
+CHART_BACKENDS: Dict[str, Callable[[int, int], bytes]] = {
+    'matplotlib': render_pie_chart_matplotlib,
+    'png': render_pie_chart_png
+}
+
+
+def render_pie_chart(user_score: int, total_score: int, backend: str = CHART_BACKEND) -> bytes:
+    """Отрисовка круговой диаграммы в PNG выбранным бэкендом (выполняется в процессе пула)"""
+    return CHART_BACKENDS[backend](user_score, total_score)
+
+
+def render_line_chart_matplotlib(labels: List[str], values: List[float], title: str, invert: bool) -> bytes:
+    """Отрисовка графика по дням через matplotlib"""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 4))
+    ax = fig.subplots()
+    ax.plot(range(len(values)), values, marker='o', color=PIE_COLORS[1])
+    step = max(len(labels) // 8, 1)
+    ax.set_xticks(range(0, len(labels), step))
+    ax.set_xticklabels(labels[::step], rotation=45, ha='right')
+    if invert:
+        ax.invert_yaxis()  # Место 1 - вверху
+    ax.grid(alpha=0.3)
+    ax.set_title(title)
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png', bbox_inches='tight')
+    return buf.getvalue()
+
+
+def render_line_chart_png(labels: List[str], values: List[float], title: str, invert: bool) -> bytes:
+    """Компактная отрисовка ломаной с осями в PNG на чистом Python (без подписей)"""
+    width, height, margin = CHART_SIZE, CHART_SIZE // 2, 10
+    pixels = bytearray(width * height)  # 0 - фон, 1 - оси, 2 - линия
+    for x in range(margin, width - margin):
+        pixels[(height - margin) * width + x] = 1
+    for y in range(margin, height - margin + 1):
+        pixels[y * width + margin] = 1
+
+    low, high = min(values), max(values)
+    span = (high - low) or 1
+    points = []
+    for idx, value in enumerate(values):
+        share = (value - low) / span
+        if invert:
+            share = 1 - share
+        points.append((margin + 1 + round(idx * (width - 2 * margin - 3) / max(len(values) - 1, 1)),
+                       height - margin - 2 - round(share * (height - 2 * margin - 3))))
+
+    for (x0, y0), (x1, y1) in zip(points, points[1:] or points):
+        steps = max(abs(x1 - x0), abs(y1 - y0), 1)
+        for step in range(steps + 1):
+            x = x0 + (x1 - x0) * step // steps
+            y = y0 + (y1 - y0) * step // steps
+            for px, py in ((x, y), (x + 1, y), (x, y - 1), (x + 1, y - 1)):
+                if 0 <= px < width and 0 <= py < height:
+                    pixels[py * width + px] = 2
+
+    return encode_png(width, height, ['#ffffff', '#999999', PIE_COLORS[1]], bytes(pixels))
+
+
+LINE_CHART_BACKENDS: Dict[str, Callable[[List[str], List[float], str, bool], bytes]] = {
+    'matplotlib': render_line_chart_matplotlib,
+    'png': render_line_chart_png
+}
+
+
+def render_line_chart(labels: List[str], values: List[float], title: str, invert: bool = False,
+                      backend: str = CHART_BACKEND) -> bytes:
+    """Отрисовка графика в PNG выбранным бэкендом (выполняется в процессе пула)"""
+    return LINE_CHART_BACKENDS[backend](labels, values, title, invert)
+
+
+chart_executor: Optional[ProcessPoolExecutor] = None
+chart_cache = LRUCache(CHART_CACHE_SIZE)
+metrics.collect('bot_chart_cache', lambda: {'hits': chart_cache.hits, 'misses': chart_cache.misses})
 
 
 # ====================== ОСНОВНЫЕ ФУНКЦИИ ======================
-async def check_subscription(user_id: int) -> bool:
-    """Проверка подписки пользователя на канал"""
+async def get_subscription_status(user_id: int) -> Optional[bool]:
+    """Запрос статуса подписки через Bot API (None при ошибке)"""
     try:
         chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        subscribed = chat_member.status in ['member', 'administrator', 'creator']
-
-        async with aiosqlite.connect('ratings.db') as db:
-            # Получаем текущий статус подписки
-            cursor = await db.execute('SELECT is_subscribed FROM users WHERE user_id = ?', (user_id,))
-            current_status = (await cursor.fetchone())
-            current_status = current_status[0] if current_status else 0
-
-            # Если статус изменился на "подписан"
-            if subscribed and not current_status:
-                await db.execute('''UPDATE users SET is_subscribed = 1, subscribed_at = ?
-                                 WHERE user_id = ?''', (datetime.now(), user_id))
-
-                # Начисляем баллы за подписку, если еще не начисляли
-                cursor = await db.execute('''SELECT COUNT(*) FROM actions 
-                                         WHERE user_id = ? AND action_type = 'subscription' ''',
-                                          (user_id,))
-                if (await cursor.fetchone())[0] == 0:
-                    await add_points(user_id, 'subscription')
-
-                # Проверяем рефералов
-                cursor = await db.execute('''SELECT id, referrer_id FROM referrals 
-                                          WHERE referral_id = ? AND subscribed = 0''', (user_id,))
-                referrals = await cursor.fetchall()
-
-                for ref in referrals:
-                    ref_id, referrer_id = ref
-                    # Проверяем, подписан ли реферер
-                    cursor = await db.execute('SELECT is_subscribed FROM users WHERE user_id = ?', (referrer_id,))
-                    referrer_subscribed = (await cursor.fetchone())[0]
-
-                    if referrer_subscribed:
-                        await add_points(referrer_id, 'referral', details=f"Привел пользователя {user_id}")
-                        await db.execute('UPDATE users SET referrals = referrals + 1 WHERE user_id = ?', (referrer_id,))
-
-                    # Помечаем реферала как подписавшегося
-                    await db.execute('''UPDATE referrals SET subscribed = 1 
-                                     WHERE id = ?''', (ref_id,))
-
-            # Если статус изменился на "не подписан"
-            elif not subscribed and current_status:
-                await db.execute('UPDATE users SET is_subscribed = 0 WHERE user_id = ?', (user_id,))
-
-            await db.commit()
+        return chat_member.status in SUBSCRIBED_STATUSES
+    except Exception as e:
+        logger.error("Error getting chat member: %s", e)
+        return None
+
+
+async def apply_subscription_status(user_id: int, subscribed: bool, db: aiosqlite.Connection = None):
+    """Применение статуса подписки: флаг, баллы за подписку и начисления реферерам"""
+    async with db_pool.transaction(db) as db:
+        # Получаем текущий статус подписки
+        cursor = await db.execute('SELECT is_subscribed FROM users WHERE user_id = ?', (user_id,))
+        current_status = (await cursor.fetchone())
+        current_status = current_status[0] if current_status else 0
+
+        # Если статус изменился на "подписан"
+        if subscribed and not current_status:
+            await db.execute('''UPDATE users SET is_subscribed = 1, subscribed_at = ?
+                             WHERE user_id = ?''', (datetime.now(), user_id))
+            db_pool.on_commit(rank_index.set_subscribed, user_id, True)
+
+            grants = []
+
+            # Начисляем баллы за подписку, если еще не начисляли (в том числе в архивированной истории)
+            cursor = await db.execute('''SELECT EXISTS (SELECT 1 FROM actions 
+                                                     WHERE user_id = ? AND action_type = 'subscription')
+                                         OR EXISTS (SELECT 1 FROM action_summaries 
+                                                    WHERE user_id = ? AND action_type = 'subscription')''',
+                                      (user_id, user_id))
+            if not (await cursor.fetchone())[0]:
+                grants.append((user_id, 'subscription', 1, None))
+
+            # Рефереры и их статус подписки одним запросом
+            cursor = await db.execute('''SELECT r.referrer_id, COALESCE(u.is_subscribed, 0) 
+                                      FROM referrals r 
+                                      LEFT JOIN users u ON u.user_id = r.referrer_id 
+                                      WHERE r.referral_id = ? AND r.subscribed = 0''', (user_id,))
+            referrers = await cursor.fetchall()
+
+            # Начисляем только подписанным реферерам
+            credited = [(referrer_id,) for referrer_id, referrer_subscribed in referrers if referrer_subscribed]
+            grants.extend((referrer_id, 'referral', 1, f"Привел пользователя {user_id}")
+                          for referrer_id, in credited)
+
+            await add_points_many(grants, db=db)
+            await db.executemany('UPDATE users SET referrals = referrals + 1 WHERE user_id = ?', credited)
+
+            # Помечаем рефералов как подписавшихся
+            if referrers:
+                await db.execute('''UPDATE referrals SET subscribed = 1 
+                                 WHERE referral_id = ? AND subscribed = 0''', (user_id,))
+                db_pool.on_commit(referral_graph.mark_subscribed, user_id)
+
+            # У рефереров меняется число приглашенных
+            await stats_snapshots.invalidate([user_id] + [referrer_id for referrer_id, _ in referrers], db)
+
+        # Если статус изменился на "не подписан"
+        elif not subscribed and current_status:
+            await db.execute('UPDATE users SET is_subscribed = 0 WHERE user_id = ?', (user_id,))
+            db_pool.on_commit(rank_index.set_subscribed, user_id, False)
+            await stats_snapshots.invalidate([user_id], db)
+
+
+async def check_subscription(user_id: int, db: aiosqlite.Connection = None) -> bool:
+    """Проверка подписки пользователя на канал"""
+    subscribed = await get_subscription_status(user_id)
+    if subscribed is None:
+        return False
 
+    try:
+        await apply_subscription_status(user_id, subscribed, db=db)
         return subscribed
     except Exception as e:
-        logger.error(f"Error checking subscription: {e}")
+        logger.error("Error checking subscription: %s", e)
         return False
 
 
-async def add_points(user_id: int, action_type: str, count: int = 1, details: str = None) -> bool:
-    """Начисление баллов пользователю"""
-    if action_type not in POINT_SYSTEM:
-        logger.error(f"Invalid action type: {action_type}")
-        return False
-
-    points = POINT_SYSTEM[action_type] * count
+async def add_points_many(grants: List[Tuple[int, str, int, Optional[str]]],
+                          db: aiosqlite.Connection = None) -> bool:
+    """Начисление баллов пачкой (user_id, action_type, count, details) в одной транзакции.
+    В транзакции вызывающего (передан db) ошибка пробрасывается, чтобы не зафиксировать часть изменений"""
+    own_transaction = db is None
+    now = datetime.now()
+    rows = []
+    for user_id, action_type, count, details in grants:
+        if action_type not in POINT_SYSTEM:
+            if not own_transaction:
+                raise ValueError(f"Invalid action type: {action_type}")
+            logger.error("Invalid action type: %s", action_type)
+            return False
+        rows.append((user_id, action_type, POINT_SYSTEM[action_type] * count, now, details))
+
+    if not rows:
+        return True
 
     try:
-        async with aiosqlite.connect('ratings.db') as db:
-            # Обновляем баллы пользователя
-            await db.execute('UPDATE users SET score = score + ? WHERE user_id = ?',
-                             (points, user_id))
-
-            # Записываем действие
-            await db.execute('''INSERT INTO actions 
-                             (user_id, action_type, points, timestamp, details) 
-                             VALUES (?, ?, ?, ?, ?)''',
-                             (user_id, action_type, points, datetime.now(), details))
-
-            await db.commit()
+        async with db_pool.transaction(db) as db:
+            # Обновляем баллы пользователей
+            await db.executemany('UPDATE users SET score = score + ? WHERE user_id = ?',
+                                 [(row[2], row[0]) for row in rows])
+            for row in rows:
+                db_pool.on_commit(rank_index.add_points, row[0], row[2])
+            await stats_snapshots.invalidate(list({row[0] for row in rows}), db)
+
+            # Записываем действия
+            await db.executemany('''INSERT INTO actions 
+                                 (user_id, action_type, points, timestamp, details) 
+                                 VALUES (?, ?, ?, ?, ?)''', rows)
 
         return True
     except Exception as e:
-        logger.error(f"Error adding points: {e}")
+        if not own_transaction:
+            raise
+        logger.error("Error adding points: %s", e)
         return False
 
 
+async def add_points(user_id: int, action_type: str, count: int = 1, details: str = None,
+                     db: aiosqlite.Connection = None) -> bool:
+    """Начисление баллов пользователю"""
+    return await add_points_many([(user_id, action_type, count, details)], db=db)
+
+
 async def get_total_score() -> int:
     """Получение общего количества баллов всех пользователей"""
-    async with aiosqlite.connect('ratings.db') as db:
-        cursor = await db.execute('SELECT SUM(score) FROM users WHERE is_subscribed = 1')
-        total = (await cursor.fetchone())[0]
-        return total if total else 0
+    async with db_pool.read() as db:
+        cursor = await db.execute("SELECT value FROM aggregates WHERE name = 'total_score'")
+        total = await cursor.fetchone()
+        return total[0] if total and total[0] else 0
 
 
-async def generate_pie_chart(user_id: int) -> BytesIO:
-    """Генерация круговой диаграммы с долей баллов пользователя"""
-    async with aiosqlite.connect('ratings.db') as db:
-        # Получаем баллы пользователя
-        cursor = await db.execute('SELECT score FROM users WHERE user_id = ?', (user_id,))
-        user_score = (await cursor.fetchone())[0] if cursor else 0
+async def rebuild_total_score(db: aiosqlite.Connection = None) -> Tuple[int, int]:
+    """Пересчет общего количества баллов с нуля: (значение счетчика, фактическая сумма)"""
+    async with db_pool.transaction(db) as db:
+        cursor = await db.execute("SELECT value FROM aggregates WHERE name = 'total_score'")
+        cached = await cursor.fetchone()
+        cursor = await db.execute('SELECT COALESCE(SUM(score), 0) FROM users WHERE is_subscribed = 1')
+        actual = (await cursor.fetchone())[0]
+        await db.execute("INSERT OR REPLACE INTO aggregates (name, value) VALUES ('total_score', ?)", (actual,))
 
-        # Получаем общее количество баллов
-        total_score = await get_total_score()
-        other_score = total_score - user_score if total_score > user_score else 0
+    cached = cached[0] if cached else 0
+    if cached != actual:
+        logger.warning("Total score counter drift: %s != %s", cached, actual)
+    return cached, actual
 
-        # Если нет данных
-        if total_score == 0:
-            user_score = 1
-            other_score = 1
-            total_score = 2
 
-    # Создаем диаграмму
-    labels = ['Ваши баллы', 'Другие участники']
-    sizes = [user_score, other_score]
-    colors = ['#ff9999', '#66b3ff']
+async def generate_pie_chart(user_id: int, user_score: Optional[int] = None) -> BytesIO:
+    """Генерация круговой диаграммы с долей баллов пользователя"""
+    if user_score is None:
+        async with db_pool.read() as db:
+            # Получаем баллы пользователя
+            cursor = await db.execute('SELECT score FROM users WHERE user_id = ?', (user_id,))
+            user = await cursor.fetchone()
+            user_score = user[0] if user else 0
 
-    fig, ax = plt.subplots()
-    ax.pie(sizes, labels=labels, colors=colors, autopct='%1.1f%%', startangle=90)
-    ax.axis('equal')  # Круговая диаграмма
-    ax.set_title(f"Ваши баллы: {user_score} из {total_score} ({user_score / total_score * 100:.1f}%)")
+    # Получаем общее количество баллов
+    total_score = await get_total_score()
 
-    buf = BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight')
-    buf.seek(0)
-    plt.close()
+    # Многие пользователи видят одинаковую пару значений, поэтому готовые PNG кэшируются
+    key = (user_score, total_score)
+    image = chart_cache.get(key)
+    if image is None:
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(chart_executor, render_pie_chart, user_score, total_score,
+                                           CHART_BACKEND)
+        chart_cache.set(key, image)
 
-    return buf
+    return BytesIO(image)
 
 
 async def get_user_position(user_id: int) -> int:
     """Получение позиции пользователя в рейтинге"""
-    async with aiosqlite.connect('ratings.db') as db:
+    if rank_index.ready:
+        return rank_index.position(user_id)
+
+    async with db_pool.read() as db:
         cursor = await db.execute('''SELECT COUNT(*) FROM users 
                                   WHERE score > (SELECT score FROM users WHERE user_id = ?)
                                   AND is_subscribed = 1''',
@@ -247,92 +1966,265 @@ async def get_user_position(user_id: int) -> int:
 
 async def get_top_users(limit: int = 10) -> List[Tuple]:
     """Получение топ-N пользователей (только подписанных)"""
-    async with aiosqlite.connect('ratings.db') as db:
+    if rank_index.ready:
+        return await get_users_by_ids(rank_index.top(limit))
+
+    async with db_pool.read() as db:
         cursor = await db.execute('''SELECT user_id, username, full_name, score 
                                  FROM users 
                                  WHERE is_subscribed = 1
-                                 ORDER BY score DESC 
+                                 ORDER BY score DESC, user_id 
                                  LIMIT ?''', (limit,))
         return await cursor.fetchall()
 
 
-async def get_user_stats(user_id: int) -> Dict[str, int]:
-    """Получение статистики пользователя"""
-    async with aiosqlite.connect('ratings.db') as db:
-        # Статистика по действиям
-        cursor = await db.execute('''SELECT action_type, SUM(points), COUNT(*) 
-                                 FROM actions 
-                                 WHERE user_id = ? 
-                                 GROUP BY action_type''', (user_id,))
-        stats = await cursor.fetchall()
-
-        # Общий счет
-        cursor = await db.execute('SELECT score FROM users WHERE user_id = ?', (user_id,))
-        total_score = (await cursor.fetchone())[0] if cursor else 0
-
-        # Статистика по заказам
-        cursor = await db.execute('''SELECT SUM(books_purchased), SUM(books_created) 
-                                  FROM orders 
-                                  WHERE user_id = ?''', (user_id,))
-        order_stats = await cursor.fetchone()
-        books_purchased = order_stats[0] if order_stats and order_stats[0] else 0
-        books_created = order_stats[1] if order_stats and order_stats[1] else 0
+async def get_users_by_ids(user_ids: List[int]) -> List[Tuple]:
+    """Получение (user_id, username, full_name, score) в порядке переданных ID"""
+    if not user_ids:
+        return []
+
+    async with db_pool.read() as db:
+        placeholders = ', '.join('?' * len(user_ids))
+        cursor = await db.execute(f'''SELECT user_id, username, full_name, score 
+                                  FROM users 
+                                  WHERE user_id IN ({placeholders})''', user_ids)
+        rows = {row[0]: row for row in await cursor.fetchall()}
+
+    return [rows[user_id] for user_id in user_ids if user_id in rows]
+
+
+async def get_users_around(user_id: int, radius: int = 1) -> List[Tuple]:
+    """Соседи пользователя по рейтингу: (место, user_id, username, full_name, score)"""
+    if rank_index.ready:
+        neighbours = rank_index.around(user_id, radius)
+        users = {row[0]: row for row in await get_users_by_ids([row[1] for row in neighbours])}
+        return [(position,) + users[neighbour_id]
+                for position, neighbour_id, _ in neighbours if neighbour_id in users]
+
+    async with db_pool.read() as db:
+        # Номер строки в порядке (score DESC, user_id), а не место: при равных счетах они различаются
+        cursor = await db.execute('''SELECT (SELECT COUNT(*) FROM users o 
+                                          WHERE o.is_subscribed = 1 AND o.score > u.score)
+                                       + (SELECT COUNT(*) FROM users o 
+                                          WHERE o.is_subscribed = 1 AND o.score = u.score AND o.user_id < u.user_id)
+                                  FROM users u WHERE user_id = ? AND is_subscribed = 1''', (user_id,))
+        row = await cursor.fetchone()
+        if row is None:
+            return []
+        offset = max(row[0] - radius, 0)
+        cursor = await db.execute('''SELECT user_id, username, full_name, score 
+                                 FROM users 
+                                 WHERE is_subscribed = 1
+                                 ORDER BY score DESC, user_id 
+                                 LIMIT ? OFFSET ?''',
+                                  (row[0] - offset + radius + 1, offset))
+        rows = await cursor.fetchall()
+
+    return [(await get_user_position(row[0]),) + tuple(row) for row in rows]
+
+
+async def get_user_rank(user_id: int) -> Optional[int]:
+    """Место пользователя в рейтинге или None, если он не подписан (без сбора статистики)"""
+    if rank_index.ready:
+        return rank_index.position(user_id) if rank_index.is_subscribed(user_id) else None
+
+    async with db_pool.read() as db:
+        cursor = await db.execute('''SELECT is_subscribed,
+                                         (SELECT COUNT(*) FROM users o
+                                          WHERE o.is_subscribed = 1 AND o.score > u.score) + 1
+                                  FROM users u WHERE user_id = ?''', (user_id,))
+        row = await cursor.fetchone()
+    return row[1] if row and row[0] else None
+
+
+class LeaderboardCache:
+    """Общая часть таблицы лидеров, собранная один раз на версию данных рейтинга"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._version = -1
+        self._user_ids: List[int] = []
+        self._lines: List[str] = []
+        self.hits = 0
+        self.builds = 0
+
+    async def get(self) -> Tuple[List[int], List[str]]:
+        """ID и строки топа в порядке мест"""
+        version = db_pool.version
+        if version == self._version:
+            self.hits += 1
+            return self._user_ids, self._lines
+
+        self.builds += 1
+        top_users = await get_top_users(self.limit)
+        user_ids = [user[0] for user in top_users]
+        lines = []
+        for idx, user in enumerate(top_users, 1):
+            name = user[2] if user[2] else f"@{user[1]}" if user[1] else f"ID:{user[0]}"
+            lines.append(f"{idx}. {name} - {user[3]} баллов")
+        # Версия прочитана до запроса: запись, зафиксированная во время сборки, вызовет пересборку
+        self._version, self._user_ids, self._lines = version, user_ids, lines
+        return user_ids, lines
+
+
+leaderboard_cache = LeaderboardCache(10)
+metrics.collect('bot_leaderboard_cache', lambda: {'hits': leaderboard_cache.hits,
+                                                  'builds': leaderboard_cache.builds})
+
+
+async def build_stats_snapshot(user_id: int, db: aiosqlite.Connection) -> Dict:
+    """Сбор статистики пользователя из исходных таблиц"""
+    # Статистика по действиям: из недельных агрегатов, пока они не заполнены - по actions и архивным суммам
+    if action_rollups.ready:
+        cursor = await db.execute('''SELECT action_type, SUM(points), SUM(actions) 
+                                  FROM action_rollups 
+                                  WHERE user_id = ? AND period = 'week' 
+                                  GROUP BY action_type''', (user_id,))
+    else:
+        cursor = await db.execute('''SELECT action_type, SUM(points), SUM(actions) 
+                                 FROM (SELECT action_type, points, 1 AS actions FROM actions WHERE user_id = ?
+                                       UNION ALL
+                                       SELECT action_type, points, actions FROM action_summaries WHERE user_id = ?) 
+                                 GROUP BY action_type''', (user_id, user_id))
+    stats = [list(stat) for stat in await cursor.fetchall()]
+
+    # Общий счет, статус подписки и реферальный код
+    cursor = await db.execute('''SELECT score, is_subscribed, referral_code 
+                              FROM users WHERE user_id = ?''', (user_id,))
+    total_score, is_subscribed, referral_code = await cursor.fetchone() or (0, 0, None)
+
+    # Статистика по заказам (с учетом архивных сумм)
+    cursor = await db.execute('''SELECT SUM(books_purchased), SUM(books_created) 
+                              FROM (SELECT books_purchased, books_created FROM orders WHERE user_id = ?
+                                    UNION ALL
+                                    SELECT books_purchased, books_created FROM order_summaries WHERE user_id = ?)''',
+                              (user_id, user_id))
+    order_stats = await cursor.fetchone()
+
+    # Количество рефералов
+    cursor = await db.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND subscribed = 1', (user_id,))
+    referrals = (await cursor.fetchone())[0]
+
+    return {
+        'stats': stats,
+        'total_score': total_score,
+        'books_purchased': order_stats[0] if order_stats and order_stats[0] else 0,
+        'books_created': order_stats[1] if order_stats and order_stats[1] else 0,
+        'is_subscribed': is_subscribed,
+        'referral_code': referral_code,
+        'referrals': referrals,
+        'referral_points': sum(stat[1] for stat in stats if stat[0] == 'referral')
+    }
 
-        # Статус подписки
-        cursor = await db.execute('SELECT is_subscribed FROM users WHERE user_id = ?', (user_id,))
-        is_subscribed = (await cursor.fetchone())[0] if cursor else 0
 
+class StatsSnapshotCache:
+    """Снимки статистики пользователей: LRU в памяти поверх таблицы user_stats"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.memory = LRUCache(maxsize, ttl=ttl)
+        self.table_hits = 0
+        self.builds = 0
+
+    async def get(self, user_id: int) -> Dict:
+        """Снимок статистики: память, затем user_stats, затем сбор из исходных таблиц"""
+        snapshot = self.memory.get(user_id)
+        if snapshot is not None:
+            return snapshot
+
+        # Снимок, прочитанный во время конкурирующей записи, не кэшируется
+        version = db_pool.version
+        async with db_pool.read() as db:
+            cursor = await db.execute('SELECT data FROM user_stats WHERE user_id = ?', (user_id,))
+            row = await cursor.fetchone()
+            if row:
+                self.table_hits += 1
+                snapshot = json.loads(row[0])
+            else:
+                self.builds += 1
+                snapshot = await build_stats_snapshot(user_id, db)
+
+        if db_pool.version == version:
+            self.memory.set(user_id, snapshot)
+            if row is None:
+                # Запись в user_stats - через очередь леджера, путь чтения не ждет писателя
+                ledger_queue.submit(self._persist, user_id)
+        return snapshot
+
+    async def _persist(self, user_id: int, db: aiosqlite.Connection):
+        """Сборка и сохранение снимка в транзакции писателя. Снимок с читателя сюда не передается:
+        db_pool.version не видит commit других процессов, а под BEGIN IMMEDIATE никто не изменит данные до commit"""
+        cursor = await db.execute('SELECT 1 FROM user_stats WHERE user_id = ?', (user_id,))
+        if await cursor.fetchone():
+            return
+        snapshot = await build_stats_snapshot(user_id, db)
+        await db.execute('INSERT INTO user_stats (user_id, data) VALUES (?, ?)', (user_id, json.dumps(snapshot)))
+
+    async def invalidate(self, user_ids: List[int], db: aiosqlite.Connection):
+        """Сброс снимков в транзакции вызывающего (память очищается после commit)"""
+        await db.executemany('DELETE FROM user_stats WHERE user_id = ?', [(user_id,) for user_id in user_ids])
+        for user_id in user_ids:
+            db_pool.on_commit(self.memory.pop, user_id)
+        db_pool.mark_changed()
+
+    @property
+    def counters(self) -> Dict[str, int]:
         return {
-            'stats': stats,
-            'total_score': total_score,
-            'position': await get_user_position(user_id) if is_subscribed else None,
-            'books_purchased': books_purchased,
-            'books_created': books_created,
-            'is_subscribed': is_subscribed
+            'memory_hits': self.memory.hits,
+            'memory_misses': self.memory.misses,
+            'table_hits': self.table_hits,
+            'builds': self.builds
         }
 
 
+stats_snapshots = StatsSnapshotCache(STATS_CACHE_SIZE, STATS_CACHE_TTL)
+db_pool.on_remote_change(stats_snapshots.memory.clear)
+metrics.collect('bot_stats_cache', lambda: stats_snapshots.counters)
+
+
+async def get_user_stats(user_id: int) -> Dict:
+    """Получение статистики пользователя"""
+    snapshot = await stats_snapshots.get(user_id)
+    return {
+        'stats': snapshot['stats'],
+        'total_score': snapshot['total_score'],
+        'position': await get_user_position(user_id) if snapshot['is_subscribed'] else None,
+        'books_purchased': snapshot['books_purchased'],
+        'books_created': snapshot['books_created'],
+        'is_subscribed': snapshot['is_subscribed'],
+        'referral_code': snapshot['referral_code'],
+        'referrals': snapshot['referrals'],
+        'referral_points': snapshot['referral_points']
+    }
+
+
 async def get_referral_info(user_id: int) -> Dict:
     """Получение информации о рефералах"""
-    async with aiosqlite.connect('ratings.db') as db:
-        # Получаем реферальный код
-        cursor = await db.execute('SELECT referral_code FROM users WHERE user_id = ?', (user_id,))
-        referral_code = (await cursor.fetchone())[0] if cursor else None
-
-        # Количество рефералов
-        cursor = await db.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND subscribed = 1', (user_id,))
-        referrals = (await cursor.fetchone())[0] if cursor else 0
-
-        # Баллы за рефералов
-        cursor = await db.execute('''SELECT SUM(points) FROM actions 
-                                  WHERE user_id = ? AND action_type = 'referral' ''',
-                                  (user_id,))
-        referral_points = (await cursor.fetchone())[0] if cursor else 0
-
-        return {
-            'referral_code': referral_code,
-            'referrals': referrals,
-            'referral_points': referral_points
-        }
+    snapshot = await stats_snapshots.get(user_id)
+    return {
+        'referral_code': snapshot['referral_code'],
+        'referrals': snapshot['referrals'],
+        'referral_points': snapshot['referral_points']
+    }
 
 
-async def register_user(user_id: int, username: str, full_name: str):
+async def register_user(user_id: int, username: str, full_name: str, db: aiosqlite.Connection = None):
     """Регистрация нового пользователя"""
-    async with aiosqlite.connect('ratings.db') as db:
+    async with db_pool.transaction(db) as db:
         referral_code = f"ref_{user_id}"
         await db.execute('''INSERT OR IGNORE INTO users 
                           (user_id, username, full_name, referral_code) 
                           VALUES (?, ?, ?, ?)''',
                          (user_id, username, full_name, referral_code))
-        await db.commit()
+        db_pool.on_commit(rank_index.add_user, user_id)
+        db_pool.mark_changed()
 
 
-async def process_referral(referral_id: int, referrer_id: int):
+async def process_referral(referral_id: int, referrer_id: int, db: aiosqlite.Connection = None):
     """Обработка реферала"""
-    if referrer_id == referral_id:
+    if referral_graph.creates_cycle(referrer_id, referral_id):
         return False
 
-    async with aiosqlite.connect('ratings.db') as db:
+    async with db_pool.transaction(db) as db:
         # Проверяем, не регистрировался ли уже этот реферал
         cursor = await db.execute('''SELECT COUNT(*) FROM referrals 
                                   WHERE referrer_id = ? AND referral_id = ?''',
@@ -345,127 +2237,757 @@ async def process_referral(referral_id: int, referrer_id: int):
                              (referrer_id, referral_id, timestamp) 
                              VALUES (?, ?, ?)''',
                              (referrer_id, referral_id, datetime.now()))
-            await db.commit()
+            db_pool.on_commit(referral_graph.add_edge, referrer_id, referral_id)
             return True
     return False
 
 
-async def add_order(user_id: int, username: str, purchased: int = 0, created: int = 0):
+async def add_order(user_id: int, username: str, purchased: int = 0, created: int = 0,
+                    db: aiosqlite.Connection = None):
     """Добавление заказа"""
-    async with aiosqlite.connect('ratings.db') as db:
+    async with db_pool.transaction(db) as db:
         await db.execute('''INSERT INTO orders 
                          (user_id, username, books_purchased, books_created, timestamp) 
                          VALUES (?, ?, ?, ?, ?)''',
                          (user_id, username, purchased, created, datetime.now()))
-        await db.commit()
+        await stats_snapshots.invalidate([user_id], db)
+
+        grants = []
+        if purchased > 0:
+            grants.append((user_id, 'book_purchase', purchased, None))
+        if created > 0:
+            grants.append((user_id, 'book_creation', created, None))
+        await add_points_many(grants, db=db)
+
+
+class SubscriptionRefresher:
+    """Массовая проверка подписок: ограниченная конкурентность, лимит запросов, чекпоинты"""
+    CHECKPOINT = 'subscription_refresh'
+
+    def __init__(self, bot: Bot, concurrency: int, rate: float, batch_size: int):
+        self.bot = bot
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate)
+        self.running = False
+        self.stats: Dict[str, float] = {}
+
+    async def _fetch_status(self, user_id: int) -> Optional[bool]:
+        """Статус подписки с учетом лимитов (None - не удалось узнать)"""
+        async with self._semaphore:
+            for _ in range(REFRESH_RETRIES):
+                await self._bucket.acquire()
+                try:
+                    chat_member = await self.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+                    return chat_member.status in SUBSCRIBED_STATUSES
+                except RetryAfter as e:
+                    # Лимит Bot API общий, поэтому приостанавливаем все запросы
+                    self.stats['retry_after'] += 1
+                    self._bucket.pause(e.timeout)
+                except Exception as e:
+                    logger.error("Error getting chat member %s: %s", user_id, e)
+                    break
+        self.stats['errors'] += 1
+        return None
+
+    async def _process_batch(self, users: List[Tuple[int, int]]):
+        """Проверка пачки пользователей и запись изменившихся статусов одной транзакцией"""
+        statuses = await asyncio.gather(*(self._fetch_status(user_id) for user_id, _ in users))
+
+        async with db_pool.write() as db:
+            for (user_id, current_status), subscribed in zip(users, statuses):
+                if subscribed is not None and subscribed != bool(current_status):
+                    await apply_subscription_status(user_id, subscribed, db=db)
+                    self.stats['changed'] += 1
+            await set_checkpoint(self.CHECKPOINT, users[-1][0], db=db)
+
+        self.stats['checked'] += len(users)
+
+    async def run(self) -> Dict[str, float]:
+        """Проверка всех пользователей, продолжая с сохраненного чекпоинта"""
+        if self.running:
+            return self.stats
+        self.running = True
+        started = time.monotonic()
+        self.stats = {'checked': 0, 'changed': 0, 'errors': 0, 'retry_after': 0, 'rate': 0.0}
+
+        try:
+            last_user_id = await get_checkpoint(self.CHECKPOINT) or 0
+            if last_user_id:
+                logger.info("Resuming subscription refresh after user %s", last_user_id)
+
+            while True:
+                async with db_pool.read() as db:
+                    cursor = await db.execute('''SELECT user_id, is_subscribed FROM users 
+                                              WHERE user_id > ? 
+                                              ORDER BY user_id 
+                                              LIMIT ?''', (last_user_id, self.batch_size))
+                    users = await cursor.fetchall()
+                if not users:
+                    break
+
+                await self._process_batch(users)
+                last_user_id = users[-1][0]
+                self.stats['rate'] = self.stats['checked'] / max(time.monotonic() - started, 1e-9)
+                logger.info("Subscription refresh progress: %s", self.stats)
+
+            await set_checkpoint(self.CHECKPOINT, None)
+            return self.stats
+        finally:
+            self.running = False
+
+
+subscription_refresher = SubscriptionRefresher(bot, REFRESH_CONCURRENCY, REFRESH_RATE, REFRESH_BATCH_SIZE)
+
+
+async def update_all_subscribers() -> Dict[str, float]:
+    """Обновление статуса подписки для всех пользователей"""
+    try:
+        return await subscription_refresher.run()
+    except Exception as e:
+        logger.error("Error updating subscribers: %s", e)
+        return subscription_refresher.stats
 
-    if purchased > 0:
-        await add_points(user_id, 'book_purchase', purchased)
-    if created > 0:
-        await add_points(user_id, 'book_creation', created)
 
+# ====================== ИСТОРИЯ ======================
+ROLLUP_PERIODS = {
+    'day': "date(timestamp)",
+    'week': "date(timestamp, 'weekday 0', '-6 days')"
+}
 
-async def update_all_subscribers():
-    """Обновление статуса подписки для всех пользователей"""
-    try:
-        async with aiosqlite.connect('ratings.db') as db:
-            # Получаем всех пользователей из базы
-            cursor = await db.execute('SELECT user_id FROM users')
-            users = await cursor.fetchall()
 
-            for user in users:
-                user_id = user[0]
-                await check_subscription(user_id)
+class ActionRollups:
+    """Агрегаты actions по дням и неделям: новые строки учитывает триггер,
+    строки, записанные до появления агрегатов, - фоновое заполнение пачками по id с чекпоинтом"""
+    CHECKPOINT = 'rollup_backfill'  # Последний учтенный id
+    UNTIL_CHECKPOINT = 'rollup_backfill_until'  # Последний id, записанный до создания триггера
+
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.ready = False  # Агрегаты покрывают всю историю actions
+
+    async def load_state(self):
+        self.ready = await get_checkpoint(self.UNTIL_CHECKPOINT) is None
+
+    async def backfill(self):
+        """Заполнение агрегатов по старым строкам, продолжая с сохраненного чекпоинта"""
+        until = await get_checkpoint(self.UNTIL_CHECKPOINT)
+        if until is None:
+            self.ready = True
+            return
+
+        last_id = await get_checkpoint(self.CHECKPOINT) or 0
+        logger.info("Backfilling action rollups from id %s to %s", last_id, until)
+        while last_id < until:
+            upper = min(last_id + self.batch_size, until)
+            async with db_pool.write() as db:
+                for period, period_start in ROLLUP_PERIODS.items():
+                    await db.execute(f'''INSERT INTO action_rollups
+                                         (user_id, period, period_start, action_type, points, actions)
+                                         SELECT user_id, '{period}', {period_start}, action_type, SUM(points), COUNT(*)
+                                         FROM actions
+                                         WHERE id > ? AND id <= ? AND timestamp IS NOT NULL
+                                         GROUP BY user_id, {period_start}, action_type
+                                         ON CONFLICT (user_id, period, period_start, action_type)
+                                         DO UPDATE SET points = points + excluded.points,
+                                                       actions = actions + excluded.actions''',
+                                     (last_id, upper))
+                await set_checkpoint(self.CHECKPOINT, upper, db=db)
+            last_id = upper
+
+        async with db_pool.write() as db:
+            await set_checkpoint(self.CHECKPOINT, None, db=db)
+            await set_checkpoint(self.UNTIL_CHECKPOINT, None, db=db)
+        self.ready = True
+        logger.info("Action rollups backfill finished")
+
+
+action_rollups = ActionRollups(ROLLUP_BACKFILL_BATCH)
+
+
+async def snapshot_rank_history():
+    """Ежедневный снимок мест всех подписанных пользователей одним запросом (один раз в день);
+    снимки старше HISTORY_DAYS дней удаляются: графики их не показывают"""
+    today = datetime.now().date()
+    day_id = int(today.strftime('%Y%m%d'))
+    if await get_checkpoint('rank_history_day') == day_id:
+        return
 
-    except Exception as e:
-        logger.error(f"Error updating subscribers: {e}")
+    async with db_pool.write() as db:
+        await db.execute('''INSERT OR REPLACE INTO rank_history (user_id, day, position, score)
+                            SELECT user_id, ?, RANK() OVER (ORDER BY score DESC), score
+                            FROM users WHERE is_subscribed = 1''', (today.isoformat(),))
+        await db.execute('DELETE FROM rank_history WHERE day < ?', (_history_days(HISTORY_DAYS)[0],))
+        await set_checkpoint('rank_history_day', day_id, db=db)
 
 
-# ====================== КОМАНДЫ ПОЛЬЗОВАТЕЛЯ ======================
-async def sync_channel_subscribers():
-    """Синхронизация всех подписчиков канала с базой данных"""
-    try:
-        async with aiosqlite.connect('ratings.db') as db:
-            # Получаем всех подписчиков канала
-            channel_members = []
-            async for member in bot.get_chat_members(CHANNEL_ID):
-                if member.user.is_bot:
-                    continue
-                channel_members.append(member.user)
-
-            # Добавляем/обновляем подписчиков в базе
-            for member in channel_members:
-                # Проверяем, есть ли пользователь в базе
-                cursor = await db.execute('SELECT 1 FROM users WHERE user_id = ?', (member.id,))
-                exists = await cursor.fetchone()
-
-                if not exists:
-                    # Добавляем нового подписчика
-                    referral_code = f"ref_{member.id}"
-                    await db.execute('''INSERT INTO users 
-                                      (user_id, username, full_name, referral_code, is_subscribed) 
-                                      VALUES (?, ?, ?, ?, ?)''',
-                                     (member.id, member.username, member.full_name, referral_code, 1))
-
-                    # Начисляем баллы за подписку
-                    await db.execute('''INSERT INTO actions 
-                                      (user_id, action_type, points, timestamp) 
-                                      VALUES (?, ?, ?, ?)''',
-                                     (member.id, 'subscription', POINT_SYSTEM['subscription'], datetime.now()))
-
-                    # Обновляем общий счёт
-                    await db.execute('UPDATE users SET score = score + ? WHERE user_id = ?',
-                                     (POINT_SYSTEM['subscription'], member.id))
-                else:
-                    # Обновляем статус подписки
-                    await db.execute('UPDATE users SET is_subscribed = 1 WHERE user_id = ?', (member.id,))
+def _history_days(days: int) -> List[str]:
+    start = datetime.now().date() - timedelta(days=days - 1)
+    return [(start + timedelta(days=idx)).isoformat() for idx in range(days)]
 
-            await db.commit()
-    except Exception as e:
-        logger.error(f"Error syncing channel subscribers: {e}")
 
+async def get_score_history(user_id: int, days: int) -> Tuple[List[str], List[int], int]:
+    """Счет пользователя на конец каждого из последних days дней и начисления за период (по дневным агрегатам)"""
+    labels = _history_days(days)
+    async with db_pool.read() as db:
+        cursor = await db.execute('''SELECT period_start, SUM(points) FROM action_rollups
+                                  WHERE user_id = ? AND period = 'day' AND period_start >= ?
+                                  GROUP BY period_start''', (user_id, labels[0]))
+        daily = dict(await cursor.fetchall())
+        cursor = await db.execute('SELECT score FROM users WHERE user_id = ?', (user_id,))
+        row = await cursor.fetchone()
+
+    # Счет до начала периода: текущий счет без начислений за период
+    gained = sum(daily.values())
+    score = (row[0] if row else 0) - gained
+    values = []
+    for day in labels:
+        score += daily.get(day, 0)
+        values.append(score)
+    return labels, values, gained
+
+
+async def get_rank_history(user_id: int, days: int) -> Tuple[List[str], List[int]]:
+    """Места пользователя по ежедневным снимкам за последние days дней"""
+    async with db_pool.read() as db:
+        cursor = await db.execute('''SELECT day, position FROM rank_history
+                                  WHERE user_id = ? AND day >= ?
+                                  ORDER BY day''', (user_id, _history_days(days)[0]))
+        rows = await cursor.fetchall()
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+
+async def generate_line_chart(key: Tuple, labels: List[str], values: List[float], title: str,
+                              invert: bool = False) -> BytesIO:
+    """Отрисовка графика в пуле процессов с кэшированием по ключу"""
+    image = chart_cache.get(key)
+    if image is None:
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(chart_executor, render_line_chart, labels, values, title, invert,
+                                           CHART_BACKEND)
+        chart_cache.set(key, image)
+    return BytesIO(image)
+
+
+# ====================== АРХИВ ======================
+# Схема архива повторяет исходные таблицы: строки переносятся как есть
+ARCHIVE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS archive.actions
+       (id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        action_type TEXT,
+        points INTEGER,
+        timestamp DATETIME,
+        details TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS archive.orders
+       (id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        username TEXT,
+        books_purchased INTEGER,
+        books_created INTEGER,
+        timestamp DATETIME)''',
+    'CREATE INDEX IF NOT EXISTS archive.idx_actions_user ON actions (user_id)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_user ON orders (user_id)',
+)
+
+# Сворачивание строк пачки в суммы основной базы: параметры - верхний id и граница по времени
+ARCHIVE_SUMMARIES = {
+    'actions': '''INSERT INTO action_summaries (user_id, action_type, points, actions)
+                  SELECT user_id, action_type, SUM(points), COUNT(*)
+                  FROM main.actions WHERE id <= ? AND timestamp < ?
+                  GROUP BY user_id, action_type
+                  ON CONFLICT (user_id, action_type)
+                  DO UPDATE SET points = points + excluded.points, actions = actions + excluded.actions''',
+    'orders': '''INSERT INTO order_summaries (user_id, books_purchased, books_created, orders)
+                 SELECT user_id, SUM(books_purchased), SUM(books_created), COUNT(*)
+                 FROM main.orders WHERE id <= ? AND timestamp < ?
+                 GROUP BY user_id
+                 ON CONFLICT (user_id)
+                 DO UPDATE SET books_purchased = books_purchased + excluded.books_purchased,
+                               books_created = books_created + excluded.books_created,
+                               orders = orders + excluded.orders'''
+}
+
+
+class LedgerArchive:
+    """Архивация леджера: строки actions и orders старше after_days сворачиваются в суммы по пользователям
+    в основной базе, а сами строки переносятся в архивную базу (доступна читателям как схема archive)"""
+
+    def __init__(self, after_days: int, batch_size: int, vacuum_pages: int):
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.stats: Dict[str, int] = {}
+
+    async def _archive_batch(self, table: str, cutoff: datetime) -> int:
+        """Перенос одной пачки самых старых строк; возвращает число перенесенных строк"""
+        async with db_pool.read() as db:
+            cursor = await db.execute(f'''SELECT MAX(id) FROM (SELECT id FROM main.{table} 
+                                       WHERE timestamp < ? ORDER BY id LIMIT ?)''', (cutoff, self.batch_size))
+            upper = (await cursor.fetchone())[0]
+        if upper is None:
+            return 0
+
+        # Commit нескольких баз в режиме WAL не атомарен как целое, поэтому копия в архив фиксируется первой
+        # отдельной транзакцией; повтор после сбоя безопасен благодаря INSERT OR IGNORE по id
+        async with db_pool.write() as db:
+            await db.execute(f'''INSERT OR IGNORE INTO archive.{table} 
+                                 SELECT * FROM main.{table} WHERE id <= ? AND timestamp < ?''', (upper, cutoff))
+        async with db_pool.write() as db:
+            await db.execute(ARCHIVE_SUMMARIES[table], (upper, cutoff))
+            cursor = await db.execute(f'DELETE FROM main.{table} WHERE id <= ? AND timestamp < ?', (upper, cutoff))
+            return cursor.rowcount
+
+    async def _vacuum(self):
+        """Инкрементальный VACUUM; при первом запуске база один раз переводится в режим auto_vacuum = INCREMENTAL"""
+        async with db_pool.exclusive() as db:
+            cursor = await db.execute('PRAGMA auto_vacuum')
+            if (await cursor.fetchone())[0] != 2:
+                logger.info("Enabling incremental auto_vacuum (one-time full VACUUM)")
+                await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                await db.execute('VACUUM')
+            await db.execute(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+
+    async def compact(self):
+        """Перенос всех строк старше after_days и освобождение места в файле базы"""
+        if not action_rollups.ready:
+            # Заполнение агрегатов еще читает старые строки actions
+            return
+
+        async with db_pool.write() as db:
+            for statement in ARCHIVE_SCHEMA:
+                await db.execute(statement)
+
+        cutoff = datetime.now() - timedelta(days=self.after_days)
+        self.stats = {'actions': 0, 'orders': 0}
+        for table in self.stats:
+            while True:
+                moved = await self._archive_batch(table, cutoff)
+                if not moved:
+                    break
+                self.stats[table] += moved
+
+        async with db_pool.write() as db:
+            # Журнал изменений процессы читают каждые несколько секунд: удаляются записи, бывшие в нем
+            # уже при прошлой очистке, то есть старше COMPACTION_INTERVAL
+            cursor = await db.execute("SELECT value FROM checkpoints WHERE name = 'user_changes_until'")
+            row = await cursor.fetchone()
+            if row:
+                await db.execute('DELETE FROM user_changes WHERE id <= ?', (row[0],))
+            cursor = await db.execute('SELECT MAX(id) FROM user_changes')
+            await set_checkpoint('user_changes_until', (await cursor.fetchone())[0], db)
+
+        await self._vacuum()
+        logger.info("Ledger compaction finished: %s", self.stats)
+
+
+ledger_archive = LedgerArchive(ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, VACUUM_PAGES)
+
+
+# ====================== ОЧЕРЕДЬ ЗАПИСИ ======================
+class LedgerQueue:
+    """Очередь записи в леджер: одна задача применяет события пачками в одной транзакции"""
+
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.applied = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Остановка после применения всех уже поставленных событий"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def submit(self, func: Callable, *args: Any, **kwargs: Any) -> asyncio.Future:
+        """Постановка события: func(*args, db=..., **kwargs) выполнится в общей транзакции.
+        Возвращает future, который завершается после commit (ждать его нужно только для гарантии записи)"""
+        future = asyncio.get_running_loop().create_future()
+        # Запросы события учитываются в счетчике обработчика, который его поставил
+        counter = db_query_counter.get()
+        if counter is not None:
+            counter.pending.append(future)
+        self._queue.put_nowait((func, args, kwargs, future, counter))
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            event = await self._queue.get()
+            if event is None:
+                break
+            batch = [event]
+
+            # Добираем пачку: до batch_size событий или до истечения flush_interval
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+
+            await self._apply(batch)
+
+    @property
+    def counters(self) -> Dict[str, int]:
+        return {
+            'applied': self.applied,
+            'failed': self.failed,
+            'batches': self.batches,
+            'queued': self._queue.qsize() if self._queue is not None else 0
+        }
+
+    async def _apply(self, batch: List[Tuple[Callable, tuple, dict, asyncio.Future, Optional[QueryCounter]]]):
+        """Применение пачки: каждое событие в своей точке сохранения, commit один на пачку"""
+        results = []
+        try:
+            async with db_pool.write() as db:
+                for func, args, kwargs, future, counter in batch:
+                    token = db_query_counter.set(counter)
+                    try:
+                        async with db_pool.transaction(db) as event_db:
+                            results.append((future, await func(*args, db=event_db, **kwargs), None))
+                    except Exception as e:
+                        logger.error("Error applying ledger event %s: %s", func.__name__, e)
+                        results.append((future, None, e))
+                    finally:
+                        db_query_counter.reset(token)
+        except Exception as e:
+            logger.error("Error committing ledger batch: %s", e)
+            results = [(future, None, e) for _, _, _, future, _ in batch]
+
+        self.batches += 1
+        for future, result, error in results:
+            if error is None:
+                self.applied += 1
+            else:
+                self.failed += 1
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+                # Исключение уже залогировано, даже если отправитель не ждет future
+                future.exception()
+
+
+ledger_queue = LedgerQueue(LEDGER_BATCH_SIZE, LEDGER_FLUSH_INTERVAL)
+metrics.collect('bot_ledger', lambda: ledger_queue.counters)
+
+
+# ====================== РАССЫЛКА ======================
+class BroadcastSender:
+    """Отправка рассылки: общий лимит Bot API, лимит на чат, повторы с экспоненциальной задержкой"""
+
+    def __init__(self, bot: Bot, concurrency: int, rate: float, per_chat_interval: float, retries: int,
+                 backoff: float = 1):
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.retries = retries
+        self.backoff = backoff  # Задержка перед первым повтором в секундах, далее удваивается
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate)
+        self._chat_buckets = LRUCache(10000)
+        self.stats: Dict[str, int] = defaultdict(int)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(1 / self.per_chat_interval, 1)
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def send(self, chat_id: int, text: str, **kwargs: Any) -> bool:
+        """Отправка одного сообщения; False - сообщение не доставлено"""
+        async with self._semaphore:
+            for attempt in range(self.retries):
+                await self._chat_bucket(chat_id).acquire()
+                await self._bucket.acquire()
+                try:
+                    await self.bot.send_message(chat_id, text, **kwargs)
+                    self.stats['sent'] += 1
+                    return True
+                except RetryAfter as e:
+                    # Лимит Bot API общий, поэтому приостанавливаем все отправки
+                    self.stats['retry_after'] += 1
+                    self._bucket.pause(e.timeout)
+                except (Unauthorized, ChatNotFound):
+                    # Бот заблокирован, удален или пользователь ни разу не начинал диалог - повтор не поможет
+                    self.stats['blocked'] += 1
+                    return False
+                except Exception as e:
+                    logger.error("Error sending message to %s: %s", chat_id, e)
+                    if attempt + 1 < self.retries:
+                        self.stats['retries'] += 1
+                        await asyncio.sleep(self.backoff * 2 ** attempt)
+        self.stats['failed'] += 1
+        return False
 
-async def check_referral(user_id: int, referrer_id: int):
+
+broadcast_sender = BroadcastSender(bot, SEND_CONCURRENCY, SEND_RATE, SEND_PER_CHAT_INTERVAL, SEND_RETRIES)
+metrics.collect('bot_broadcast', lambda: dict(broadcast_sender.stats))
+
+
+class WeeklyDigest:
+    """Недельная рассылка рейтинга пользователям с включенными уведомлениями.
+    Получатели читаются пачками по user_id; после каждой пачки сохраняется чекпоинт, и после сбоя
+    рассылка продолжается с него (сообщения незавершенной пачки могут прийти повторно)"""
+    WEEK_CHECKPOINT = 'weekly_digest_week'  # Неделя последней завершенной рассылки: год * 100 + номер недели
+
+    def __init__(self, sender: BroadcastSender, batch_size: int):
+        self.sender = sender
+        self.batch_size = batch_size
+        self.running = False
+        self.stats: Dict[str, float] = {}
+
+    async def run_if_due(self):
+        """Запуск рассылки, если наступило время и рассылка этой недели еще не завершена"""
+        now = datetime.now()
+        year, week, weekday = now.isocalendar()
+        if (weekday - 1, now.hour) < (DIGEST_WEEKDAY, DIGEST_HOUR):
+            return
+        week_id = year * 100 + week
+        if await get_checkpoint(self.WEEK_CHECKPOINT) == week_id:
+            return
+        await self.run(week_id)
+
+    @staticmethod
+    async def _position_lookup() -> Callable[[int], int]:
+        """Место по счету на всю рассылку: индекс рейтинга или один запрос счетов всех подписанных"""
+        if rank_index.ready:
+            return rank_index.position_for_score
+        async with db_pool.read() as db:
+            cursor = await db.execute('SELECT -score FROM users WHERE is_subscribed = 1 ORDER BY score DESC')
+            keys = [row[0] for row in await cursor.fetchall()]
+        return lambda score: bisect.bisect_left(keys, -score) + 1
+
+    @staticmethod
+    def render_header(top_users: List[Tuple]) -> str:
+        """Общая часть сообщения: топ-10, собирается один раз на рассылку"""
+        text = "📬 <b>Рейтинг за неделю</b>\n\n🏆 <b>Топ-10 участников</b>\n"
+        for idx, user in enumerate(top_users, 1):
+            name = user[2] if user[2] else f"@{user[1]}" if user[1] else f"ID:{user[0]}"
+            text += f"{idx}. {name} - {user[3]} баллов\n"
+        return text
+
+    @staticmethod
+    def render_user(score: int, position: Optional[int], previous: Optional[int]) -> str:
+        """Персональная часть сообщения: счет и изменение места с прошлой рассылки"""
+        if position is None:
+            return f"\n<b>Ваши баллы:</b> {score}\n❌ Вы не подписаны на канал и не участвуете в рейтинге"
+        if previous is None:
+            change = "🆕"
+        elif previous > position:
+            change = f"⬆️ +{previous - position}"
+        elif previous < position:
+            change = f"⬇️ -{position - previous}"
+        else:
+            change = "без изменений"
+        return f"\n<b>Ваши баллы:</b> {score}\n<b>Ваше место:</b> {position} ({change})"
+
+    async def run(self, week_id: int) -> Dict[str, float]:
+        """Рассылка за неделю week_id, продолжая с сохраненного чекпоинта"""
+        if self.running:
+            return self.stats
+        self.running = True
+        started = time.monotonic()
+        self.sender.stats = defaultdict(int)
+        checkpoint = f"weekly_digest_{week_id}"
+
+        try:
+            header = self.render_header(await get_top_users(10))
+            position_for_score = await self._position_lookup()
+            last_user_id = await get_checkpoint(checkpoint) or 0
+            if last_user_id:
+                logger.info("Resuming weekly digest after user %s", last_user_id)
+
+            while True:
+                async with db_pool.read() as db:
+                    cursor = await db.execute('''SELECT u.user_id, u.score, u.is_subscribed, d.position
+                                              FROM users u
+                                              LEFT JOIN notification_settings n ON n.user_id = u.user_id
+                                              LEFT JOIN weekly_digest d ON d.user_id = u.user_id
+                                              WHERE u.user_id > ? AND COALESCE(n.weekly_notifications, 1) = 1
+                                              ORDER BY u.user_id
+                                              LIMIT ?''', (last_user_id, self.batch_size))
+                    users = await cursor.fetchall()
+                if not users:
+                    break
+
+                positions = [position_for_score(score) if subscribed else None
+                             for _, score, subscribed, _ in users]
+                delivered = await asyncio.gather(*(
+                    self.sender.send(user_id, header + self.render_user(score, position, previous), parse_mode='HTML')
+                    for (user_id, score, _, previous), position in zip(users, positions)
+                ))
+
+                now = datetime.now()
+                async with db_pool.write() as db:
+                    await db.executemany('''INSERT OR REPLACE INTO weekly_digest (user_id, position, score, sent_at)
+                                            VALUES (?, ?, ?, ?)''',
+                                         [(user_id, position, score, now)
+                                          for (user_id, score, _, _), position, ok in zip(users, positions, delivered)
+                                          if ok])
+                    await set_checkpoint(checkpoint, users[-1][0], db=db)
+                last_user_id = users[-1][0]
+                logger.info("Weekly digest progress: %s", dict(self.sender.stats))
+
+            async with db_pool.write() as db:
+                await set_checkpoint(checkpoint, None, db=db)
+                await set_checkpoint(self.WEEK_CHECKPOINT, week_id, db=db)
+
+            self.stats = dict(self.sender.stats)
+            self.stats['rate'] = self.stats.get('sent', 0) / max(time.monotonic() - started, 1e-9)
+            logger.info("Weekly digest finished: %s", self.stats)
+            return self.stats
+        finally:
+            self.running = False
+
+
+weekly_digest = WeeklyDigest(broadcast_sender, DIGEST_BATCH_SIZE)
+
+
+# ====================== КОМАНДЫ ПОЛЬЗОВАТЕЛЯ ======================
+async def apply_channel_members(members: List[types.User], db: aiosqlite.Connection = None):
+    """Учет вступивших в канал: новые пользователи с баллом за подписку, вернувшиеся - снова подписаны"""
+    channel_members = {member.id: member for member in members if not member.is_bot}
+    if not channel_members:
+        return
+
+    async with db_pool.transaction(db) as db:
+        # Сравнение с базой в той же транзакции: регистрация через /start не успеет вклиниться
+        known = {}
+        member_ids = list(channel_members)
+        for i in range(0, len(member_ids), SQL_VARIABLES_LIMIT):
+            chunk = member_ids[i:i + SQL_VARIABLES_LIMIT]
+            cursor = await db.execute(f'''SELECT user_id, is_subscribed FROM users 
+                                      WHERE user_id IN ({', '.join('?' * len(chunk))})''', chunk)
+            known.update(await cursor.fetchall())
+
+        new_members = [member for user_id, member in channel_members.items() if user_id not in known]
+        resubscribed = [user_id for user_id, is_subscribed in known.items() if not is_subscribed]
+        if not new_members and not resubscribed:
+            return
+
+        # Добавляем новых подписчиков
+        await db.executemany('''INSERT INTO users 
+                             (user_id, username, full_name, referral_code, is_subscribed) 
+                             VALUES (?, ?, ?, ?, 1)''',
+                             [(member.id, member.username, member.full_name, f"ref_{member.id}")
+                              for member in new_members])
+        for member in new_members:
+            db_pool.on_commit(rank_index.add_user, member.id, 0, True)
+
+        # Начисляем баллы за подписку
+        await add_points_many([(member.id, 'subscription', 1, None) for member in new_members], db=db)
+
+        # Обновляем статус подписки вернувшихся
+        await db.executemany('UPDATE users SET is_subscribed = 1 WHERE user_id = ?',
+                             [(user_id,) for user_id in resubscribed])
+        for user_id in resubscribed:
+            db_pool.on_commit(rank_index.set_subscribed, user_id, True)
+
+        await stats_snapshots.invalidate(resubscribed, db)
+
+    logger.info("Channel members: %s new, %s resubscribed", len(new_members), len(resubscribed))
+
+
+@dp.chat_member_handler(lambda update: update.chat.id == CHANNEL_ID)
+async def on_channel_member(update: types.ChatMemberUpdated):
+    """Вступление в канал (обновления chat_member приходят, если бот - администратор канала)"""
+    joined = (update.new_chat_member.status in SUBSCRIBED_STATUSES
+              and update.old_chat_member.status not in SUBSCRIBED_STATUSES)
+    if joined:
+        ledger_queue.submit(apply_channel_members, [update.new_chat_member.user])
+
+
+async def check_referral(user_id: int, referrer_id: int, db: aiosqlite.Connection = None):
     """Проверка и обработка реферала"""
+    # Собственная ссылка и приглашение своего реферера (цикл) не засчитываются
+    if referral_graph.creates_cycle(referrer_id, user_id):
+        return False
+
     try:
-        async with aiosqlite.connect('ratings.db') as db:
+        async with db_pool.transaction(db) as db:
             # Проверяем, новый ли это реферал
-            cursor = await db.execute('''SELECT 1 FROM referrals 
-                                      WHERE referral_id = ? AND referrer_id = ?''',
-                                      (user_id, referrer_id))
-            if not await cursor.fetchone():
-                # Фиксируем реферала
-                await db.execute('''INSERT INTO referrals 
-                                  (referrer_id, referral_id, timestamp) 
-                                  VALUES (?, ?, ?)''',
-                                 (referrer_id, user_id, datetime.now()))
-
-                # Начисляем баллы рефереру
-                await add_points(referrer_id, 'referral')
-
-                await db.commit()
-                return True
-        return False
+            if referral_graph.ready:
+                if referral_graph.has_edge(referrer_id, user_id):
+                    return False
+            else:
+                cursor = await db.execute('''SELECT 1 FROM referrals 
+                                          WHERE referral_id = ? AND referrer_id = ?''',
+                                          (user_id, referrer_id))
+                if await cursor.fetchone():
+                    return False
+
+            # Фиксируем реферала
+            await db.execute('''INSERT INTO referrals 
+                              (referrer_id, referral_id, timestamp) 
+                              VALUES (?, ?, ?)''',
+                             (referrer_id, user_id, datetime.now()))
+            db_pool.on_commit(referral_graph.add_edge, referrer_id, user_id)
+
+            # Начисляем баллы рефереру в той же транзакции
+            await add_points(referrer_id, 'referral', db=db)
+            return True
     except Exception as e:
-        logger.error(f"Error processing referral: {e}")
+        logger.error("Error processing referral: %s", e)
         return False
 
 
+async def process_start(user_id: int, username: str, full_name: str, referrer_id: Optional[int],
+                        subscribed: Optional[bool], db: aiosqlite.Connection = None):
+    """Регистрация пользователя, реферал и статус подписки в одной транзакции"""
+    async with db_pool.transaction(db) as db:
+        # Регистрация пользователя
+        await register_user(user_id, username, full_name, db=db)
+
+        if referrer_id is not None:
+            await check_referral(user_id, referrer_id, db=db)
+
+        # Проверка подписки
+        if subscribed is not None:
+            await apply_subscription_status(user_id, subscribed, db=db)
+
+
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
     """Обработка команды /start"""
     user = message.from_user
 
-    # Регистрация пользователя
-    await register_user(user.id, user.username, user.full_name)
-
     # Обработка реферальной ссылки
+    referrer_id = None
     if len(message.get_args()) > 0 and message.get_args().startswith('ref_'):
         referrer_id = int(message.get_args().split('_')[1])
-        await check_referral(user.id, referrer_id)
 
-    # Проверка подписки
-    await check_subscription(user.id)
+    # Статус подписки запрашиваем до транзакции, чтобы не держать писателя во время запроса к API
+    subscribed = await get_subscription_status(user.id)
+
+    # Регистрация, реферал и подписка применяются одним событием очереди записи
+    try:
+        await ledger_queue.submit(process_start, user.id, user.username, user.full_name,
+                                  referrer_id, subscribed)
+    except Exception as e:
+        logger.error("Error processing /start: %s", e)
 
     # Приветственное сообщение
     await message.answer(
@@ -477,10 +2999,11 @@ async def cmd_start(message: types.Message):
 
 @dp.message_handler(commands=['stats'])
 @dp.message_handler(Text(equals="📊 Моя статистика"))
+@rate_limit(0.2, burst=2, key='stats', coalesce=True)
 async def cmd_stats(message: types.Message):
     """Показать статистику пользователя"""
+    # Снимок статистики содержит и реферальную информацию
     user_stats = await get_user_stats(message.from_user.id)
-    referral_info = await get_referral_info(message.from_user.id)
 
     action_descriptions = {
         'subscription': "Подписки",
@@ -499,8 +3022,8 @@ async def cmd_stats(message: types.Message):
     message_text += f"▫️ Создано: {user_stats['books_created']}\n"
 
     message_text += f"\n👥 <b>Рефералы:</b>\n"
-    message_text += f"▫️ Приглашено: {referral_info['referrals']}\n"
-    message_text += f"▫️ Заработано баллов: {referral_info['referral_points']}\n"
+    message_text += f"▫️ Приглашено: {user_stats['referrals']}\n"
+    message_text += f"▫️ Заработано баллов: {user_stats['referral_points']}\n"
 
     message_text += f"\n<b>Итого:</b> {user_stats['total_score']} баллов\n"
 
@@ -512,7 +3035,7 @@ async def cmd_stats(message: types.Message):
     message_text += f"<b>Подписка на канал:</b> {'✅' if user_stats['is_subscribed'] else '❌'}\n"
 
     # Генерируем диаграмму
-    chart_image = await generate_pie_chart(message.from_user.id)
+    chart_image = await generate_pie_chart(message.from_user.id, user_score=user_stats['total_score'])
 
     await message.answer_photo(
         photo=chart_image,
@@ -522,38 +3045,79 @@ async def cmd_stats(message: types.Message):
     )
 
 
-@dp.message_handler(commands=['leaderboard'])
-@dp.message_handler(Text(equals="🏆 Таблица лидеров"))
-async def cmd_leaderboard(message: types.Message):
-    """Показать таблицу лидеров"""
-    # Синхронизируем подписчиков перед показом рейтинга
-    await sync_channel_subscribers()
-
-    top_users = await get_top_users(10)
-    user_stats = await get_user_stats(message.from_user.id)
-
-    message_text = "🏆 <b>Топ-10 участников</b>\n\n"
-    for idx, user in enumerate(top_users, 1):
-        highlight = " <b>◄ ВЫ</b>" if user[0] == message.from_user.id else ""
-        name = user[2] if user[2] else f"@{user[1]}" if user[1] else f"ID:{user[0]}"
-        message_text += f"{idx}. {name} - {user[3]} баллов{highlight}\n"
-
-    if user_stats['position'] and user_stats['position'] > 10:
-        message_text += f"\n...\n{user_stats['position']}. Вы - {user_stats['total_score']} баллов\n"
-    elif not user_stats['is_subscribed']:
+async def render_leaderboard(user_id: int) -> str:
+    """Таблица лидеров для пользователя: общий топ из кэша и персональная часть"""
+    top_ids, top_lines = await leaderboard_cache.get()
+    lines = [f"{line} <b>◄ ВЫ</b>" if top_id == user_id else line for top_id, line in zip(top_ids, top_lines)]
+    message_text = "🏆 <b>Топ-10 участников</b>\n\n" + "".join(f"{line}\n" for line in lines)
+
+    position = await get_user_rank(user_id)
+    if position and position > len(top_ids):
+        # Показываем соседей пользователя по рейтингу
+        message_text += "\n...\n"
+        for neighbour_position, neighbour_id, username, full_name, score in await get_users_around(user_id):
+            if neighbour_id in top_ids:
+                continue
+            if neighbour_id == user_id:
+                message_text += f"{neighbour_position}. Вы - {score} баллов\n"
+            else:
+                name = full_name if full_name else f"@{username}" if username else f"ID:{neighbour_id}"
+                message_text += f"{neighbour_position}. {name} - {score} баллов\n"
+    elif position is None:
         message_text += "\n❌ Вы не подписаны на канал и не участвуете в рейтинге\n"
+    return message_text
+
 
+def get_leaderboard_keyboard() -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🔄 Обновить", callback_data='leaderboard_refresh'))
     keyboard.add(InlineKeyboardButton("📊 Моя статистика", callback_data='my_stats'))
     keyboard.add(InlineKeyboardButton("📥 Полный рейтинг (Excel)", callback_data='full_report'))
+    return keyboard
 
+
+@dp.message_handler(commands=['leaderboard'])
+@dp.message_handler(Text(equals="🏆 Таблица лидеров"))
+@rate_limit(0.2, burst=2, key='leaderboard', coalesce=True)
+async def cmd_leaderboard(message: types.Message):
+    """Показать таблицу лидеров"""
+    # Вступления в канал учитываются по обновлениям chat_member, здесь читаем текущее состояние базы
     await message.answer(
-        text=message_text,
+        text=await render_leaderboard(message.from_user.id),
         parse_mode='HTML',
-        reply_markup=keyboard
+        reply_markup=get_leaderboard_keyboard()
     )
 
 
+@dp.message_handler(commands=['progress'])
+@dp.message_handler(Text(equals="📈 Прогресс"))
+@rate_limit(0.2, burst=2, key='progress', coalesce=True)
+async def cmd_progress(message: types.Message):
+    """Показать графики счета и места за последние дни"""
+    user_id = message.from_user.id
+    version = db_pool.version
+
+    labels, scores, gained = await get_score_history(user_id, HISTORY_DAYS)
+    score_chart = InputFile(await generate_line_chart(('score', user_id, version), labels, scores,
+                                                      f"Баллы за {HISTORY_DAYS} дней"))
+    caption = (f"📈 <b>Прогресс за {HISTORY_DAYS} дней</b>\n"
+               f"Баллов сейчас: {scores[-1]}\n"
+               f"Начислено за период: {gained}")
+
+    # sendMediaGroup принимает от 2 до 10 элементов: без истории мест отправляем один график
+    days, positions = await get_rank_history(user_id, HISTORY_DAYS)
+    if not positions:
+        await message.answer_photo(score_chart, caption=caption, parse_mode='HTML')
+        await message.answer("🏆 График места появится после первого ежедневного снимка рейтинга")
+        return
+
+    media = types.MediaGroup()
+    media.attach_photo(score_chart, caption=caption, parse_mode='HTML')
+    media.attach_photo(InputFile(await generate_line_chart(('rank', user_id, days[-1]), days, positions,
+                                                           f"Место за {HISTORY_DAYS} дней", invert=True)))
+    await message.answer_media_group(media)
+
+
 @dp.message_handler(Text(equals="📢 Реферальная система"))
 async def cmd_referral(message: types.Message):
     """Показать реферальную информацию"""
@@ -568,10 +3132,18 @@ async def cmd_referral(message: types.Message):
         )
         return
 
+    # Сеть по уровням доступна, когда граф рефералов загружен в память
+    network = ""
+    if referral_graph.ready:
+        levels = referral_graph.downline_levels(message.from_user.id, REFERRAL_DEPTH)
+        if levels:
+            network = "Ваша сеть по уровням: " + " / ".join(str(count) for count in levels) + "\n"
+
     await message.answer(
         f"📢 <b>Реферальная система</b>\n\n"
         f"Ваш реферальный код: <code>{referral_info['referral_code']}</code>\n"
         f"Приглашено пользователей: {referral_info['referrals']}\n"
+        f"{network}"
         f"Заработано баллов: {referral_info['referral_points']}\n\n"
         f"<b>Как приглашать:</b>\n"
         f"1. Поделитесь этой ссылкой:\n"
@@ -591,7 +3163,7 @@ async def cmd_settings(message: types.Message):
     keyboard.add(InlineKeyboardButton("🔕 Выключить уведомления", callback_data='disable_notifications'))
 
     # Получаем текущий статус уведомлений
-    async with aiosqlite.connect('ratings.db') as db:
+    async with db_pool.read() as db:
         cursor = await db.execute('SELECT weekly_notifications FROM notification_settings WHERE user_id = ?',
                                   (message.from_user.id,))
         status = await cursor.fetchone()
@@ -618,16 +3190,119 @@ async def cmd_admin(message: types.Message):
         InlineKeyboardButton("➕ Начислить баллы", callback_data='admin_add_points'),
         InlineKeyboardButton("📊 Обновить рейтинг", callback_data='admin_update_leaderboard'),
         InlineKeyboardButton("📝 Добавить заказ", callback_data='admin_add_order'),
-        InlineKeyboardButton("📤 Экспорт в Excel", callback_data='admin_export_excel')
+        InlineKeyboardButton("📤 Экспорт в Excel", callback_data='admin_export_excel'),
+        InlineKeyboardButton("📥 Импорт заказов", callback_data='admin_import_orders'),
+        InlineKeyboardButton("🔬 Профилирование", callback_data='admin_profile')
     )
 
+    counters = throttling.counters
+    top_referrers = ""
+    if referral_graph.ready:
+        top_referrers = "".join(f"\n▫️ <code>{user_id}</code>: {count}"
+                                for user_id, count in referral_graph.top(TOP_REFERRERS))
+        if top_referrers:
+            top_referrers = "\n\n📢 Топ рефереров:" + top_referrers
     await message.answer(
-        "🛠 <b>Панель администратора</b>",
+        "🛠 <b>Панель администратора</b>\n\n"
+        f"🛡 Антифлуд: пропущено {counters['passed']}, ограничено {counters['throttled']}, "
+        f"объединено {counters['coalesced']}"
+        f"{top_referrers}",
         parse_mode='HTML',
         reply_markup=keyboard
     )
 
 
+@dp.callback_query_handler(lambda c: c.data == 'admin_update_leaderboard')
+async def process_admin_update_leaderboard(callback_query: CallbackQuery):
+    """Обработка обновления статусов подписки всех пользователей"""
+    if callback_query.from_user.id not in ADMIN_IDS:
+        await bot.answer_callback_query(callback_query.id)
+        return
+
+    if subscription_refresher.running:
+        await bot.answer_callback_query(callback_query.id, text="⏳ Обновление уже выполняется", show_alert=True)
+        return
+
+    await bot.answer_callback_query(callback_query.id, text="⏳ Обновление запущено")
+    stats = await update_all_subscribers()
+    await bot.send_message(
+        callback_query.from_user.id,
+        f"✅ Обновление завершено\n"
+        f"Проверено: {stats.get('checked', 0)}\n"
+        f"Изменено: {stats.get('changed', 0)}\n"
+        f"Ошибок: {stats.get('errors', 0)}\n"
+        f"Скорость: {stats.get('rate', 0):.1f} польз./сек"
+    )
+
+
+async def send_profile(chat_id: int):
+    """Ожидание окончания профилирования и отправка файла профиля"""
+    path, summary = await profiler.wait()
+    try:
+        if summary['mode'] == 'cprofile':
+            filename, hint = 'profile.pstats', "Открыть: python -m pstats profile.pstats или snakeviz"
+        else:
+            filename, hint = 'profile.collapsed', "Открыть: flamegraph.pl или speedscope.app"
+        caption = (f"🔬 Профиль {summary['mode']}: {summary['seconds']} сек, "
+                   f"обновлений: {summary['updates']}")
+        if 'samples' in summary:
+            caption += f", выборок: {summary['samples']}"
+        await bot.send_document(chat_id, InputFile(path, filename=filename), caption=f"{caption}\n{hint}")
+    except Exception as e:
+        logger.error("Error sending profile: %s", e)
+    finally:
+        os.remove(path)
+
+
+def start_profiling(chat_id: int, mode: str, seconds: float, updates: Optional[int] = None) -> bool:
+    """Запуск профилирования с отправкой результата в чат; False, если профилирование уже идет"""
+    if profiler.active:
+        return False
+    profiler.start(mode, seconds, updates)
+    asyncio.ensure_future(send_profile(chat_id))
+    return True
+
+
+@dp.message_handler(commands=['profile'])
+async def cmd_profile(message: types.Message):
+    """Профилирование: /profile [sample|cprofile] [секунды | N обновлений с суффиксом u, например 200u]"""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав доступа к этой команде.")
+        return
+
+    args = message.get_args().split()
+    mode = args.pop(0) if args and args[0] in PROFILE_MODES else 'sample'
+    seconds, updates = PROFILE_SECONDS, None
+    try:
+        if args and args[0].lower().endswith('u'):
+            updates = int(args[0][:-1])
+            seconds = PROFILE_MAX_SECONDS
+        elif args:
+            seconds = min(float(args[0]), PROFILE_MAX_SECONDS)
+    except ValueError:
+        await message.answer("❌ Формат: /profile [sample|cprofile] [секунды | N обновлений, например 200u]")
+        return
+
+    if not start_profiling(message.chat.id, mode, seconds, updates):
+        await message.answer("⏳ Профилирование уже выполняется")
+        return
+    limit = f"{updates} обновлений (не дольше {seconds:.0f} сек)" if updates else f"{seconds:.0f} сек"
+    await message.answer(f"🔬 Профилирование {mode} запущено: {limit}")
+
+
+@dp.callback_query_handler(lambda c: c.data == 'admin_profile')
+async def process_admin_profile(callback_query: CallbackQuery):
+    """Обработка кнопки профилирования: выборка стеков на PROFILE_SECONDS секунд"""
+    if callback_query.from_user.id not in ADMIN_IDS:
+        await bot.answer_callback_query(callback_query.id)
+        return
+
+    if not start_profiling(callback_query.from_user.id, 'sample', PROFILE_SECONDS):
+        await bot.answer_callback_query(callback_query.id, text="⏳ Профилирование уже выполняется", show_alert=True)
+        return
+    await bot.answer_callback_query(callback_query.id, text=f"🔬 Профилирование запущено на {PROFILE_SECONDS} сек")
+
+
 # ====================== ОБРАБОТКА ЗАКАЗОВ ======================
 @dp.callback_query_handler(lambda c: c.data == 'admin_add_order')
 async def process_admin_add_order(callback_query: CallbackQuery):
@@ -647,6 +3322,7 @@ async def process_admin_add_order(callback_query: CallbackQuery):
 @dp.message_handler(lambda message: message.text and message.text.split()[0].startswith('@')
                                     and len(message.text.split()) >= 3
                                     and message.from_user.id in ADMIN_IDS)
+@rate_limit(None)
 async def process_order_input(message: Message):
     """Обработка ввода данных заказа"""
     try:
@@ -656,24 +3332,155 @@ async def process_order_input(message: Message):
         created = int(parts[2])
 
         # Получаем user_id по username
-        async with aiosqlite.connect('ratings.db') as db:
+        async with db_pool.read() as db:
             cursor = await db.execute('SELECT user_id FROM users WHERE username = ?', (username,))
             user = await cursor.fetchone()
 
-            if user:
-                user_id = user[0]
-                await add_order(user_id, username, purchased, created)
-                await message.answer(f"✅ Заказ для @{username} успешно добавлен!\n"
-                                     f"Куплено: {purchased} книг\n"
-                                     f"Создано: {created} книг")
-            else:
-                await message.answer(f"❌ Пользователь @{username} не найден в базе")
+        if user:
+            user_id = user[0]
+            await ledger_queue.submit(add_order, user_id, username, purchased, created)
+            await message.answer(f"✅ Заказ для @{username} успешно добавлен!\n"
+                                 f"Куплено: {purchased} книг\n"
+                                 f"Создано: {created} книг")
+        else:
+            await message.answer(f"❌ Пользователь @{username} не найден в базе")
     except Exception as e:
         await message.answer(f"❌ Ошибка обработки заказа: {e}")
 
 
+def parse_orders_file(path: str, filename: str) -> Tuple[List[Tuple[int, str, int, int]], List[str]]:
+    """Потоковый разбор CSV/XLSX с колонками username, куплено, создано (выполняется в отдельном потоке)"""
+    if filename.lower().endswith('.xlsx'):
+        wb = load_workbook(path, read_only=True)
+        source = wb.active.iter_rows(values_only=True)
+    else:
+        wb = None
+        file = open(path, newline='', encoding='utf-8-sig')
+        try:
+            dialect = csv.Sniffer().sniff(file.read(4096), delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        file.seek(0)
+        source = csv.reader(file, dialect)
+
+    rows = []
+    errors = []
+    try:
+        for line_no, row in enumerate(source, 1):
+            values = [str(value).strip() if value is not None else '' for value in row]
+            if not any(values):
+                continue
+            try:
+                username = values[0].lstrip('@')
+                purchased = int(float(values[1] or 0)) if len(values) > 1 else 0
+                created = int(float(values[2] or 0)) if len(values) > 2 else 0
+            except ValueError:
+                # Первая строка может быть заголовком
+                if line_no > 1:
+                    errors.append(f"Строка {line_no}: неверные количества {values[1:3]}")
+                continue
+            if not username or purchased < 0 or created < 0 or (purchased == 0 and created == 0):
+                errors.append(f"Строка {line_no}: пустой username или количества")
+                continue
+            rows.append((line_no, username, purchased, created))
+    finally:
+        if wb is not None:
+            wb.close()
+        else:
+            file.close()
+
+    return rows, errors
+
+
+async def import_orders(rows: List[Tuple[int, str, int, int]],
+                        db: aiosqlite.Connection = None) -> Tuple[int, List[str]]:
+    """Импорт заказов одной транзакцией: (количество импортированных, ошибки по строкам)"""
+    # Разрешаем все username пачками запросов
+    usernames = list({row[1] for row in rows})
+    user_ids = {}
+    async with db_pool.read() as read_db:
+        for i in range(0, len(usernames), SQL_VARIABLES_LIMIT):
+            chunk = usernames[i:i + SQL_VARIABLES_LIMIT]
+            cursor = await read_db.execute(f'''SELECT username, user_id FROM users 
+                                           WHERE username IN ({', '.join('?' * len(chunk))})''', chunk)
+            user_ids.update(await cursor.fetchall())
+
+    errors = [f"Строка {line_no}: пользователь @{username} не найден в базе"
+              for line_no, username, _, _ in rows if username not in user_ids]
+    orders = [(user_ids[username], username, purchased, created)
+              for _, username, purchased, created in rows if username in user_ids]
+    if not orders:
+        return 0, errors
+
+    grants = []
+    for user_id, _, purchased, created in orders:
+        if purchased > 0:
+            grants.append((user_id, 'book_purchase', purchased, None))
+        if created > 0:
+            grants.append((user_id, 'book_creation', created, None))
+
+    now = datetime.now()
+    async with db_pool.transaction(db) as db:
+        await db.executemany('''INSERT INTO orders 
+                             (user_id, username, books_purchased, books_created, timestamp) 
+                             VALUES (?, ?, ?, ?, ?)''',
+                             [order + (now,) for order in orders])
+        await add_points_many(grants, db=db)
+        await stats_snapshots.invalidate(list({order[0] for order in orders}), db)
+
+    return len(orders), errors
+
+
+@dp.callback_query_handler(lambda c: c.data == 'admin_import_orders')
+async def process_admin_import_orders(callback_query: CallbackQuery):
+    """Обработка импорта заказов"""
+    await bot.answer_callback_query(callback_query.id)
+    await bot.send_message(
+        callback_query.from_user.id,
+        "📥 <b>Импорт заказов</b>\n\n"
+        "Отправьте файл CSV или XLSX с колонками:\n"
+        "<code>username, количество_купленных, количество_созданных</code>\n\n"
+        "Пример строки:\n"
+        "<code>@user123,2,1</code>",
+        parse_mode='HTML'
+    )
+
+
+@dp.message_handler(lambda message: message.from_user.id in ADMIN_IDS
+                                    and message.document.file_name
+                                    and message.document.file_name.lower().endswith(('.csv', '.xlsx')),
+                    content_types=types.ContentType.DOCUMENT)
+async def process_orders_file(message: Message):
+    """Обработка файла с заказами"""
+    filename = message.document.file_name
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+    os.close(fd)
+    started = time.monotonic()
+    try:
+        await message.document.download(destination_file=path)
+        rows, errors = await asyncio.get_running_loop().run_in_executor(None, parse_orders_file, path, filename)
+        imported, lookup_errors = await import_orders(rows)
+        errors += lookup_errors
+    except Exception as e:
+        await message.answer(f"❌ Ошибка импорта заказов: {e}")
+        return
+    finally:
+        os.remove(path)
+
+    elapsed = time.monotonic() - started
+    text = (f"✅ Импортировано заказов: {imported}\n"
+            f"Ошибок: {len(errors)}\n"
+            f"Время: {elapsed:.1f} сек ({(imported + len(errors)) / max(elapsed, 1e-9):.0f} строк/сек)")
+    if errors:
+        text += "\n\n" + "\n".join(errors[:20])
+        if len(errors) > 20:
+            text += f"\n...и еще {len(errors) - 20}"
+    await message.answer(text)
+
+
 # ====================== ОБРАБОТКА CALLBACK ======================
 @dp.callback_query_handler(lambda c: c.data == 'my_stats')
+@rate_limit(0.2, burst=2, key='stats', coalesce=True)
 async def process_callback_my_stats(callback_query: CallbackQuery):
     """Обработка кнопки 'Моя статистика'"""
     await cmd_stats(Message(
@@ -684,27 +3491,35 @@ async def process_callback_my_stats(callback_query: CallbackQuery):
     await bot.answer_callback_query(callback_query.id)
 
 
+@dp.callback_query_handler(lambda c: c.data == 'leaderboard_refresh')
+@rate_limit(0.2, burst=2, key='leaderboard', coalesce=True)
+async def process_callback_leaderboard_refresh(callback_query: CallbackQuery):
+    """Обработка кнопки 'Обновить': таблица лидеров обновляется в том же сообщении"""
+    try:
+        await callback_query.message.edit_text(
+            await render_leaderboard(callback_query.from_user.id),
+            parse_mode='HTML',
+            reply_markup=get_leaderboard_keyboard()
+        )
+    except MessageNotModified:
+        await bot.answer_callback_query(callback_query.id, text="Изменений нет")
+        return
+    await bot.answer_callback_query(callback_query.id)
+
+
 @dp.callback_query_handler(lambda c: c.data == 'full_report')
+@rate_limit(0.1, burst=1, key='report', coalesce=True)
 async def process_callback_full_report(callback_query: CallbackQuery):
     """Обработка кнопки 'Полный рейтинг'"""
-    excel_file = await generate_excel_report()
-    await bot.send_document(
-        chat_id=callback_query.message.chat.id,
-        document=InputFile(excel_file, filename='Рейтинг_участников.xlsx'),
-        caption="📊 Полный отчет по рейтингу участников"
-    )
+    await send_excel_report(callback_query.message.chat.id)
     await bot.answer_callback_query(callback_query.id)
 
 
 @dp.callback_query_handler(lambda c: c.data == 'admin_export_excel')
+@rate_limit(0.1, burst=1, key='report', coalesce=True)
 async def process_admin_export_excel(callback_query: CallbackQuery):
     """Обработка экспорта в Excel"""
-    excel_file = await generate_excel_report()
-    await bot.send_document(
-        chat_id=callback_query.message.chat.id,
-        document=InputFile(excel_file, filename='Рейтинг_участников.xlsx'),
-        caption="📊 Полный отчет по рейтингу участников"
-    )
+    await send_excel_report(callback_query.message.chat.id)
     await bot.answer_callback_query(callback_query.id)
 
 
@@ -713,12 +3528,11 @@ async def process_notification_settings(callback_query: CallbackQuery):
     """Обработка настроек уведомлений"""
     status = 1 if callback_query.data == 'enable_notifications' else 0
 
-    async with aiosqlite.connect('ratings.db') as db:
+    async with db_pool.write() as db:
         await db.execute('''INSERT OR REPLACE INTO notification_settings 
                           (user_id, weekly_notifications) 
                           VALUES (?, ?)''',
                          (callback_query.from_user.id, status))
-        await db.commit()
 
     await bot.answer_callback_query(
         callback_query.id,
@@ -738,57 +3552,329 @@ async def get_main_menu_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton("📊 Моя статистика"), KeyboardButton("🏆 Таблица лидеров")],
-            [KeyboardButton("📢 Реферальная система"), KeyboardButton("⚙️ Настройки")]
+            [KeyboardButton("📢 Реферальная система"), KeyboardButton("⚙️ Настройки")],
+            [KeyboardButton("📈 Прогресс")]
         ],
         resize_keyboard=True
     )
 
 
-async def generate_excel_report() -> BytesIO:
-    """Генерация Excel-отчета"""
-    async with aiosqlite.connect('ratings.db') as db:
-        cursor = await db.execute('''SELECT user_id, username, full_name, score, referrals, is_subscribed
-                                 FROM users 
-                                 ORDER BY score DESC''')
-        users = await cursor.fetchall()
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Рейтинг участников"
-        ws.append(["Место", "ID", "Username", "Имя", "Баллы", "Рефералов", "Подписка", "Куплено книг", "Создано книг"])
-
-        for idx, user in enumerate(users, 1):
-            cursor = await db.execute('''SELECT SUM(books_purchased), SUM(books_created) 
-                                     FROM orders WHERE user_id = ?''', (user[0],))
-            order_stats = await cursor.fetchone()
-            purchased = order_stats[0] if order_stats and order_stats[0] else 0
-            created = order_stats[1] if order_stats and order_stats[1] else 0
-
-            ws.append([
-                idx,
-                user[0],
-                user[1],
-                user[2],
-                user[3],
-                user[4],
-                "Да" if user[5] else "Нет",
-                purchased,
-                created
-            ])
-
-        excel_file = BytesIO()
-        wb.save(excel_file)
-        excel_file.seek(0)
-
-        return excel_file
+EXCEL_REPORT_QUERY = '''SELECT u.user_id, u.username, u.full_name, u.score, u.referrals, u.is_subscribed,
+                             COALESCE(o.purchased, 0), COALESCE(o.created, 0)
+                      FROM users u
+                      LEFT JOIN (SELECT user_id,
+                                        SUM(books_purchased) AS purchased,
+                                        SUM(books_created) AS created
+                                 FROM (SELECT user_id, books_purchased, books_created FROM orders
+                                       UNION ALL
+                                       SELECT user_id, books_purchased, books_created FROM order_summaries)
+                                 GROUP BY user_id) o ON o.user_id = u.user_id
+                      ORDER BY u.score DESC'''
+
+
+def write_excel_report(path: str):
+    """Потоковая запись отчета в XLSX (выполняется в отдельном потоке)"""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Рейтинг участников")
+    ws.append(["Место", "ID", "Username", "Имя", "Баллы", "Рефералов", "Подписка", "Куплено книг", "Создано книг"])
+
+    # Отдельное соединение только на чтение: курсор читается кусками в этом же потоке
+    db = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    try:
+        cursor = db.execute(EXCEL_REPORT_QUERY)
+        idx = 0
+        while True:
+            users = cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not users:
+                break
+
+            for user in users:
+                idx += 1
+                ws.append([
+                    idx,
+                    user[0],
+                    user[1],
+                    user[2],
+                    user[3],
+                    user[4],
+                    "Да" if user[5] else "Нет",
+                    user[6],
+                    user[7]
+                ])
+    finally:
+        db.close()
+
+    wb.save(path)
+
+
+async def generate_excel_report() -> str:
+    """Генерация Excel-отчета во временный файл, возвращает путь к нему"""
+    fd, path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, write_excel_report, path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+class ReportCache:
+    """Кэш файла отчета: одна сборка на версию данных для всех конкурентных запросов"""
+
+    def __init__(self, build: Callable, filename: str, ttl: float = 0):
+        self._build = build
+        self.filename = filename
+        self.ttl = ttl
+        self._path: Optional[str] = None
+        self._version = -1
+        self._built_at = 0.0
+        self._generation = 0
+        self._file_id: Optional[str] = None
+        self._inflight: Optional[asyncio.Future] = None
+
+    def _is_fresh(self) -> bool:
+        if self._path is None:
+            return False
+        return self._version == db_pool.version or time.monotonic() - self._built_at < self.ttl
+
+    async def _rebuild(self):
+        version = db_pool.version
+        path = await self._build()
+        if self._path:
+            # Отправки открывают файл сразу при создании InputFile, поэтому старый файл можно удалить
+            os.remove(self._path)
+        self._path = path
+        self._version = version
+        self._built_at = time.monotonic()
+        self._generation += 1
+        self._file_id = None
+
+    async def get(self) -> Tuple[int, Any]:
+        """Актуальный отчет: (поколение, file_id уже загруженного файла или InputFile)"""
+        if not self._is_fresh():
+            if self._inflight is None:
+                self._inflight = asyncio.ensure_future(self._rebuild())
+                self._inflight.add_done_callback(self._clear_inflight)
+            await asyncio.shield(self._inflight)
+
+        if self._file_id:
+            return self._generation, self._file_id
+        return self._generation, InputFile(self._path, filename=self.filename)
+
+    def _clear_inflight(self, future: asyncio.Future):
+        self._inflight = None
+
+    def set_file_id(self, generation: int, file_id: str):
+        """Запоминание file_id, который Telegram вернул для загруженного отчета"""
+        if generation == self._generation:
+            self._file_id = file_id
+
+    def close(self):
+        if self._path:
+            os.remove(self._path)
+            self._path = None
+
+
+report_cache = ReportCache(generate_excel_report, 'Рейтинг_участников.xlsx', ttl=REPORT_CACHE_TTL)
+
+
+async def send_excel_report(chat_id: int):
+    """Отправка полного отчета: повторные отправки используют file_id без загрузки файла"""
+    generation, document = await report_cache.get()
+    message = await bot.send_document(
+        chat_id=chat_id,
+        document=document,
+        caption="📊 Полный отчет по рейтингу участников"
+    )
+    if message.document:
+        report_cache.set_file_id(generation, message.document.file_id)
+
+
+# ====================== ФОНОВЫЕ ЗАДАЧИ ======================
+background_tasks: List[asyncio.Task] = []
+
+
+async def run_periodically(interval: float, job: Callable):
+    """Периодический запуск задачи; ошибки логируются и не останавливают цикл"""
+    while True:
+        try:
+            await job()
+        except Exception as e:
+            logger.error("Error in background job %s: %s", job.__name__, e)
+        await asyncio.sleep(interval)
+
+
+def start_background_job(interval: float, job: Callable):
+    """Запуск периодической задачи в фоне"""
+    background_tasks.append(asyncio.ensure_future(run_periodically(interval, job)))
+
+
+async def run_once(job: Callable):
+    """Однократный запуск задачи; ошибка логируется"""
+    try:
+        await job()
+    except Exception as e:
+        logger.error("Error in background job %s: %s", job.__name__, e)
+
+
+def run_in_background(job: Callable):
+    """Однократный запуск задачи в фоне (отменяется при остановке вместе с периодическими)"""
+    background_tasks.append(asyncio.ensure_future(run_once(job)))
+
+
+async def stop_background_jobs():
+    """Остановка фоновых задач"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
 
 
 # ====================== ЗАПУСК БОТА ======================
 async def on_startup(dp):
     """Действия при запуске бота"""
+    global chart_executor
+    # spawn: не наследуем потоки aiosqlite и состояние цикла событий в дочерние процессы
+    chart_executor = ProcessPoolExecutor(max_workers=CHART_WORKERS,
+                                         mp_context=multiprocessing.get_context('spawn'))
+    await db_pool.open()
     await init_db()
-    logger.info("Бот успешно запущен")
+    await action_rollups.load_state()
+    if WORKER_INDEX == 0:
+        await rebuild_total_score()
+        start_background_job(DIGEST_CHECK_INTERVAL, weekly_digest.run_if_due)
+        start_background_job(RANK_HISTORY_INTERVAL, snapshot_rank_history)
+        run_in_background(action_rollups.backfill)
+        start_background_job(COMPACTION_INTERVAL, ledger_archive.compact)
+    await rank_index.load()
+    await referral_graph.load()
+    if WEB_WORKERS > 1:
+        # Записи других процессов видны по data_version: кэши сбрасываются сразу,
+        # рейтинг и граф в памяти досинхронизируются не реже MEMORY_INDEX_REFRESH_INTERVAL
+        start_background_job(DATA_VERSION_POLL_INTERVAL, db_pool.poll_remote_changes)
+        start_background_job(MEMORY_INDEX_REFRESH_INTERVAL, refresh_memory_indexes)
+    ledger_queue.start()
+    instrument_handlers(dp)
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_HOST, METRICS_PORT + WORKER_INDEX)
+    logger.info("Бот успешно запущен (процесс %s)", WORKER_INDEX)
+
+
+async def on_shutdown(dp):
+    """Действия при остановке бота"""
+    await stop_background_jobs()
+    await stop_metrics_server()
+    await ledger_queue.stop()
+    chart_executor.shutdown(wait=False, cancel_futures=True)
+    report_cache.close()
+    await db_pool.close()
+    logger.info("Бот остановлен")
+
+
+# ====================== WEBHOOK ======================
+class WebhookServer:
+    """Прием обновлений по webhook: конкурентная обработка с ограничением и плавной остановкой.
+    Для локальной проверки достаточно отправить POST с JSON обновления на WEBHOOK_PATH"""
+
+    def __init__(self, dispatcher: Dispatcher, path: str, secret: str, max_in_flight: int):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.max_in_flight = max_in_flight
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Прием обновления: ответ Telegram сразу, обработка в отдельной задаче"""
+        if self.secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret:
+            return web.Response(status=403)
+
+        update = types.Update(**(await request.json()))
+
+        # При достижении лимита ответ задерживается, и Telegram сам снижает темп доставки
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: types.Update):
+        try:
+            Bot.set_current(self.dispatcher.bot)
+            Dispatcher.set_current(self.dispatcher)
+            await self.dispatcher.process_update(update)
+        except Exception as e:
+            logger.error("Error processing update %s: %s", update.update_id, e)
+        finally:
+            self._semaphore.release()
+
+    async def _on_startup(self, app: web.Application):
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        await on_startup(self.dispatcher)
+        if WEBHOOK_URL and WORKER_INDEX == 0:
+            await self.dispatcher.bot.set_webhook(WEBHOOK_URL + self.path,
+                                                  secret_token=self.secret or None,
+                                                  max_connections=self.max_in_flight,
+                                                  allowed_updates=ALLOWED_UPDATES,
+                                                  drop_pending_updates=True)
+
+    async def _on_shutdown(self, app: web.Application):
+        # Сервер уже не принимает запросы: дожидаемся начатых обработчиков
+        if self._tasks:
+            logger.info("Waiting for %s pending updates", len(self._tasks))
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _on_cleanup(self, app: web.Application):
+        await on_shutdown(self.dispatcher)
+        session = await self.dispatcher.bot.get_session()
+        await session.close()
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        app.on_startup.append(self._on_startup)
+        app.on_shutdown.append(self._on_shutdown)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+def run_webhook_worker(index: int):
+    """Процесс webhook-сервера; при нескольких процессах порт делится через SO_REUSEPORT"""
+    global WORKER_INDEX
+    WORKER_INDEX = index
+    webhook_server = WebhookServer(dp, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_MAX_IN_FLIGHT)
+    web.run_app(webhook_server.make_app(), host=WEBHOOK_HOST, port=WEBHOOK_PORT,
+                reuse_port=WEB_WORKERS > 1)
+
+
+def run_webhook_workers(count: int):
+    """Запуск count процессов webhook-сервера; SIGTERM и Ctrl+C передаются процессам для плавной остановки.
+    Записи из разных процессов упорядочивает блокировка SQLite (BEGIN IMMEDIATE и busy_timeout): каждый процесс
+    пишет пачками через свою очередь записи. По benchmarks/bench_workers.py запись не масштабируется дальше
+    ~2 процессов (один файл - один писатель), ошибок блокировки нет, но p99 ожидания commit при 4-8 процессах
+    растет до секунд; обработчики commit не ждут, поэтому процессов имеет смысл ставить по нагрузке чтения"""
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_webhook_worker, args=(index,), name=f"webhook-worker-{index}")
+               for index in range(count)]
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
 
 
 if __name__ == '__main__':
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
\ No newline at end of file
+    if WEB_WORKERS > 1:
+        run_webhook_workers(WEB_WORKERS)
+    elif BOT_MODE == 'webhook':
+        run_webhook_worker(0)
+    else:
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True,
+                               allowed_updates=ALLOWED_UPDATES)
\ No newline at end of file
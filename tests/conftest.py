@@ -0,0 +1,34 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def db(loop, tmp_path, monkeypatch):
+    """Пул соединений к новой базе во временном каталоге со всеми миграциями"""
+    monkeypatch.chdir(tmp_path)
+    main.rank_index.__init__()
+    main.referral_graph.__init__()
+    main.stats_snapshots.memory.clear()
+    loop.run_until_complete(main.db_pool.open())
+    loop.run_until_complete(main.init_db())
+    loop.run_until_complete(main.action_rollups.load_state())
+    main.ledger_queue.start()
+    yield main.db_pool
+    loop.run_until_complete(main.ledger_queue.stop())
+    loop.run_until_complete(main.db_pool.close())
@@ -0,0 +1,20 @@
+"""Запись через очередь фиксирует аргументы в момент вызова, а не в потоке записи"""
+import logging
+import queue
+
+import main
+
+
+def test_queue_handler_snapshots_arguments():
+    records = queue.SimpleQueue()
+    handler = main.DeferredQueueHandler(records)
+    stats = {'checked': 1}
+    record = logging.LogRecord('main', logging.INFO, __file__, 1, "Progress: %s", (stats,), None)
+    record.user_id = 7
+
+    handler.emit(record)
+    stats['checked'] = 2
+    queued = records.get_nowait()
+
+    assert queued.getMessage() == "Progress: {'checked': 1}"
+    assert '"user_id": 7' in main.JsonFormatter().format(queued)
@@ -0,0 +1,28 @@
+"""Метрики запросов к базе: события очереди записи учитываются в счетчике поставившего их обработчика,
+задержка запросов размечена именем вызвавшей функции"""
+import asyncio
+
+import main
+
+
+def test_ledger_queries_counted_for_handler(db, loop):
+    async def handler():
+        await main.ledger_queue.submit(main.add_points, 1, 'subscription')
+        main.ledger_queue.submit(main.add_points, 1, 'subscription')  # Без ожидания commit
+
+    async def scenario():
+        async with main.db_pool.write() as db:
+            await db.execute('INSERT INTO users (user_id, score, is_subscribed) VALUES (1, 0, 1)')
+        await main.instrumented(handler)()
+        await asyncio.sleep(main.LEDGER_FLUSH_INTERVAL * 5)
+
+    main.handler_db_queries._values.clear()
+    main.db_query_seconds._values.clear()
+    loop.run_until_complete(scenario())
+    _, total, count = main.handler_db_queries._values[('handler',)]
+    assert count == 1
+    assert total >= 4  # Каждое начисление - несколько запросов внутри события
+
+    helpers = {helper for helper, _ in main.db_query_seconds._values}
+    assert 'add_points_many' in helpers
+    assert 'execute' not in helpers and '_traced' not in helpers
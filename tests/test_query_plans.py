@@ -0,0 +1,91 @@
+"""Регрессия планов запросов: запросы горячих путей не должны читать таблицы целиком"""
+import re
+
+import main
+
+# Строка плана без индекса: "SCAN users" или "SCAN u" (псевдоним), но не подзапрос и не CONSTANT ROW
+FULL_SCAN = re.compile(r'^SCAN (?!\(|CONSTANT ROW)(\S+)$')
+
+
+def record_queries(monkeypatch):
+    """Запоминание (sql, параметры) всех запросов, прошедших через TracedConnection"""
+    queries = []
+    traced = main.TracedConnection._traced
+
+    async def recording(self, method, sql, parameters):
+        if method.__name__ == 'executemany':
+            # Для плана достаточно первого набора параметров
+            parameters = list(parameters)
+            queries.append((sql, parameters[0] if parameters else None))
+        else:
+            queries.append((sql, parameters))
+        return await traced(self, method, sql, parameters)
+
+    monkeypatch.setattr(main.TracedConnection, '_traced', recording)
+    return queries
+
+
+async def seed():
+    for user_id in range(1, 21):
+        await main.ledger_queue.submit(main.process_start, user_id, f'user{user_id}', f'User {user_id}',
+                                       1 if user_id > 1 else None, user_id % 2 == 0)
+    await main.ledger_queue.submit(main.add_order, 2, 'user2', 3, 1)
+    await main.snapshot_rank_history()
+
+
+async def hot_paths():
+    """Запросы, выполняемые при обработке обновлений пользователей"""
+    await main.ledger_queue.submit(main.process_start, 21, 'user21', 'User 21', 2, True)
+    await main.ledger_queue.submit(main.process_referral, 22, 4)
+    await main.ledger_queue.submit(main.add_points, 4, 'comment')
+    await main.ledger_queue.submit(main.add_order, 4, 'user4', 1, 0)
+    await main.ledger_queue.submit(main.apply_subscription_status, 3, True)
+    await main.ledger_queue.submit(main.apply_subscription_status, 3, False)
+    await main.import_orders([(1, 'user6', 1, 1), (2, 'missing', 1, 0)])
+
+    for user_id in (2, 3, 99):
+        await main.get_user_stats(user_id)
+        await main.get_user_rank(user_id)
+        await main.get_users_around(user_id, 2)
+        await main.get_score_history(user_id, main.HISTORY_DAYS)
+        await main.get_rank_history(user_id, main.HISTORY_DAYS)
+    await main.get_top_users(10)
+    await main.render_leaderboard(2)
+
+    storage = main.SQLiteStorage()
+    await storage.set_state(chat=2, user=2, state='Form:order')
+    await storage.update_data(chat=2, user=2, data={'step': 1})
+    await storage.get_state(chat=2, user=2)
+    await storage.get_data(chat=2, user=2)
+    await storage.reset_state(chat=2, user=2)
+
+    # Очередь выполняет события по порядку: после этого записаны и отложенные снимки статистики
+    await main.ledger_queue.submit(main.set_checkpoint, 'query_plans', None)
+
+
+def explain(loop, sql, parameters):
+    async def plan():
+        async with main.db_pool.read() as db:
+            cursor = await db.execute(f'EXPLAIN QUERY PLAN {sql}', parameters or ())
+            return [row[3] for row in await cursor.fetchall()]
+
+    return loop.run_until_complete(plan())
+
+
+def test_hot_queries_use_indexes(db, loop, monkeypatch):
+    loop.run_until_complete(seed())
+    queries = record_queries(monkeypatch)
+    loop.run_until_complete(hot_paths())
+
+    statements = {}
+    for sql, parameters in queries:
+        if sql.split(None, 1)[0].upper() in ('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH'):
+            statements.setdefault(' '.join(sql.split()), (sql, parameters))
+    assert len(statements) > 20
+
+    scans = []
+    for normalized, (sql, parameters) in statements.items():
+        for detail in explain(loop, sql, parameters):
+            if FULL_SCAN.match(detail):
+                scans.append(f'{detail}: {normalized}')
+    assert not scans, '\n'.join(scans)
@@ -0,0 +1,25 @@
+"""Снимки мест: один раз в день, старше HISTORY_DAYS дней удаляются"""
+from datetime import date, timedelta
+
+import main
+
+
+def test_snapshot_prunes_old_days(db, loop):
+    today = date.today()
+    old_day = (today - timedelta(days=main.HISTORY_DAYS)).isoformat()
+    kept_day = (today - timedelta(days=main.HISTORY_DAYS - 1)).isoformat()
+
+    async def scenario():
+        async with main.db_pool.write() as db:
+            await db.executemany('INSERT INTO users (user_id, score, is_subscribed) VALUES (?, ?, 1)',
+                                 [(1, 10), (2, 20)])
+            await db.executemany('INSERT INTO rank_history (user_id, day, position, score) VALUES (?, ?, ?, ?)',
+                                 [(1, old_day, 1, 5), (1, kept_day, 1, 8)])
+        await main.snapshot_rank_history()
+        async with main.db_pool.read() as db:
+            cursor = await db.execute('SELECT user_id, day, position FROM rank_history ORDER BY day, user_id')
+            return await cursor.fetchall()
+
+    assert loop.run_until_complete(scenario()) == [
+        (1, kept_day, 1), (1, today.isoformat(), 2), (2, today.isoformat(), 1)
+    ]
@@ -0,0 +1,137 @@
+"""Рейтинг в памяти должен совпадать с SQL-версией, включая равные счета и смену подписки"""
+import bisect
+import random
+
+import aiosqlite
+
+import main
+
+
+async def seed(rng, count):
+    async with main.db_pool.write() as db:
+        await db.executemany('''INSERT INTO users (user_id, username, score, is_subscribed)
+                             VALUES (?, ?, ?, ?)''',
+                             [(user_id, f'user{user_id}', rng.randrange(10), rng.random() < 0.7)
+                              for user_id in range(1, count + 1)])
+
+
+async def ranking(user_ids):
+    """Места, соседи и топ для списка пользователей"""
+    return {
+        'top': await main.get_top_users(15),
+        'positions': [await main.get_user_position(user_id) for user_id in user_ids],
+        'ranks': [await main.get_user_rank(user_id) for user_id in user_ids],
+        'around': [await main.get_users_around(user_id, 2) for user_id in user_ids
+                   if await main.get_user_rank(user_id) is not None]
+    }
+
+
+async def compare(user_ids):
+    indexed = await ranking(user_ids)
+    main.rank_index.ready = False
+    try:
+        plain = await ranking(user_ids)
+    finally:
+        main.rank_index.ready = True
+    assert indexed == plain
+
+
+def test_rank_index_matches_sql(db, loop):
+    rng = random.Random(451)
+    count = 200
+    user_ids = list(range(1, count + 1)) + [count + 1]  # Последний - неизвестный пользователь
+
+    async def scenario():
+        await seed(rng, count)
+        await main.rank_index.load()
+        await compare(user_ids)
+
+        for _ in range(10):
+            for _ in range(20):
+                user_id = rng.randrange(1, count + 1)
+                if rng.random() < 0.6:
+                    await main.ledger_queue.submit(main.add_points, user_id, rng.choice(list(main.POINT_SYSTEM)))
+                else:
+                    subscribed = not main.rank_index.is_subscribed(user_id)
+                    await main.ledger_queue.submit(main.apply_subscription_status, user_id, subscribed)
+            await compare(user_ids)
+
+        # Новый пользователь попадает в индекс после регистрации
+        await main.ledger_queue.submit(main.process_start, count + 1, 'new', 'New', None, True)
+        await compare(user_ids)
+
+    loop.run_until_complete(scenario())
+
+
+def test_ties_share_position(db, loop):
+    async def scenario():
+        async with main.db_pool.write() as db:
+            await db.executemany('INSERT INTO users (user_id, score, is_subscribed) VALUES (?, ?, 1)',
+                                 [(1, 5), (2, 7), (3, 5), (4, 5), (5, 1)])
+        await main.rank_index.load()
+        assert [await main.get_user_position(user_id) for user_id in range(1, 6)] == [2, 1, 2, 2, 5]
+        await compare(range(1, 6))
+
+    loop.run_until_complete(scenario())
+
+
+def test_sorted_keys_matches_list():
+    rng = random.Random(7)
+    keys = sorted({(-rng.randrange(50), user_id) for user_id in range(100)})
+    plain = list(keys)
+    blocks = main.SortedKeys(keys, load=3)
+
+    for _ in range(3000):
+        key = (-rng.randrange(60), rng.randrange(150))
+        if rng.random() < 0.5 and key not in plain:
+            blocks.add(key)
+            plain.insert(bisect.bisect_left(plain, key), key)
+        else:
+            if rng.random() < 0.5 and plain:
+                key = rng.choice(plain)
+            blocks.discard(key)
+            if key in plain:
+                plain.remove(key)
+
+        probe = (-rng.randrange(60),)
+        start = rng.randrange(-2, len(plain) + 2)
+        assert len(blocks) == len(plain)
+        assert blocks.bisect_left(probe) == bisect.bisect_left(plain, probe)
+        assert blocks.islice(start, start + 5) == plain[max(start, 0):start + 5]
+
+    # Удаление всех ключей и вставка в пустой список
+    for key in list(plain):
+        blocks.discard(key)
+    assert len(blocks) == 0 and blocks.islice(0, 10) == []
+    blocks.add((0, 1))
+    assert blocks.islice(0, 10) == [(0, 1)]
+
+
+def test_refresh_applies_remote_writes(db, loop):
+    rng = random.Random(45)
+    count = 50
+
+    async def scenario():
+        await seed(rng, count)
+        await main.rank_index.load()
+        await main.db_pool.poll_remote_changes()
+
+        # Запись другого процесса - отдельное соединение к тому же файлу
+        remote = await aiosqlite.connect(main.DB_PATH)
+        try:
+            await remote.execute('UPDATE users SET score = score + 7 WHERE user_id <= 10')
+            await remote.execute('UPDATE users SET is_subscribed = NOT is_subscribed WHERE user_id > 40')
+            await remote.execute("INSERT INTO users (user_id, score, is_subscribed) VALUES (?, 3, 1)", (count + 1,))
+            await remote.commit()
+        finally:
+            await remote.close()
+        # Своя запись тоже попадает в журнал и не должна откатиться при сверке
+        await main.ledger_queue.submit(main.add_points, 20, 'subscription')
+
+        await main.db_pool.poll_remote_changes()
+        assert main.rank_index.stale
+        await main.refresh_memory_indexes()
+        assert not main.rank_index.stale
+        await compare(range(1, count + 2))
+
+    loop.run_until_complete(scenario())
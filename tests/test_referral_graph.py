@@ -0,0 +1,60 @@
+"""Топ рефереров в памяти совпадает с числом подписавшихся приглашенных в таблице referrals,
+в том числе после записей другого процесса"""
+import random
+
+import aiosqlite
+
+import main
+
+TOP_SQL = '''SELECT referrer_id, COUNT(*) FROM referrals WHERE subscribed = 1
+             GROUP BY referrer_id ORDER BY COUNT(*) DESC, referrer_id'''
+
+
+async def expected_top(limit):
+    async with main.db_pool.read() as db:
+        cursor = await db.execute(TOP_SQL)
+        return (await cursor.fetchall())[:limit]
+
+
+def test_top_counts_subscribed_referrals(db, loop):
+    rng = random.Random(25)
+    count = 60
+
+    async def scenario():
+        async with main.db_pool.write() as db:
+            await db.executemany('INSERT INTO users (user_id, score, is_subscribed) VALUES (?, 0, ?)',
+                                 [(user_id, user_id <= 10) for user_id in range(1, count + 1)])
+            # Связи до загрузки графа, часть приглашенных уже подписана
+            for referral_id in range(11, 31):
+                await db.execute('INSERT INTO referrals (referrer_id, referral_id, subscribed) VALUES (?, ?, ?)',
+                                 (rng.randrange(1, 11), referral_id, rng.random() < 0.5))
+        await main.referral_graph.load()
+        assert main.referral_graph.top(10) == await expected_top(10)
+
+        # Новые приглашения и подписки через очередь записи
+        for referral_id in range(31, count + 1):
+            await main.ledger_queue.submit(main.check_referral, referral_id, rng.randrange(1, 11))
+        for referral_id in rng.sample(range(11, count + 1), 30):
+            await main.ledger_queue.submit(main.apply_subscription_status, referral_id, True)
+        assert main.referral_graph.top(10) == await expected_top(10)
+        assert all(count > 0 for _, count in main.referral_graph.top(100))
+
+        # Другой процесс добавляет связь и подписывает приглашенных
+        await main.db_pool.poll_remote_changes()
+        remote = await aiosqlite.connect(main.DB_PATH)
+        try:
+            await remote.execute('INSERT INTO referrals (referrer_id, referral_id) VALUES (5, 1)')
+            cursor = await remote.execute('SELECT referral_id FROM referrals WHERE subscribed = 0')
+            pending = [row[0] for row in await cursor.fetchall()]
+            for referral_id in pending:
+                await remote.execute('UPDATE users SET is_subscribed = 1 WHERE user_id = ?', (referral_id,))
+                await remote.execute('UPDATE referrals SET subscribed = 1 WHERE referral_id = ?', (referral_id,))
+            await remote.commit()
+        finally:
+            await remote.close()
+        await main.db_pool.poll_remote_changes()
+        await main.refresh_memory_indexes()
+        assert main.referral_graph.top(100) == await expected_top(100)
+        assert main.referral_graph.has_edge(5, 1)
+
+    loop.run_until_complete(scenario())
@@ -0,0 +1,83 @@
+"""Массовая проверка подписок на заглушке Bot: статусы, RetryAfter, конкурентность и чекпоинт"""
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.utils.exceptions import RetryAfter
+
+import main
+
+
+class FakeBot:
+    """get_chat_member без сети: подписаны пользователи из subscribed, для retry_after - один RetryAfter"""
+
+    def __init__(self, subscribed, retry_after=(), failing=()):
+        self.subscribed = set(subscribed)
+        self.retry_after = set(retry_after)
+        self.failing = set(failing)
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.calls.append(user_id)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if user_id in self.retry_after:
+                self.retry_after.discard(user_id)
+                raise RetryAfter(1)
+            if user_id in self.failing:
+                raise RuntimeError('network error')
+            return SimpleNamespace(status='member' if user_id in self.subscribed else 'left')
+        finally:
+            self.in_flight -= 1
+
+
+async def seed(subscribed):
+    async with main.db_pool.write() as db:
+        await db.executemany('INSERT INTO users (user_id, is_subscribed) VALUES (?, ?)',
+                             [(user_id, user_id in subscribed) for user_id in range(1, 21)])
+
+
+async def subscribed_ids():
+    async with main.db_pool.read() as db:
+        cursor = await db.execute('SELECT user_id FROM users WHERE is_subscribed = 1 ORDER BY user_id')
+        return [row[0] for row in await cursor.fetchall()]
+
+
+def test_refresh_applies_changes(db, loop):
+    bot = FakeBot(subscribed=range(1, 11), retry_after={3}, failing={20})
+    refresher = main.SubscriptionRefresher(bot, concurrency=4, rate=1000, batch_size=6)
+
+    async def scenario():
+        await seed(subscribed={8, 9, 10, 11, 12, 20})
+        stats = await refresher.run()
+        return stats, await subscribed_ids(), await main.get_checkpoint(refresher.CHECKPOINT)
+
+    stats, subscribed, checkpoint = loop.run_until_complete(scenario())
+    # 20 не удалось проверить: статус в базе не меняется
+    assert subscribed == list(range(1, 11)) + [20]
+    assert stats['checked'] == 20
+    assert stats['changed'] == 9
+    assert stats['retry_after'] == 1
+    assert stats['errors'] == 1
+    assert bot.calls.count(3) == 2
+    assert bot.max_in_flight <= 4
+    assert checkpoint is None
+
+
+def test_refresh_resumes_from_checkpoint(db, loop):
+    bot = FakeBot(subscribed=range(1, 21))
+    refresher = main.SubscriptionRefresher(bot, concurrency=4, rate=1000, batch_size=5)
+
+    async def scenario():
+        await seed(subscribed=set())
+        await main.set_checkpoint(refresher.CHECKPOINT, 15)
+        stats = await refresher.run()
+        return stats, await subscribed_ids()
+
+    stats, subscribed = loop.run_until_complete(scenario())
+    assert sorted(bot.calls) == list(range(16, 21))
+    assert stats['checked'] == 5
+    assert subscribed == list(range(16, 21))
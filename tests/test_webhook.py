@@ -0,0 +1,91 @@
+"""Webhook-сервер на локальном порту: POST поддельных обновлений, секрет, лимит и плавная остановка"""
+import asyncio
+
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher
+
+import main
+
+SECRET = 'test-secret'
+
+
+def make_update(update_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': 1, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'},
+            'text': f'update {update_id}'
+        }
+    }
+
+
+class Recorder:
+    """Обработчик сообщений, который ждет release и считает одновременные вызовы"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.handled = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, message):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await self.release.wait()
+            self.handled.append(message.message_id)
+        finally:
+            self.in_flight -= 1
+
+
+async def noop(dispatcher):
+    pass
+
+
+def make_client(recorder, max_in_flight):
+    dispatcher = Dispatcher(Bot('123456789:' + 'A' * 35))
+    dispatcher.register_message_handler(recorder)
+    server = main.WebhookServer(dispatcher, '/webhook', SECRET, max_in_flight)
+    return TestClient(TestServer(server.make_app()))
+
+
+def post(client, update_id, secret=SECRET):
+    return client.post('/webhook', json=make_update(update_id),
+                       headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+
+
+def test_webhook_limits_and_drains(loop, monkeypatch):
+    monkeypatch.setattr(main, 'on_startup', noop)
+    monkeypatch.setattr(main, 'on_shutdown', noop)
+    recorder = Recorder()
+
+    async def scenario():
+        client = make_client(recorder, max_in_flight=2)
+        await client.start_server()
+        try:
+            response = await post(client, 100, secret='wrong')
+            assert response.status == 403
+
+            # Два обновления обрабатываются, остальные запросы ждут свободного места
+            requests = [asyncio.ensure_future(post(client, update_id)) for update_id in range(1, 5)]
+            await asyncio.sleep(0.2)
+            assert recorder.in_flight == 2
+            assert sum(request.done() for request in requests) == 2
+
+            recorder.release.set()
+            responses = await asyncio.gather(*requests)
+            assert [response.status for response in responses] == [200] * 4
+
+            # Обновление, принятое перед остановкой, обрабатывается до ее завершения
+            recorder.release.clear()
+            assert (await post(client, 5)).status == 200
+            loop.call_later(0.1, recorder.release.set)
+        finally:
+            await client.close()
+
+    loop.run_until_complete(scenario())
+    assert sorted(recorder.handled) == [1, 2, 3, 4, 5]
+    assert recorder.max_in_flight == 2
@@ -0,0 +1,97 @@
+"""Недельная рассылка на заглушке Bot: постоянные ошибки, повторы, RetryAfter и продолжение с чекпоинта"""
+import asyncio
+from datetime import datetime
+
+from aiogram.utils.exceptions import BotBlocked, CantInitiateConversation, ChatNotFound, RetryAfter
+
+import main
+
+YEAR, WEEK, _ = datetime.now().isocalendar()
+WEEK_ID = YEAR * 100 + WEEK
+
+
+class FakeBot:
+    """send_message без сети: errors - user_id -> список исключений, выдаваемых по очереди перед успехом"""
+
+    def __init__(self, errors=None):
+        self.errors = {user_id: list(queue) for user_id, queue in (errors or {}).items()}
+        self.calls = []
+        self.sent = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(chat_id)
+        await asyncio.sleep(0.001)
+        queue = self.errors.get(chat_id)
+        if queue:
+            raise queue.pop(0)
+        self.sent[chat_id] = text
+
+
+def make_digest(bot, batch_size=4):
+    sender = main.BroadcastSender(bot, concurrency=8, rate=1000, per_chat_interval=0.001, retries=3, backoff=0.01)
+    return main.WeeklyDigest(sender, batch_size)
+
+
+async def seed(count):
+    async with main.db_pool.write() as db:
+        await db.executemany('INSERT INTO users (user_id, username, score, is_subscribed) VALUES (?, ?, ?, 1)',
+                             [(user_id, f'user{user_id}', user_id) for user_id in range(1, count + 1)])
+
+
+async def digest_rows():
+    async with main.db_pool.read() as db:
+        cursor = await db.execute('SELECT user_id, position FROM weekly_digest ORDER BY user_id')
+        return dict(await cursor.fetchall())
+
+
+def test_digest_errors_and_retries(db, loop):
+    network_error = RuntimeError('network error')
+    bot = FakeBot({
+        2: [BotBlocked('Forbidden: bot was blocked by the user')],
+        3: [CantInitiateConversation("Forbidden: bot can't initiate conversation with a user")],
+        4: [ChatNotFound('Bad Request: chat not found')],
+        5: [RetryAfter(1)],
+        6: [network_error],
+        7: [network_error] * 3,
+    })
+    digest = make_digest(bot)
+
+    async def scenario():
+        await seed(10)
+        stats = await digest.run(WEEK_ID)
+        return stats, await digest_rows(), await main.get_checkpoint(digest.WEEK_CHECKPOINT)
+
+    stats, rows, week = loop.run_until_complete(scenario())
+    # Постоянные ошибки - одна попытка, временные - повтор, исчерпавшие попытки не считаются доставленными
+    assert [bot.calls.count(user_id) for user_id in range(1, 11)] == [1, 1, 1, 1, 2, 2, 3, 1, 1, 1]
+    assert stats['sent'] == 6
+    assert stats['blocked'] == 3
+    assert stats['retry_after'] == 1
+    assert stats['retries'] == 3
+    assert stats['failed'] == 1
+    assert sorted(rows) == [1, 5, 6, 8, 9, 10]
+    assert rows[10] == 1
+    assert week == WEEK_ID
+    assert 'Ваше место:</b> 1 (🆕)' in bot.sent[10]
+
+
+def test_digest_resumes_from_checkpoint(db, loop):
+    bot = FakeBot()
+    digest = make_digest(bot)
+
+    async def scenario():
+        await seed(10)
+        await main.set_checkpoint(f'weekly_digest_{WEEK_ID}', 6)
+        await digest.run(WEEK_ID)
+        return (await main.get_checkpoint(f'weekly_digest_{WEEK_ID}'),
+                await main.get_checkpoint(digest.WEEK_CHECKPOINT))
+
+    checkpoint, week = loop.run_until_complete(scenario())
+    assert sorted(bot.calls) == [7, 8, 9, 10]
+    assert checkpoint is None
+    assert week == WEEK_ID
+
+    # Повторный запуск на той же неделе run_if_due не выполняет
+    bot.calls.clear()
+    loop.run_until_complete(digest.run_if_due())
+    assert bot.calls == []